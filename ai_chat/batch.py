@@ -0,0 +1,136 @@
+import asyncio
+import dataclasses
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Type
+
+if TYPE_CHECKING:
+    from ai_chat.chat import Chat
+
+from ai_chat.types import AiConfig, ChatResponse, Message
+from ai_chat.store.base import Store
+from ai_chat.limits import RateLimiter
+
+
+@dataclasses.dataclass
+class BatchResult:
+    thread_id: str
+    content: str
+    response: ChatResponse | None = None
+    error: Exception | None = None
+
+
+class BulkWriter:
+    """Collects the messages of finished turns, and writes them in bulk."""
+
+    def __init__(self, store: Store, chat: "Chat", flush_every: int):
+        self.store = store
+        self.chat = chat
+        self.flush_every = flush_every
+        self.pending: list[Message] = []
+        # held while writing too, so a thread's turns are written in order
+        self.lock = threading.Lock()
+
+    def add(self, messages: list[Message]):
+        with self.lock:
+            self.pending.extend(messages)
+            if len(self.pending) >= self.flush_every:
+                self.flush_locked()
+
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        if self.pending:
+            # messages carry their own thread_id, the chat only supplies defaults
+            self.store.add_messages(self.pending, self.chat)
+            self.pending = []
+
+
+def group_requests(requests: list[tuple[str, str]]) -> dict[str, list[tuple[int, str]]]:
+    """thread_id -> [(index, content)], a thread's turns run in order, by one worker."""
+    threads: dict[str, list[tuple[int, str]]] = {}
+    for index, (thread_id, content) in enumerate(requests):
+        threads.setdefault(thread_id, []).append((index, content))
+    return threads
+
+
+def chat_many(chat_class: Type["Chat"], requests: list[tuple[str, str]], *, ai: AiConfig, store: Store,
+              concurrency=8, rate_limiter: RateLimiter | None = None, flush_every=500, **kws) -> list[BatchResult]:
+    """Run (thread_id, content) turns, `concurrency` threads at a time, see Chat.chat_many."""
+    threads = group_requests(requests)
+    results: list[BatchResult | None] = [None] * len(requests)
+    probe = chat_class(ai=ai, store=store, **kws)
+    history = store.get_thread_messages(probe, list(threads), probe.history_limit)
+    writer = BulkWriter(store, probe, flush_every)
+
+    def run_thread(thread_id: str):
+        chat = chat_class(ai=ai, thread_id=thread_id, store=store, **kws)
+        chat.rate_limiter = rate_limiter
+        last = history.get(thread_id, [])
+        for index, content in threads[thread_id]:
+            # collect the turn's messages instead of writing them, see Chat.batch
+            turn: list[Message] = []
+            token = chat.pending_var.set(turn)
+            try:
+                response = chat.chat(content, history=last)
+                writer.add(turn)
+                last = (last + turn)[-chat.history_limit:]
+                results[index] = BatchResult(thread_id, content, response)
+            except Exception as e:
+                results[index] = BatchResult(thread_id, content, error=e)
+            finally:
+                chat.pending_var.reset(token)
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(run_thread, threads))
+    finally:
+        writer.flush()
+    return results
+
+
+async def achat_many(chat_class: Type["Chat"], requests: list[tuple[str, str]], *, ai: AiConfig, store: Store,
+                     concurrency=8, rate_limiter: RateLimiter | None = None, flush_every=500,
+                     **kws) -> list[BatchResult]:
+    threads = group_requests(requests)
+    results: list[BatchResult | None] = [None] * len(requests)
+    probe = chat_class(ai=ai, store=store, **kws)
+    history = await store.aget_thread_messages(probe, list(threads), probe.history_limit)
+    pending: list[Message] = []
+    write_lock = asyncio.Lock()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def flush():
+        nonlocal pending
+        async with write_lock:
+            if pending:
+                batch, pending = pending, []
+                await store.aadd_messages(batch, probe)
+
+    async def run_thread(thread_id: str):
+        async with semaphore:
+            chat = chat_class(ai=ai, thread_id=thread_id, store=store, **kws)
+            chat.rate_limiter = rate_limiter
+            last = history.get(thread_id, [])
+            for index, content in threads[thread_id]:
+                turn: list[Message] = []
+                token = chat.pending_var.set(turn)
+                try:
+                    response = await chat.achat(content, history=last)
+                    pending.extend(turn)
+                    last = (last + turn)[-chat.history_limit:]
+                    results[index] = BatchResult(thread_id, content, response)
+                except Exception as e:
+                    results[index] = BatchResult(thread_id, content, error=e)
+                finally:
+                    chat.pending_var.reset(token)
+                if len(pending) >= flush_every:
+                    await flush()
+
+    try:
+        await asyncio.gather(*(run_thread(thread_id) for thread_id in threads))
+    finally:
+        await flush()
+    return results
@@ -0,0 +1,173 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+from ai_chat.types import Function
+
+Completion = tuple[str, str, Function | list[Function] | None]
+
+
+def completion_key(prompt: list[dict], schema, model_params: dict) -> str:
+    """Canonical hash of everything that determines a completion."""
+    data = json.dumps(dict(prompt=prompt, functions=schema, params=model_params), sort_keys=True,
+                      separators=(",", ":"), default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def dump_completion(completion: Completion) -> str:
+    role, content, function = completion
+
+    def dump_function(f: Function):
+        return dict(f.__dict__)
+
+    if isinstance(function, list):
+        function = [dump_function(f) for f in function]
+    elif function:
+        function = dump_function(function)
+    return json.dumps(dict(role=role, content=content, function=function))
+
+
+def load_completion(data: str) -> Completion:
+    data = json.loads(data)
+    function = data["function"]
+    if isinstance(function, list):
+        function = [Function(**f) for f in function]
+    elif function:
+        function = Function(**function)
+    return data["role"], data["content"], function
+
+
+class CompletionCache(ABC):
+    """Cache for chat_complete results, set as AiConfig(completion_cache=...).
+
+    Only used when the model's temperature is 0, unless `always` is set.
+    """
+
+    def __init__(self, *, max_size=10000, ttl: float | None = None, always=False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.always = always
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def enabled(self, model_params: dict) -> bool:
+        return self.always or model_params.get("temperature") == 0
+
+    def stats(self) -> dict:
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+    def get(self, key: str) -> Completion | None:
+        data = self.load(key)
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return load_completion(data)
+
+    def set(self, key: str, completion: Completion):
+        self.save(key, dump_completion(completion))
+
+    @abstractmethod
+    def load(self, key: str) -> str | None:
+        """Serialized completion, or None if missing or expired."""
+
+    @abstractmethod
+    def save(self, key: str, data: str):
+        ...
+
+
+class MemoryCompletionCache(CompletionCache):
+    """In-process LRU."""
+
+    def __init__(self, **kws):
+        super().__init__(**kws)
+        self.entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def load(self, key: str) -> str | None:
+        with self.lock:
+            ent = self.entries.get(key)
+            if ent is None:
+                return None
+            created, data = ent
+            if self.ttl is not None and time.time() - created > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return data
+
+    def save(self, key: str, data: str):
+        with self.lock:
+            self.entries[key] = (time.time(), data)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+
+class SqliteCompletionCache(CompletionCache):
+    """Cache shared by processes on one host, and kept across restarts.
+
+    Size and ttl are enforced every `prune_every` saves rather than on each one, so the table can run up to
+    that many rows (per process) over max_size, and expired rows linger until the next prune. load() never
+    returns an expired row.
+    """
+
+    def __init__(self, db_path, prune_every=100, **kws):
+        super().__init__(**kws)
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.prune_every = prune_every
+        self.saves = 0
+        with self.lock:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS completions (
+                    key TEXT PRIMARY KEY,
+                    content TEXT,
+                    created_at REAL,
+                    used_at REAL
+                );
+
+                create index if not exists ix_completions_used_at on completions(used_at);
+                create index if not exists ix_completions_created_at on completions(created_at);
+            """)
+            self.conn.commit()
+
+    def load(self, key: str) -> str | None:
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT content, created_at FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if self.ttl is not None and now - row[1] > self.ttl:
+                self.conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+                self.conn.commit()
+                return None
+            self.conn.execute("UPDATE completions SET used_at = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+            return row[0]
+
+    def save(self, key: str, data: str):
+        now = time.time()
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO completions (key, content, created_at, used_at) "
+                              "VALUES (?, ?, ?, ?)", (key, data, now, now))
+            self.saves += 1
+            if self.saves % self.prune_every == 0:
+                self.prune(now)
+            self.conn.commit()
+
+    def prune(self, now: float):
+        """Drop expired rows, then the least recently used ones over max_size, call with the lock held."""
+        if self.ttl is not None:
+            self.conn.execute("DELETE FROM completions WHERE created_at < ?", (now - self.ttl,))
+        count = self.conn.execute("SELECT count(*) FROM completions").fetchone()[0]
+        if count > self.max_size:
+            self.conn.execute("DELETE FROM completions WHERE key IN "
+                              "(SELECT key FROM completions ORDER BY used_at LIMIT ?)", (count - self.max_size,))
+            self.evictions += count - self.max_size
@@ -1,26 +1,111 @@
+import asyncio
+import contextlib
+import contextvars
+import inspect
 import json
 import logging as log
+import time
 from abc import ABC, abstractmethod
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, Generator, Iterator, AsyncIterator
+
+from ai_functions.functions import prepare_function
 
 from ai_chat.types import Message, Function, ChatResponse, AiConfig, AIFunctions
 from ai_chat.store.base import Store
+from ai_chat.prompt import PromptBuilder, summary_prompt
+from ai_chat.cache import completion_key
+from ai_chat.schema import FunctionSchema, function_schema, schema_version
+from ai_chat.instrument import TurnStats
+from ai_chat.limits import RateLimiter
+from ai_chat import batch
 from ai_chat.util import uuid
 
 
 class Chat(ABC):
+    # set to share a pool for running parallel tool calls, otherwise one is made per turn
+    tool_executor: Executor | None = None
+    # how many recent messages are loaded for each turn
+    history_limit = 20
+    # set to pace completions to a provider's limits, see ai_chat.limits
+    rate_limiter: "RateLimiter | None" = None
+    # chat_complete takes tool_choice="none", so the answer after the last tool hop can still see the tools
+    supports_tool_choice = False
+    # chat_complete admits each request itself, on the model it goes to, instead of complete admitting the turn's
+    admits_per_request = False
+
     def __init__(self, *, ai: "AiConfig", thread_id: str | None = None, store: Store | None = None):
         """Thread of conversation"""
         self.ai = ai
         self.functions = self.ai.functions
         self.thread_id = thread_id
         self.store = store
+        self.prompt_builder = PromptBuilder(ai.token_counter)
+        # messages waiting for the end of the turn, per thread or task like turn_var, see batch() and pending
+        self.pending_var: contextvars.ContextVar[list[Message] | None] = contextvars.ContextVar("pending",
+                                                                                                default=None)
+        # the user's message this turn, functions are selected by it
+        self.turn_content: str | None = None
+        # stats of the turn in progress, per thread or task so concurrent turns don't share them, see turn
+        self.turn_var: contextvars.ContextVar[TurnStats | None] = contextvars.ContextVar("turn", default=None)
+        # stats of the last turn to finish
+        self.last_turn: TurnStats | None = None
+
+    @property
+    def functions(self) -> AIFunctions:
+        return self._functions
+
+    @functions.setter
+    def functions(self, functions: AIFunctions):
+        self._functions = functions
+        self._schema = None
+
+    def function_schema(self, functions) -> FunctionSchema | None:
+        """Schema of an AIFunctions set, reused until the set or chat.functions changes."""
+        if not isinstance(functions, AIFunctions):
+            return None
+        if self._schema and self._schema[0] is functions and self._schema[1].version == schema_version(functions):
+            return self._schema[1]
+        schema = function_schema(functions)
+        self._schema = (functions, schema)
+        return schema
 
     def function_kws(self):
         """Override this to provide other kwargs to functions"""
         return {"chat": self}
 
     def recent_messages(self, content: str):
-        return self.store.get_messages(self, content)
+        return self.store.get_messages(self, content, self.history_limit)
+
+    async def arecent_messages(self, content: str):
+        return await self.store.aget_messages(self, content, self.history_limit)
+
+    def prepare_prompt(self, content, history: list["Message"] | None) -> list[dict]:
+        # this can include embeddings/search if you want, so that's why the content is there
+        self.turn_content = content
+        with self.stage("history"):
+            last_messages = history if history is not None else self.recent_messages(content)
+
+        summary = None
+        if self.ai.compactor and self.store and history is None:
+            with self.stage("compact"):
+                summary, last_messages = self.ai.compactor.apply(self, last_messages)
+
+        with self.stage("prompt"):
+            return self.build_prompt(content, last_messages, summary)
+
+    async def aprepare_prompt(self, content, history: list["Message"] | None) -> list[dict]:
+        self.turn_content = content
+        with self.stage("history"):
+            last_messages = history if history is not None else await self.arecent_messages(content)
+
+        summary = None
+        if self.ai.compactor and self.store and history is None:
+            with self.stage("compact"):
+                summary, last_messages = await self.ai.compactor.aapply(self, last_messages)
+
+        with self.stage("prompt"):
+            return self.build_prompt(content, last_messages, summary)
 
     def get_system(self):
         """Override this if you want the current state to be considered in the system prompt."""
@@ -28,38 +113,142 @@ class Chat(ABC):
 
     def chat(self, content, history: list["Message"] | None = None, save=True) -> ChatResponse:
         """Continue a conversation"""
+        def turn(content):
+            prompt = self.prepare_prompt(content, history)
+            return self.chat_as(content, "user", prompt, save=save)
+
+        with self.measure_turn() as stats:
+            response = self.ai.turn_lock.run(self, content, turn) if self.ai.turn_lock else turn(content)
+        response.stats = stats
+        return response
+
+    async def achat(self, content, history: list["Message"] | None = None, save=True) -> ChatResponse:
+        """Continue a conversation, without blocking the event loop"""
+        async def turn(content):
+            prompt = await self.aprepare_prompt(content, history)
+            return await self.achat_as(content, "user", prompt, save=save)
+
+        with self.measure_turn() as stats:
+            response = await self.ai.turn_lock.arun(self, content, turn) if self.ai.turn_lock else await turn(content)
+        response.stats = stats
+        return response
+
+    def chat_stream(self, content, history: list["Message"] | None = None, save=True) -> Iterator[str]:
+        """Continue a conversation, yielding reply text as it arrives.
+
+        The final ChatResponse is the generator's return value (use `yield from` to get it).
+        """
+        with self.measure_turn() as stats, self.thread_lock():
+            prompt = self.prepare_prompt(content, history)
 
-        # this can include embeddings/search if you want, so that's why the content is there
-        last_messages = history or self.recent_messages(content)
-
-        prompt = [
-            {
-                "role": "system",
-                "content": self.get_system()
-            }
-        ]
-
-        if not last_messages:
-            if self.ai.seed_chat:
-                for user, assistant in self.ai.seed_chat:
-                    prompt.append(
-                        {
-                            "role": "user",
-                            "content": user,
-                        }
-                    )
-                    prompt.append(
-                        {
-                            "role": "assistant",
-                            "content": assistant,
-                        }
-                    )
-
-        for msg in last_messages:
-            info = self.get_prompt(msg.role, msg.content)
-            prompt.append(info)
-
-        return self.chat_as(content, "user", prompt, save=save)
+            response = yield from self.chat_as_stream(content, "user", prompt, save=save)
+        response.stats = stats
+        return response
+
+    async def achat_stream(self, content, history: list["Message"] | None = None, save=True) -> AsyncIterator[str]:
+        """Continue a conversation, yielding reply text as it arrives, stats are in last_turn."""
+        with self.measure_turn():
+            async with self.athread_lock():
+                prompt = await self.aprepare_prompt(content, history)
+
+                async for delta in self.achat_as_stream(content, "user", prompt, save=save):
+                    yield delta
+
+    @classmethod
+    def chat_many(cls, requests: list[tuple[str, str]], *, ai: "AiConfig", store: Store, concurrency=8,
+                  rate_limiter: RateLimiter | None = None, **kws) -> list["batch.BatchResult"]:
+        """Run many (thread_id, content) turns concurrently, results (or errors) are in input order.
+
+        History for every thread is read with one store query, a thread's turns run in order, and the new
+        messages are written in bulk, every `flush_every` messages and at the end.
+        """
+        return batch.chat_many(cls, requests, ai=ai, store=store, concurrency=concurrency,
+                               rate_limiter=rate_limiter, **kws)
+
+    @classmethod
+    async def achat_many(cls, requests: list[tuple[str, str]], *, ai: "AiConfig", store: Store, concurrency=8,
+                         rate_limiter: RateLimiter | None = None, **kws) -> list["batch.BatchResult"]:
+        return await batch.achat_many(cls, requests, ai=ai, store=store, concurrency=concurrency,
+                                      rate_limiter=rate_limiter, **kws)
+
+    def thread_lock(self):
+        """Hold ai.turn_lock for this thread, if set."""
+        return self.ai.turn_lock.hold(self) if self.ai.turn_lock else contextlib.nullcontext()
+
+    def athread_lock(self):
+        return self.ai.turn_lock.ahold(self) if self.ai.turn_lock else contextlib.nullcontext()
+
+    @property
+    def pending(self) -> list[Message] | None:
+        """Messages batched by the turn in progress in the current thread or task, None outside a batch."""
+        return self.pending_var.get()
+
+    @property
+    def turn(self) -> TurnStats | None:
+        """Stats of the turn in progress in the current thread or task."""
+        return self.turn_var.get()
+
+    @contextlib.contextmanager
+    def measure_turn(self):
+        """Collect TurnStats for a turn, and report them to ai.instruments."""
+        if self.turn is not None:
+            yield self.turn
+            return
+        stats = TurnStats()
+        token = self.turn_var.set(stats)
+        started = time.perf_counter()
+        try:
+            with contextlib.ExitStack() as spans:
+                for instrument in self.ai.instruments:
+                    spans.enter_context(instrument.span("turn", self))
+                yield stats
+        finally:
+            stats.seconds = time.perf_counter() - started
+            try:
+                self.turn_var.reset(token)
+            except ValueError:
+                # a stream closed from another context, that context never saw the turn
+                pass
+            self.last_turn = stats
+            for instrument in self.ai.instruments:
+                instrument.on_turn(self, stats)
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """Time a stage of the turn."""
+        with contextlib.ExitStack() as spans:
+            for instrument in self.ai.instruments:
+                spans.enter_context(instrument.span(name, self))
+            started = time.perf_counter()
+            try:
+                yield
+            finally:
+                seconds = time.perf_counter() - started
+                if self.turn is not None:
+                    self.turn.add(name, seconds)
+                for instrument in self.ai.instruments:
+                    instrument.on_stage(self, name, seconds)
+
+    def add_usage(self, usage):
+        """Count token usage, as reported by the model."""
+        if self.turn is not None and usage:
+            self.turn.add_usage(usage)
+
+    def build_prompt(self, content: str, last_messages: list["Message"], summary: str | None = None) -> list[dict]:
+        """Override to change prompt assembly, default packs newest history into ai.max_prompt tokens."""
+        return self.prompt_builder.build(self, content, last_messages, summary)
+
+    def summarize(self, summary: str | None, messages: list["Message"]) -> str:
+        """Fold messages into a running summary, see Compactor. Override to use a cheaper model."""
+        prompt = summary_prompt(summary, messages)
+        self.admit(prompt)
+        with self.stage("summarize"):
+            _, reply, _ = self.chat_complete(prompt, None)
+        return reply
+
+    async def asummarize(self, summary: str | None, messages: list["Message"]) -> str:
+        """Override for native async, by default runs summarize in a worker thread"""
+        return await asyncio.to_thread(self.summarize, summary, messages)
 
     @staticmethod
     def get_prompt(role, content):
@@ -80,6 +269,58 @@ class Chat(ABC):
 
         return prompt
 
+    @staticmethod
+    def tool_calls_prompt(functions: list[Function]):
+        return {
+            'role': 'assistant',
+            'content': None,
+            'tool_calls': [
+                {'id': f.id, 'type': 'function', 'function': {'name': f.name, 'arguments': f.arguments}}
+                for f in functions
+            ],
+        }
+
+    @staticmethod
+    def tool_result_prompt(function: Function, content):
+        return {
+            'role': 'tool',
+            'tool_call_id': function.id,
+            'content': content,
+        }
+
+    @staticmethod
+    def call_chain(in_role, content, calls: list[Function], results: list[str]):
+        """Structure parallel calls as the (in_role, content, call) pairs sequential calls would save."""
+        roles = [in_role] + ['function:' + call.name for call in calls[:-1]]
+        return list(zip(roles, [content] + results[:-1], calls))
+
+    def next_hop(self, prompt, function: Function | list[Function], results: list[str]):
+        """Add all but the last function result to the prompt, returns (content, in_role, tool_call) for the last."""
+        if not isinstance(function, list):
+            return results[0], 'function:' + function.name, None
+        prompt.append(self.tool_calls_prompt(function))
+        for call, result in zip(function[:-1], results[:-1]):
+            prompt.append(self.tool_result_prompt(call, result))
+        return results[-1], 'function:' + function[-1].name, function[-1]
+
+    def execute_functions(self, functions: list[Function]) -> list[str]:
+        """Run independent calls at the same time, results are in call order."""
+        if self.turn is not None:
+            self.turn.hops += 1
+        with self.stage("functions"):
+            if len(functions) == 1:
+                return [self.execute_function(functions[0])]
+            if self.tool_executor:
+                return list(self.tool_executor.map(self.execute_function, functions))
+            with ThreadPoolExecutor(max_workers=min(len(functions), self.ai.tool_workers)) as pool:
+                return list(pool.map(self.execute_function, functions))
+
+    async def aexecute_functions(self, functions: list[Function]) -> list[str]:
+        if self.turn is not None:
+            self.turn.hops += 1
+        with self.stage("functions"):
+            return list(await asyncio.gather(*(self.aexecute_function(f) for f in functions)))
+
     def execute_function(self, function: Function):
         function_name = function.name
         functions = self.ai_functions()
@@ -91,26 +332,86 @@ class Chat(ABC):
             log.exception("Got an error while running function")
             return f"{self.ai.error_prefix} '{repr(e)}' while running '{function_name}'"
 
-    def chat_as(self, content, in_role, prompt, save=True) -> ChatResponse:
-        # add content and role to the prompt
-        prompt.append(self.get_prompt(in_role, content))
+    async def aexecute_function(self, function: Function):
+        functions = self.ai_functions()
+        func = functions.map.get(function.name) if functions else None
+        if not inspect.iscoroutinefunction(func):
+            # plain functions may block, so keep them off the loop
+            return await asyncio.to_thread(self.execute_function, function)
+        try:
+            args, func = prepare_function(function.arguments, [func], function.name)
+            ret = await func(**{**args, **self.function_kws()})
+            return functions.convert_output(ret) if functions.convert_output else ret
+        except Exception as e:
+            log.exception("Got an error while running function")
+            return f"{self.ai.error_prefix} '{repr(e)}' while running '{function.name}'"
 
-        functions = self.get_functions()
+    def prompt_tokens(self, prompt: list[dict]) -> int:
+        return sum(self.ai.token_counter.count_prompt(info) for info in prompt)
 
-        out_role, reply, function = self.chat_complete(prompt, functions)
+    def hop_limit(self, hop: int, started: float, spent: int) -> str | None:
+        """The limit this hop is past, if any, the model then has to answer without tools.
 
-        if function:
-            function_result = self.execute_function(function)
+        `spent` is the prompt tokens sent this turn, including this hop's prompt.
+        """
+        if self.ai.max_hops is not None and hop >= self.ai.max_hops:
+            limit = "max_hops"
+        elif self.ai.turn_deadline is not None and time.monotonic() - started >= self.ai.turn_deadline:
+            limit = "deadline"
+        elif self.ai.turn_token_budget is not None and spent > self.ai.turn_token_budget:
+            limit = "token_budget"
+        else:
+            return None
+        log.warning("tool loop hit %s after %s hops, asking for a final answer", limit, hop)
+        if self.turn is not None:
+            self.turn.limit = limit
+        return limit
+
+    def tool_loop(self, content, in_role, prompt, save=True,
+                  tool_call: Function | None = None) -> Generator[tuple, Any, ChatResponse]:
+        """The turn's tool calling loop, as steps for chat_as and its async and streaming versions to run.
+
+        Yields ("complete", prompt, functions, tool_choice), ("execute", calls) and
+        ("save", in_role, content, out_role, reply, hop_start) steps, is sent each step's result,
+        and returns the ChatResponse.
+        """
+        hop, started, spent, hop_start = 0, time.monotonic(), 0, None
+        while True:
+            # add content and role to the prompt
+            prompt.append(self.tool_result_prompt(tool_call, content) if tool_call else self.get_prompt(in_role, content))
+
+            spent += self.prompt_tokens(prompt)
+            limit = self.hop_limit(hop, started, spent)
+            functions, tool_choice = self.get_functions(), None
+            if limit:
+                # the model may see the tools its history refers to, but has to answer in text
+                functions, tool_choice = (functions, "none") if self.supports_tool_choice and functions else (None, None)
+
+            out_role, reply, function = yield "complete", prompt, functions, tool_choice
+
+            if not function:
+                break
+            if limit:
+                # calls weren't allowed, one now can't be answered
+                out_role, reply = "assistant", reply or ""
+                break
+
+            calls = function if isinstance(function, list) else [function]
+            results = yield "execute", calls
 
             if save:
+                # the hop's calls and results start after its first message, see drop_failed_call
+                hop_start = len(self.pending) + 1 if self.pending is not None else None
                 # structure as the db would and save
-                self.save_interaction(in_role, content, out_role, function)
+                for hop_role, hop_content, call in self.call_chain(in_role, content, calls, results):
+                    yield "save", hop_role, hop_content, out_role, call, None
 
             # continue chat with the functional reply, don't return until you get an assistant reply
-            return self.chat_as(function_result, 'function:' + function.name, prompt)
+            content, in_role, tool_call = self.next_hop(prompt, function, results)
+            hop += 1
 
         if save:
-            request_id, response_id = self.save_interaction(in_role, content, out_role, reply)
+            request_id, response_id = yield "save", in_role, content, out_role, reply, hop_start
         else:
             request_id, response_id = None, None
 
@@ -120,6 +421,80 @@ class Chat(ABC):
             content=reply
         )
 
+    def run_step(self, step: tuple):
+        kind, *args = step
+        if kind == "complete":
+            return self.complete(*args)
+        if kind == "execute":
+            return self.execute_functions(*args)
+        return self.save_interaction(*args)
+
+    async def arun_step(self, step: tuple):
+        kind, *args = step
+        if kind == "complete":
+            return await self.acomplete(*args)
+        if kind == "execute":
+            return await self.aexecute_functions(*args)
+        return await self.asave_interaction(*args)
+
+    def chat_as(self, content, in_role, prompt, save=True, tool_call: Function | None = None) -> ChatResponse:
+        with self.batch():
+            steps, result = self.tool_loop(content, in_role, prompt, save, tool_call), None
+            while True:
+                try:
+                    step = steps.send(result)
+                except StopIteration as stop:
+                    return stop.value
+                result = self.run_step(step)
+
+    async def achat_as(self, content, in_role, prompt, save=True, tool_call: Function | None = None) -> ChatResponse:
+        async with self.abatch():
+            steps, result = self.tool_loop(content, in_role, prompt, save, tool_call), None
+            while True:
+                try:
+                    step = steps.send(result)
+                except StopIteration as stop:
+                    return stop.value
+                result = await self.arun_step(step)
+
+    def chat_as_stream(self, content, in_role, prompt, save=True, tool_call: Function | None = None) -> Iterator[str]:
+        with self.batch():
+            steps, result = self.tool_loop(content, in_role, prompt, save, tool_call), None
+            while True:
+                try:
+                    step = steps.send(result)
+                except StopIteration as stop:
+                    return stop.value
+                if step[0] != "complete":
+                    result = self.run_step(step)
+                    continue
+                # keep streaming, through every hop
+                result = None, None, None
+                for event in self.complete_stream(*step[1:]):
+                    if isinstance(event, tuple):
+                        result = event
+                    else:
+                        yield event
+
+    async def achat_as_stream(self, content, in_role, prompt, save=True,
+                              tool_call: Function | None = None) -> AsyncIterator[str]:
+        async with self.abatch():
+            steps, result = self.tool_loop(content, in_role, prompt, save, tool_call), None
+            while True:
+                try:
+                    step = steps.send(result)
+                except StopIteration:
+                    return
+                if step[0] != "complete":
+                    result = await self.arun_step(step)
+                    continue
+                result = None, None, None
+                async for event in self.acomplete_stream(*step[1:]):
+                    if isinstance(event, tuple):
+                        result = event
+                    else:
+                        yield event
+
     def ai_functions(self) -> AIFunctions:
         """Override to vary functions based on state."""
         return self.functions
@@ -129,24 +504,108 @@ class Chat(ABC):
 
         You will also need to override execute_function.
         """
-        return self.ai_functions() and self.ai_functions()
+        functions = self.ai_functions()
+        if functions and self.ai.tool_selector and self.turn_content:
+            return self.ai.tool_selector.select(self, functions, self.turn_content)
+        return functions
 
     def add_message(self, role: str, content: str | Function):
         if isinstance(content, Function):
             role = "function:" + content.name
             content = content.arguments
         user_chat = self.structure_reply(content, role)
-        if self.store:
+        if self.pending is not None:
+            self.pending.append(user_chat)
+        elif self.store:
             self.store.add_message(user_chat, self)
         return user_chat.id
 
-    def save_interaction(self, in_role: str, content: str, out_role: str, reply: str | Function):
-        is_error = in_role == "function_all" and reply.startswith(self.ai.error_prefix)
+    async def aadd_message(self, role: str, content: str | Function):
+        if isinstance(content, Function):
+            role = "function:" + content.name
+            content = content.arguments
+        user_chat = self.structure_reply(content, role)
+        if self.pending is not None:
+            self.pending.append(user_chat)
+        elif self.store:
+            await self.store.aadd_message(user_chat, self)
+        return user_chat.id
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Collect added messages, and write them in one transaction when the outermost batch exits.
 
-        if not is_error:
+        If the block raises, nothing is written, so a half finished function chain stays out of the history.
+        """
+        if self.pending is not None:
+            yield
+            return
+        pending: list[Message] = []
+        token = self.pending_var.set(pending)
+        try:
+            yield
+            if pending and self.store:
+                with self.stage("save"):
+                    self.store.add_messages(pending, self)
+        finally:
+            try:
+                self.pending_var.reset(token)
+            except ValueError:
+                # a stream closed from another context, see measure_turn
+                pass
+
+    @contextlib.asynccontextmanager
+    async def abatch(self):
+        if self.pending is not None:
+            yield
+            return
+        pending: list[Message] = []
+        token = self.pending_var.set(pending)
+        try:
+            yield
+            if pending and self.store:
+                with self.stage("save"):
+                    await self.store.aadd_messages(pending, self)
+        finally:
+            try:
+                self.pending_var.reset(token)
+            except ValueError:
+                # a stream closed from another context, see measure_turn
+                pass
+
+    def is_error(self, in_role: str, content: str, reply: str | Function) -> bool:
+        """A final reply to a failed function, kept out of the history."""
+        return (in_role.startswith("function:") and not isinstance(reply, Function)
+                and isinstance(content, str) and content.startswith(self.ai.error_prefix))
+
+    def drop_failed_call(self, in_role: str, hop_start: int | None = None):
+        """The failed hop is still waiting in the batch, drop its calls and results from `hop_start` on.
+
+        Without `hop_start`, only the last call is dropped (saved under the function's role).
+        """
+        if self.pending is None:
+            return
+        if hop_start is not None:
+            del self.pending[hop_start:]
+        elif self.pending and self.pending[-1].role == in_role:
+            self.pending.pop()
+
+    def save_interaction(self, in_role: str, content: str, out_role: str, reply: str | Function,
+                         hop_start: int | None = None):
+        if not self.is_error(in_role, content, reply):
             user_id = self.add_message(in_role, content)
             assistant_id = self.add_message(out_role, reply)
             return user_id, assistant_id
+        self.drop_failed_call(in_role, hop_start)
+        return None, None
+
+    async def asave_interaction(self, in_role: str, content: str, out_role: str, reply: str | Function,
+                                hop_start: int | None = None):
+        if not self.is_error(in_role, content, reply):
+            user_id = await self.aadd_message(in_role, content)
+            assistant_id = await self.aadd_message(out_role, reply)
+            return user_id, assistant_id
+        self.drop_failed_call(in_role, hop_start)
         return None, None
 
     def structure_reply(self, reply: str, role: str):
@@ -159,6 +618,128 @@ class Chat(ABC):
             content=reply,
         )
 
+    def cache_key(self, prompt, functions, tool_choice: str | None = None) -> str | None:
+        """Key for the completion cache, or None if this completion shouldn't be cached."""
+        cache = self.ai.completion_cache
+        if not cache or not cache.enabled(self.ai.model_params):
+            return None
+        schema = self.function_schema(functions)
+        schema = schema.digest if schema else functions
+        params = {**self.ai.model_params, "parallel_tools": self.ai.parallel_tools}
+        if tool_choice:
+            params["tool_choice"] = tool_choice
+        return completion_key(prompt, schema, params)
+
+    def request_tokens(self, prompt) -> int:
+        """Tokens a completion counts against a provider's limit: the prompt, and the most it may reply."""
+        return self.prompt_tokens(prompt) + (self.ai.model_params.get("max_tokens") or 0)
+
+    def admit(self, prompt, model: str | None = None):
+        """Wait for ai.admission and the rate limiter, if any. Raises limits.Overloaded when shed.
+
+        `model` is the one the request goes to, if not ai.model_params' model.
+        """
+        if self.ai.admission:
+            self.ai.admission.acquire(model or self.ai.model_params.get("model"), self.request_tokens(prompt),
+                                      self.ai.priority)
+        if self.rate_limiter:
+            self.rate_limiter.acquire(self.request_tokens(prompt))
+
+    async def aadmit(self, prompt, model: str | None = None):
+        if self.ai.admission:
+            await self.ai.admission.aacquire(model or self.ai.model_params.get("model"), self.request_tokens(prompt),
+                                             self.ai.priority)
+        if self.rate_limiter:
+            await self.rate_limiter.aacquire(self.request_tokens(prompt))
+
+    def complete(self, prompt, functions, tool_choice: str | None = None) -> tuple[str, str, Function | list[Function] | None]:
+        """chat_complete, through ai.completion_cache if set"""
+        key = self.cache_key(prompt, functions, tool_choice)
+        if key and (hit := self.ai.completion_cache.get(key)):
+            return hit
+        if not self.admits_per_request:
+            self.admit(prompt)
+        with self.stage("complete"):
+            result = self.chat_complete(prompt, functions, **self.choice_kws(tool_choice))
+        if key:
+            self.ai.completion_cache.set(key, result)
+        return result
+
+    async def acomplete(self, prompt, functions,
+                        tool_choice: str | None = None) -> tuple[str, str, Function | list[Function] | None]:
+        key = self.cache_key(prompt, functions, tool_choice)
+        if key and (hit := self.ai.completion_cache.get(key)):
+            return hit
+        if not self.admits_per_request:
+            await self.aadmit(prompt)
+        with self.stage("complete"):
+            result = await self.achat_complete(prompt, functions, **self.choice_kws(tool_choice))
+        if key:
+            self.ai.completion_cache.set(key, result)
+        return result
+
+    def complete_stream(self, prompt, functions,
+                        tool_choice: str | None = None) -> Iterator[str | tuple[str, str, Function | None]]:
+        """chat_complete_stream, a cached reply is yielded in one piece"""
+        key = self.cache_key(prompt, functions, tool_choice)
+        if key and (hit := self.ai.completion_cache.get(key)):
+            role, reply, function = hit
+            if reply and not function:
+                yield reply
+            yield hit
+            return
+        if not self.admits_per_request:
+            self.admit(prompt)
+        with self.stage("complete"):
+            for event in self.chat_complete_stream(prompt, functions, **self.choice_kws(tool_choice)):
+                if key and isinstance(event, tuple):
+                    self.ai.completion_cache.set(key, event)
+                yield event
+
+    async def acomplete_stream(self, prompt, functions,
+                               tool_choice: str | None = None) -> AsyncIterator[str | tuple[str, str, Function | None]]:
+        key = self.cache_key(prompt, functions, tool_choice)
+        if key and (hit := self.ai.completion_cache.get(key)):
+            role, reply, function = hit
+            if reply and not function:
+                yield reply
+            yield hit
+            return
+        if not self.admits_per_request:
+            await self.aadmit(prompt)
+        with self.stage("complete"):
+            async for event in self.achat_complete_stream(prompt, functions, **self.choice_kws(tool_choice)):
+                if key and isinstance(event, tuple):
+                    self.ai.completion_cache.set(key, event)
+                yield event
+
+    @staticmethod
+    def choice_kws(tool_choice: str | None) -> dict:
+        """tool_choice for chat_complete, only passed when set, see supports_tool_choice."""
+        return {"tool_choice": tool_choice} if tool_choice else {}
+
     @abstractmethod
-    def chat_complete(self, prompt, functions) -> tuple[str, str, Function | None]:
-        """Override for your favorite chat model"""
+    def chat_complete(self, prompt, functions) -> tuple[str, str, Function | list[Function] | None]:
+        """Override for your favorite chat model, return a list of functions for parallel tool calls
+
+        Take a tool_choice keyword and set supports_tool_choice if the model can be told not to call tools.
+        """
+
+    async def achat_complete(self, prompt, functions, **kws) -> tuple[str, str, Function | None]:
+        """Override for native async, by default runs chat_complete in a worker thread"""
+        return await asyncio.to_thread(self.chat_complete, prompt, functions, **kws)
+
+    def chat_complete_stream(self, prompt, functions, **kws) -> Iterator[str | tuple[str, str, Function | None]]:
+        """Override to stream: yield content deltas, then a final (role, reply, function) tuple."""
+        role, reply, function = self.chat_complete(prompt, functions, **kws)
+        if reply and not function:
+            yield reply
+        yield role, reply, function
+
+    async def achat_complete_stream(self, prompt, functions,
+                                    **kws) -> AsyncIterator[str | tuple[str, str, Function | None]]:
+        """Async version of chat_complete_stream."""
+        role, reply, function = await self.achat_complete(prompt, functions, **kws)
+        if reply and not function:
+            yield reply
+        yield role, reply, function
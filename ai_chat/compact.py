@@ -0,0 +1,187 @@
+import asyncio
+import logging as log
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    from ai_chat.chat import Chat
+
+from ai_chat.types import Message
+
+# (chat, previous summary, messages to fold in) -> new summary
+Summarizer = Callable[["Chat", str | None, list[Message]], str]
+
+_default_executor = None
+
+
+def default_executor() -> Executor:
+    global _default_executor
+    if _default_executor is None:
+        _default_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="compact")
+    return _default_executor
+
+
+class Compactor:
+    """Folds older thread history into a running summary, stored with Store.set_state.
+
+    Once the unsummarized history passes `threshold` tokens, or fills the history window, everything but the
+    newest `keep_recent` messages is summarized together with the previous summary. Only messages newer than
+    the last summary are ever sent to the summarizer, including any that slid out of the history window
+    before they were folded in, those are fetched from the store. By default this runs in the background, so
+    the turn that triggers it is not slowed down, and the new summary is used from the next turn.
+    """
+
+    def __init__(self, summarize: Summarizer | None = None, threshold=4000, keep_recent=8, background=True,
+                 executor: Executor | None = None):
+        self.summarize = summarize
+        self.threshold = threshold
+        self.keep_recent = keep_recent
+        self.background = background
+        self.executor = executor
+        self.running: set[tuple[str, str]] = set()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def state_key(chat: "Chat"):
+        return f"summary:{chat.thread_id}"
+
+    @staticmethod
+    def unsummarized(state: dict | None, history: list[Message]) -> list[Message]:
+        if not state:
+            return history
+        ids = [m.id for m in history]
+        if state["through"] in ids:
+            return history[ids.index(state["through"]) + 1:]
+        return history
+
+    @staticmethod
+    def gap(state: dict, page: list[Message]) -> tuple[list[Message], bool]:
+        """The part of an older page after the summary's last message, and whether that message was found."""
+        ids = [m.id for m in page]
+        if state["through"] in ids:
+            return page[ids.index(state["through"]) + 1:], True
+        return page, False
+
+    def backlog(self, chat: "Chat", state: dict | None, history: list[Message]) -> list[Message]:
+        """Every message after the summary, the unsummarized history plus any that already left the window."""
+        if not state or not history or state["through"] in {m.id for m in history}:
+            return history
+        older, before = [], history[0]
+        while page := chat.store.get_messages(chat, "", 100, before):
+            part, found = self.gap(state, page)
+            older = part + older
+            if found:
+                return older + history
+            before = page[0]
+        # the summary's last message is gone, nothing to go back to
+        return history
+
+    async def abacklog(self, chat: "Chat", state: dict | None, history: list[Message]) -> list[Message]:
+        if not state or not history or state["through"] in {m.id for m in history}:
+            return history
+        older, before = [], history[0]
+        while page := await chat.store.aget_messages(chat, "", 100, before):
+            part, found = self.gap(state, page)
+            older = part + older
+            if found:
+                return older + history
+            before = page[0]
+        return history
+
+    def apply(self, chat: "Chat", history: list[Message]) -> tuple[str | None, list[Message]]:
+        """Returns the current summary and the history it doesn't cover, and starts compaction if needed."""
+        state = chat.store.get_state(chat, self.state_key(chat))
+        history = self.unsummarized(state, history)
+        if new_state := self.maybe_compact(chat, state, history):
+            state, history = new_state, self.unsummarized(new_state, history)
+        return state and state["summary"], history
+
+    async def aapply(self, chat: "Chat", history: list[Message]) -> tuple[str | None, list[Message]]:
+        state = await chat.store.aget_state(chat, self.state_key(chat))
+        history = self.unsummarized(state, history)
+        if new_state := await self.amaybe_compact(chat, state, history):
+            state, history = new_state, self.unsummarized(new_state, history)
+        return state and state["summary"], history
+
+    def needs_compaction(self, chat: "Chat", history: list[Message]) -> bool:
+        if len(history) <= self.keep_recent:
+            return False
+        if len(history) >= chat.history_limit:
+            # older messages are about to fall out of the window
+            return True
+        counter = chat.ai.token_counter
+        tokens = sum(counter.count_message(m, chat.get_prompt(m.role, m.content)) for m in history)
+        return tokens > self.threshold
+
+    def start(self, chat: "Chat", history: list[Message]) -> tuple[str, str] | None:
+        """The thread's key if it needs compaction and none is running, it's marked running then."""
+        if not self.needs_compaction(chat, history):
+            return None
+        key = (chat.ai.id, chat.thread_id)
+        with self.lock:
+            if key in self.running:
+                return None
+            self.running.add(key)
+        return key
+
+    def fold(self, history: list[Message]) -> list[Message]:
+        return history[:-self.keep_recent] if self.keep_recent else history
+
+    @staticmethod
+    def new_state(state: dict | None, summary: str, fold: list[Message]) -> dict:
+        return {
+            "summary": summary,
+            "through": fold[-1].id,
+            "count": (state["count"] if state else 0) + len(fold),
+        }
+
+    def maybe_compact(self, chat: "Chat", state: dict | None, history: list[Message]) -> dict | None:
+        """Start compaction if needed, returns the new state if it ran in the foreground."""
+        if not (key := self.start(chat, history)):
+            return None
+        if self.background:
+            (self.executor or default_executor()).submit(self.compact, chat, state, history, key)
+            return None
+        return self.compact(chat, state, history, key)
+
+    async def amaybe_compact(self, chat: "Chat", state: dict | None, history: list[Message]) -> dict | None:
+        if not (key := self.start(chat, history)):
+            return None
+        if self.background:
+            (self.executor or default_executor()).submit(self.compact, chat, state, history, key)
+            return None
+        return await self.acompact(chat, state, history, key)
+
+    def compact(self, chat: "Chat", state: dict | None, history: list[Message], key) -> dict | None:
+        try:
+            fold = self.fold(self.backlog(chat, state, history))
+            previous = state and state["summary"]
+            summary = self.summarize(chat, previous, fold) if self.summarize else chat.summarize(previous, fold)
+            new_state = self.new_state(state, summary, fold)
+            chat.store.set_state(chat, self.state_key(chat), new_state)
+            return new_state
+        except Exception:
+            log.exception("thread compaction failed")
+            return None
+        finally:
+            with self.lock:
+                self.running.discard(key)
+
+    async def acompact(self, chat: "Chat", state: dict | None, history: list[Message], key) -> dict | None:
+        try:
+            fold = self.fold(await self.abacklog(chat, state, history))
+            previous = state and state["summary"]
+            if self.summarize:
+                summary = await asyncio.to_thread(self.summarize, chat, previous, fold)
+            else:
+                summary = await chat.asummarize(previous, fold)
+            new_state = self.new_state(state, summary, fold)
+            await chat.store.aset_state(chat, self.state_key(chat), new_state)
+            return new_state
+        except Exception:
+            log.exception("thread compaction failed")
+            return None
+        finally:
+            with self.lock:
+                self.running.discard(key)
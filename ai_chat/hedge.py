@@ -0,0 +1,172 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Awaitable, Callable
+
+from ai_chat.stats import LatencyWindow
+
+def close_result(future: Future):
+    """Close a losing stream, if it got one."""
+    if not future.cancelled() and future.exception() is None:
+        if close := getattr(future.result(), "close", None):
+            close()
+
+
+async def aclose_result(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is None:
+        if aclose := getattr(task.result(), "aclose", None):
+            await aclose()
+
+
+class Hedger:
+    """Sends a duplicate request when the first is slow, set as AiConfig(hedger=...) for OpenaiChat.
+
+    If no reply (or first streamed chunk) arrived within the `percentile` latency of recent requests, clamped
+    to [min_delay, max_delay], the same request is sent again, with the `backup` model_params overrides if
+    given. The first good answer wins. The loser is cancelled in async code, in sync code its thread runs to
+    completion and the result is dropped. At most `max_rate` of requests are hedged.
+
+    A hedge is extra load on the provider: `admit`, if given, is called with the hedge's args before it is
+    sent, and the hedge is dropped if it raises (OpenaiChat passes ai.admission, without queueing).
+
+    Sync calls run on `executor`, or on a pool of `max_workers` threads of this hedger's own. That caps the
+    sync completions in flight through it, a hedged call takes two threads, so size it for the concurrency.
+    """
+
+    def __init__(self, percentile=95, min_delay=0.25, max_delay=10.0, max_rate=0.05, backup: dict | None = None,
+                 window=200, executor: Executor | None = None, max_workers=64):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_rate = max_rate
+        self.backup = backup or {}
+        self.executor = executor
+        self.max_workers = max_workers
+        self.stats = LatencyWindow(window)
+        self.requests = 0
+        self.hedged = 0
+        # hedges that answered first, and answers that arrived (or were in flight) but weren't used
+        self.hedge_wins = 0
+        self.wasted = 0
+        self.lock = threading.Lock()
+
+    def snapshot(self) -> dict:
+        return dict(requests=self.requests, hedged=self.hedged, hedge_wins=self.hedge_wins, wasted=self.wasted,
+                    delay=self.delay())
+
+    def pool(self) -> Executor:
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="hedge")
+            return self.executor
+
+    def delay(self) -> float:
+        latency = self.stats.percentile(self.percentile)
+        if latency is None:
+            return self.max_delay
+        return min(self.max_delay, max(self.min_delay, latency))
+
+    def start(self):
+        with self.lock:
+            self.requests += 1
+
+    def take_hedge(self) -> bool:
+        with self.lock:
+            if self.hedged + 1 > self.max_rate * self.requests:
+                return False
+            self.hedged += 1
+            return True
+
+    def finish(self, started: float, hedge_won: bool, loser_wasted: bool):
+        self.stats.add(time.monotonic() - started)
+        with self.lock:
+            self.hedge_wins += hedge_won
+            self.wasted += loser_wasted
+
+    def call(self, func: Callable[[dict], object], args: dict, admit: Callable[[dict], None] | None = None):
+        """Run func(args), hedged with func({**args, **backup}) if it is slow."""
+        self.start()
+        pool = self.pool()
+        # the delay runs from when the primary is sent, not from when it was queued on a busy pool
+        sent, started = threading.Event(), []
+
+        def send(args):
+            started.append(time.monotonic())
+            sent.set()
+            return func(args)
+
+        primary = pool.submit(send, args)
+        sent.wait()
+        started = started[0]
+        done, _ = wait([primary], timeout=max(0.0, started + self.delay() - time.monotonic()))
+        if done or not self.take_hedge():
+            result = primary.result()
+            self.stats.add(time.monotonic() - started)
+            return result
+
+        def hedge(args):
+            if admit:
+                admit(args)
+            return func(args)
+
+        futures = [primary, pool.submit(hedge, {**args, **self.backup})]
+        pending, error = set(futures), None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in [f for f in futures if f in done]:
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                loser = futures[future is primary]
+                self.finish(started, future is not primary, loser in pending or loser.exception() is None)
+                if not loser.cancel():
+                    loser.add_done_callback(close_result)
+                return future.result()
+        raise error
+
+    async def acall(self, func: Callable[[dict], Awaitable], args: dict,
+                    admit: Callable[[dict], Awaitable] | None = None):
+        self.start()
+        sent, started = asyncio.Event(), []
+
+        async def send(args):
+            started.append(time.monotonic())
+            sent.set()
+            return await func(args)
+
+        async def hedge(args):
+            if admit:
+                await admit(args)
+            return await func(args)
+
+        tasks = [asyncio.ensure_future(send(args))]
+        primary = tasks[0]
+        try:
+            await sent.wait()
+            started = started[0]
+            done, _ = await asyncio.wait({primary}, timeout=max(0.0, started + self.delay() - time.monotonic()))
+            if done or not self.take_hedge():
+                result = await primary
+                self.stats.add(time.monotonic() - started)
+                return result
+
+            tasks.append(asyncio.ensure_future(hedge({**args, **self.backup})))
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in [t for t in tasks if t in done]:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    loser = tasks[task is primary]
+                    self.finish(started, task is not primary, loser in pending or loser.exception() is None)
+                    if loser.done():
+                        await aclose_result(loser)
+                    return task.result()
+            raise error
+        finally:
+            # the caller was cancelled, or one answer won, nothing left should keep running and billing
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
@@ -0,0 +1,137 @@
+import contextlib
+import dataclasses
+import threading
+from collections import defaultdict
+from typing import TYPE_CHECKING, ContextManager
+
+if TYPE_CHECKING:
+    from ai_chat.chat import Chat
+
+
+@dataclasses.dataclass
+class TurnStats:
+    """Where one turn's time and tokens went, stage durations are in seconds."""
+    seconds: float = 0.0
+    stages: dict[str, float] = dataclasses.field(default_factory=dict)
+    hops: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    # the tool loop limit hit, if any
+    limit: str | None = None
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_usage(self, usage):
+        self.prompt_tokens += getattr(usage, "prompt_tokens", None) or 0
+        self.completion_tokens += getattr(usage, "completion_tokens", None) or 0
+
+
+class Instrument:
+    """Instrumentation hooks, set as AiConfig(instruments=[...]). Override what you need.
+
+    Stages are "history", "compact", "prompt", "complete", "functions" and "save", wrapped in a "turn".
+    """
+
+    def span(self, name: str, chat: "Chat") -> ContextManager:
+        """Context around each stage, for tracing."""
+        return contextlib.nullcontext()
+
+    def on_stage(self, chat: "Chat", name: str, seconds: float):
+        pass
+
+    def on_turn(self, chat: "Chat", stats: TurnStats):
+        pass
+
+
+class TracerInstrument(Instrument):
+    """Spans on an OpenTelemetry tracer, or anything with start_as_current_span."""
+
+    def __init__(self, tracer):
+        self.tracer = tracer
+
+    def span(self, name: str, chat: "Chat") -> ContextManager:
+        return self.tracer.start_as_current_span(f"ai_chat.{name}", attributes={"ai_id": chat.ai.id})
+
+
+def label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class PrometheusExporter(Instrument):
+    """Aggregates turn stats in memory and renders them in the Prometheus text format."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, prefix="ai_chat", buckets=BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        # (ai_id, stage) -> bucket counts, then sum and count
+        self.histograms: dict[tuple[str, str], list[float]] = {}
+        self.counters: dict[tuple[str, tuple], float] = defaultdict(float)
+        self.lock = threading.Lock()
+
+    def observe(self, ai_id: str, stage: str, seconds: float):
+        with self.lock:
+            hist = self.histograms.setdefault((ai_id, stage), [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    hist[i] += 1
+            hist[-2] += seconds
+            hist[-1] += 1
+
+    def on_stage(self, chat: "Chat", name: str, seconds: float):
+        self.observe(chat.ai.id, name, seconds)
+
+    def on_turn(self, chat: "Chat", stats: TurnStats):
+        self.observe(chat.ai.id, "turn", stats.seconds)
+        ai = ("ai_id", chat.ai.id)
+        with self.lock:
+            self.counters[("turns_total", (ai,))] += 1
+            self.counters[("function_hops_total", (ai,))] += stats.hops
+            self.counters[("tokens_total", (ai, ("kind", "prompt")))] += stats.prompt_tokens
+            self.counters[("tokens_total", (ai, ("kind", "completion")))] += stats.completion_tokens
+
+    def render(self) -> str:
+        name = f"{self.prefix}_stage_seconds"
+        lines = [f"# TYPE {name} histogram"]
+        with self.lock:
+            for (ai_id, stage), hist in sorted(self.histograms.items()):
+                labels = f'ai_id="{label(ai_id)}",stage="{label(stage)}"'
+                for bound, count in zip(self.buckets, hist):
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {hist[-1]}')
+                lines.append(f"{name}_sum{{{labels}}} {hist[-2]}")
+                lines.append(f"{name}_count{{{labels}}} {hist[-1]}")
+
+            typed = set()
+            for (metric, labels), value in sorted(self.counters.items()):
+                metric = f"{self.prefix}_{metric}"
+                if metric not in typed:
+                    typed.add(metric)
+                    lines.append(f"# TYPE {metric} counter")
+                labels = ",".join(f'{k}="{label(v)}"' for k, v in labels)
+                lines.append(f"{metric}{{{labels}}} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, addr=""):
+        """Serve /metrics from a daemon thread, returns the server."""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = exporter.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((addr, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True, name="metrics").start()
+        return server
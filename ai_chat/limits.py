@@ -0,0 +1,257 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+
+
+class Overloaded(Exception):
+    """Raised by AdmissionController when a request can't be admitted before its queue deadline."""
+
+
+class TokenBucket:
+    """Refills at `rate` per second up to `capacity`. Takes may overdraw, later takers wait out the debt."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount: float) -> float:
+        """Reserve `amount`, returns the seconds to wait before using it."""
+        with self.lock:
+            self.refill()
+            self.tokens -= min(amount, self.capacity)
+            return max(0.0, -self.tokens / self.rate)
+
+    def wait(self, amount: float) -> float:
+        """Seconds until `amount` is available, without taking it."""
+        with self.lock:
+            self.refill()
+            return max(0.0, (min(amount, self.capacity) - self.tokens) / self.rate)
+
+    def resize(self, capacity: float):
+        """New capacity, the refill rate scales with it."""
+        with self.lock:
+            self.refill()
+            self.rate *= capacity / self.capacity
+            self.capacity = capacity
+            self.tokens = min(self.tokens, capacity)
+
+    def clamp(self, tokens: float):
+        """The provider says only `tokens` are left."""
+        with self.lock:
+            self.refill()
+            self.tokens = min(self.tokens, tokens)
+
+
+class RateLimiter:
+    """Requests per minute and tokens per minute for one provider, shared by every chat calling it.
+
+    Reservations are first come, first served: each caller is told how long to wait for its share.
+    """
+
+    def __init__(self, rpm: float | None = None, tpm: float | None = None):
+        self.requests = TokenBucket(rpm / 60, rpm) if rpm else None
+        self.tokens = TokenBucket(tpm / 60, tpm) if tpm else None
+        # set by a retry-after, nothing goes out before it
+        self.paused_until = 0.0
+
+    def reserve(self, tokens=0) -> float:
+        wait = self.requests.take(1) if self.requests else 0.0
+        if self.tokens and tokens:
+            wait = max(wait, self.tokens.take(tokens))
+        return max(wait, self.paused_until - time.monotonic())
+
+    def wait(self, tokens=0) -> float:
+        """Seconds until a request of `tokens` fits, without reserving it."""
+        wait = self.requests.wait(1) if self.requests else 0.0
+        if self.tokens and tokens:
+            wait = max(wait, self.tokens.wait(tokens))
+        return max(wait, self.paused_until - time.monotonic())
+
+    def acquire(self, tokens=0):
+        if wait := self.reserve(tokens):
+            time.sleep(wait)
+
+    async def aacquire(self, tokens=0):
+        if wait := self.reserve(tokens):
+            await asyncio.sleep(wait)
+
+    def limit(self, rpm: float | None = None, tpm: float | None = None):
+        """Change the limits, as reported by the provider."""
+        if rpm:
+            if self.requests:
+                self.requests.resize(rpm)
+            else:
+                self.requests = TokenBucket(rpm / 60, rpm)
+        if tpm:
+            if self.tokens:
+                self.tokens.resize(tpm)
+            else:
+                self.tokens = TokenBucket(tpm / 60, tpm)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def number(value) -> float | None:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def response_headers(source) -> dict:
+    """Provider response headers of a litellm response or exception, lowercased, {} if there are none."""
+    headers = (getattr(source, "_hidden_params", None) or {}).get("additional_headers") \
+        or getattr(source, "_response_headers", None) \
+        or getattr(source, "litellm_response_headers", None) \
+        or getattr(source, "headers", None) \
+        or getattr(getattr(source, "response", None), "headers", None) \
+        or {}
+    try:
+        return {k.lower().removeprefix("llm_provider-"): v for k, v in dict(headers).items()}
+    except (TypeError, ValueError, AttributeError):
+        return {}
+
+
+class AdmissionController:
+    """Admits completion requests under per-model requests/min and tokens/min limits, set as AiConfig(admission=...).
+
+    Callers queue per model, by priority (higher first) then arrival, and only the head of a queue is admitted,
+    so a large request isn't starved by a stream of small ones. A request that can't be admitted within
+    `max_wait` seconds raises Overloaded instead of adding to the pile. `models` overrides rpm/tpm per model,
+    and the limits follow the provider's x-ratelimit-* and retry-after headers when responses carry them.
+    """
+
+    def __init__(self, rpm: float | None = None, tpm: float | None = None, *, models: dict[str, dict] = None,
+                 max_wait=30.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.models = models or {}
+        self.max_wait = max_wait
+        self.limiters: dict[str, RateLimiter] = {}
+        # model -> heap of [-priority, seq, event, loop] tickets, loop is set for asyncio events
+        self.queues: dict[str, list[list]] = {}
+        self.seq = itertools.count()
+        self.admitted = 0
+        self.shed = 0
+        self.lock = threading.Lock()
+
+    def limiter(self, model: str) -> RateLimiter:
+        with self.lock:
+            if model not in self.limiters:
+                limits = self.models.get(model, {})
+                self.limiters[model] = RateLimiter(limits.get("rpm", self.rpm), limits.get("tpm", self.tpm))
+            return self.limiters[model]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(admitted=self.admitted, shed=self.shed,
+                        queued={model: len(queue) for model, queue in self.queues.items() if queue})
+
+    def enqueue(self, model: str, priority: int, event, loop=None) -> list:
+        ticket = [-priority, next(self.seq), event, loop]
+        with self.lock:
+            heapq.heappush(self.queues.setdefault(model, []), ticket)
+        return ticket
+
+    def wake(self, model: str):
+        """Wake the head of the model's queue, call with the lock held."""
+        if queue := self.queues.get(model):
+            _, _, event, loop = queue[0]
+            if loop:
+                loop.call_soon_threadsafe(event.set)
+            else:
+                event.set()
+
+    def try_admit(self, model: str, ticket: list, tokens: int) -> float | None:
+        """0 if admitted, else the seconds the head must wait, or None if the ticket isn't the head."""
+        limiter = self.limiter(model)
+        with self.lock:
+            queue = self.queues[model]
+            ticket[2].clear()
+            if queue[0] is not ticket:
+                return None
+            if wait := limiter.wait(tokens):
+                return wait
+            limiter.reserve(tokens)
+            heapq.heappop(queue)
+            self.admitted += 1
+            self.wake(model)
+            return 0.0
+
+    def leave(self, model: str, ticket: list):
+        """Drop a ticket that gave up, waking whoever is next."""
+        with self.lock:
+            queue = self.queues[model]
+            head = queue[0] is ticket
+            queue.remove(ticket)
+            heapq.heapify(queue)
+            self.shed += 1
+            if head:
+                self.wake(model)
+
+    def overloaded(self, model: str, max_wait: float) -> Overloaded:
+        return Overloaded(f"no capacity for {model} within {max_wait}s, "
+                          f"{len(self.queues.get(model, ()))} requests queued")
+
+    def acquire(self, model: str, tokens=0, priority=0, max_wait: float | None = None):
+        """Block until the request may be sent, or raise Overloaded."""
+        max_wait = self.max_wait if max_wait is None else max_wait
+        deadline = time.monotonic() + max_wait
+        ticket = self.enqueue(model, priority, threading.Event())
+        try:
+            while (wait := self.try_admit(model, ticket, tokens)) != 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or (wait is not None and wait > remaining):
+                    raise self.overloaded(model, max_wait)
+                ticket[2].wait(min(wait or remaining, remaining))
+        except BaseException:
+            # shed, or interrupted while queued
+            self.leave(model, ticket)
+            raise
+
+    async def aacquire(self, model: str, tokens=0, priority=0, max_wait: float | None = None):
+        max_wait = self.max_wait if max_wait is None else max_wait
+        deadline = time.monotonic() + max_wait
+        ticket = self.enqueue(model, priority, asyncio.Event(), asyncio.get_running_loop())
+        try:
+            while (wait := self.try_admit(model, ticket, tokens)) != 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or (wait is not None and wait > remaining):
+                    raise self.overloaded(model, max_wait)
+                try:
+                    await asyncio.wait_for(ticket[2].wait(), min(wait or remaining, remaining))
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            # shed, or the caller was cancelled while queued
+            self.leave(model, ticket)
+            raise
+
+    def update(self, model: str, headers: dict):
+        """Follow the provider's rate limit headers, as returned by response_headers."""
+        if not headers:
+            return
+        limiter = self.limiter(model)
+        limiter.limit(number(headers.get("x-ratelimit-limit-requests")),
+                      number(headers.get("x-ratelimit-limit-tokens")))
+        for bucket, kind in ((limiter.requests, "requests"), (limiter.tokens, "tokens")):
+            if bucket and (remaining := number(headers.get(f"x-ratelimit-remaining-{kind}"))) is not None:
+                bucket.clamp(remaining)
+        retry_after = number(headers.get("retry-after"))
+        if retry_after is None and (ms := number(headers.get("retry-after-ms"))) is not None:
+            retry_after = ms / 1000
+        if retry_after:
+            limiter.pause(retry_after)
+        with self.lock:
+            self.wake(model)
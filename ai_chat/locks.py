@@ -0,0 +1,292 @@
+import asyncio
+import collections
+import contextlib
+import copy
+import threading
+import time
+from typing import TYPE_CHECKING, Awaitable, Callable
+
+if TYPE_CHECKING:
+    from ai_chat.chat import Chat
+    from ai_chat.types import ChatResponse
+
+
+class Waiter:
+    """One caller queued on an Entry, woken when the lock is handed to it or its slot is answered."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop | None = None):
+        # set for async waiters, the event is then an asyncio.Event of that loop
+        self.loop = loop
+        self.event = asyncio.Event() if loop else threading.Event()
+        self.granted = False
+
+    def wake(self):
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.event.set)
+        else:
+            self.event.set()
+
+
+class Slot:
+    """A user message waiting for its turn, answered by whichever turn takes it."""
+
+    def __init__(self, content: str):
+        self.content = content
+        self.done = False
+        self.response: "ChatResponse | None" = None
+        self.error: Exception | None = None
+        self.waiter: Waiter | None = None
+
+    def result(self) -> "ChatResponse":
+        if self.error:
+            raise self.error
+        # each caller gets its own copy, to set its own stats on
+        return copy.copy(self.response)
+
+
+class Entry:
+    def __init__(self):
+        # the lock is handed from holder to the next waiter, first come first served
+        self.held = False
+        self.queue: collections.deque[Waiter] = collections.deque()
+        # holders and waiters, the entry is dropped when this is back to 0
+        self.users = 0
+        self.waiting: list[Slot] = []
+
+
+class ThreadLocks:
+    """In-process lock map, (ai_id, thread_id) -> lock, entries only live while someone holds or waits on them.
+
+    Sync and async callers share one queue per entry: threads block on an Event, coroutines await one on their
+    own loop, so waiting never ties up executor threads.
+    """
+
+    def __init__(self):
+        self.entries: dict[tuple[str, str], Entry] = {}
+        self.lock = threading.Lock()
+
+    def enter(self, key, slot: Slot | None = None) -> Entry:
+        with self.lock:
+            entry = self.entries.get(key) or self.entries.setdefault(key, Entry())
+            entry.users += 1
+            if slot:
+                entry.waiting.append(slot)
+            return entry
+
+    def exit(self, key, entry: Entry, slot: Slot | None = None):
+        with self.lock:
+            if slot and slot in entry.waiting:
+                entry.waiting.remove(slot)
+            entry.users -= 1
+            if not entry.users:
+                del self.entries[key]
+
+    def take(self, entry: Entry) -> list[Slot]:
+        with self.lock:
+            slots, entry.waiting = entry.waiting, []
+            return slots
+
+    def request(self, entry: Entry, waiter: Waiter) -> bool:
+        """Take the lock if it's free, else queue the waiter."""
+        with self.lock:
+            if not entry.held:
+                entry.held = True
+                return True
+            entry.queue.append(waiter)
+            return False
+
+    def cancel(self, entry: Entry, waiter: Waiter) -> bool:
+        """Stop waiting, True if the lock was handed over meanwhile, the caller holds it then."""
+        with self.lock:
+            if waiter.granted:
+                return True
+            entry.queue.remove(waiter)
+            return False
+
+    def release(self, entry: Entry):
+        with self.lock:
+            if entry.queue:
+                waiter = entry.queue.popleft()
+                waiter.granted = True
+                waiter.wake()
+            else:
+                entry.held = False
+
+    def acquire(self, entry: Entry, slot: Slot | None = None, timeout: float | None = None) -> bool:
+        """Wait for the entry's lock, False on timeout or once another turn has answered `slot`."""
+        waiter = Waiter()
+        if slot:
+            slot.waiter = waiter
+        if self.request(entry, waiter):
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            while not waiter.granted and not (slot and slot.done):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                waiter.event.wait(remaining)
+                waiter.event.clear()
+        except BaseException:
+            if self.cancel(entry, waiter):
+                self.release(entry)
+            raise
+        return self.cancel(entry, waiter)
+
+    async def aacquire(self, entry: Entry, slot: Slot | None = None, timeout: float | None = None) -> bool:
+        waiter = Waiter(asyncio.get_running_loop())
+        if slot:
+            slot.waiter = waiter
+        if self.request(entry, waiter):
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            while not waiter.granted and not (slot and slot.done):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(waiter.event.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+                waiter.event.clear()
+        except BaseException:
+            # cancelled while queued
+            if self.cancel(entry, waiter):
+                self.release(entry)
+            raise
+        return self.cancel(entry, waiter)
+
+
+class TurnLock:
+    """Serializes turns on the same thread, set as AiConfig(turn_lock=TurnLock()).
+
+    A turn waits on an in-process lock per (ai, thread), then on the store's lock_thread (store_lock=True), so
+    processes sharing a database don't interleave a thread's history either. Waiting longer than `timeout`
+    raises TimeoutError.
+
+    With coalesce=True, user messages that arrive while a turn is running are merged (joined by `separator`) into
+    one message, answered by one completion, and every caller gets that response. Streams are never coalesced.
+    """
+
+    def __init__(self, *, store_lock=True, coalesce=False, timeout: float | None = 60.0, separator="\n\n"):
+        self.store_lock = store_lock
+        self.coalesce = coalesce
+        self.timeout = timeout
+        self.separator = separator
+        self.locks = ThreadLocks()
+        self.coalesced = 0
+
+    def stats(self) -> dict:
+        return dict(threads=len(self.locks.entries), coalesced=self.coalesced)
+
+    def busy(self, chat: "Chat") -> TimeoutError:
+        return TimeoutError(f"thread {chat.thread_id} is busy, gave up after {self.timeout}s")
+
+    def remaining(self, deadline: float | None) -> float | None:
+        return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+    @contextlib.contextmanager
+    def hold(self, chat: "Chat", slot: Slot | None = None):
+        key = (chat.ai.id, chat.thread_id)
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        entry = self.locks.enter(key, slot)
+        try:
+            if not self.locks.acquire(entry, slot, self.remaining(deadline)):
+                if slot and slot.done:
+                    # answered by another turn while queued
+                    yield entry
+                    return
+                raise self.busy(chat)
+            try:
+                # once held, no other turn in this process can answer the slot, so the store lock is just waited on
+                if self.store_lock and chat.store:
+                    with chat.store.lock_thread(chat, self.remaining(deadline)):
+                        yield entry
+                else:
+                    yield entry
+            finally:
+                self.locks.release(entry)
+        finally:
+            self.locks.exit(key, entry, slot)
+
+    @contextlib.asynccontextmanager
+    async def ahold(self, chat: "Chat", slot: Slot | None = None):
+        key = (chat.ai.id, chat.thread_id)
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        entry = self.locks.enter(key, slot)
+        try:
+            if not await self.locks.aacquire(entry, slot, self.remaining(deadline)):
+                if slot and slot.done:
+                    yield entry
+                    return
+                raise self.busy(chat)
+            try:
+                if self.store_lock and chat.store:
+                    async with chat.store.alock_thread(chat, self.remaining(deadline)):
+                        yield entry
+                else:
+                    yield entry
+            finally:
+                self.locks.release(entry)
+        finally:
+            self.locks.exit(key, entry, slot)
+
+    def merge(self, slots: list[Slot]) -> str:
+        self.coalesced += len(slots) - 1
+        return self.separator.join(slot.content for slot in slots)
+
+    @staticmethod
+    def answer(slots: list[Slot], response=None, error: Exception | None = None):
+        for slot in slots:
+            slot.response, slot.error, slot.done = response, error, True
+            if slot.waiter:
+                slot.waiter.wake()
+
+    def fail(self, slots: list[Slot], error: BaseException):
+        """Answer the slots of a turn that raised, a cancelled or interrupted turn is an error to the others."""
+        if not isinstance(error, Exception):
+            interrupted = RuntimeError(f"the turn answering this message was interrupted: {error!r}")
+            interrupted.__cause__ = error
+            error = interrupted
+        self.answer(slots, error=error)
+
+    def run(self, chat: "Chat", content: str, turn: Callable[[str], "ChatResponse"]) -> "ChatResponse":
+        """Run turn(content) holding the thread's lock, coalesced with waiting messages if enabled."""
+        if not self.coalesce:
+            with self.hold(chat):
+                return turn(content)
+        slot = Slot(content)
+        with self.hold(chat, slot) as entry:
+            if slot.done:
+                return slot.result()
+            if not (slots := self.locks.take(entry)):
+                # never run a turn without a message, the slot was taken by an earlier turn
+                return slot.result()
+            try:
+                response = turn(self.merge(slots))
+            except BaseException as e:
+                self.fail(slots, e)
+                raise
+            self.answer(slots, response)
+            return response
+
+    async def arun(self, chat: "Chat", content: str,
+                   turn: Callable[[str], Awaitable["ChatResponse"]]) -> "ChatResponse":
+        if not self.coalesce:
+            async with self.ahold(chat):
+                return await turn(content)
+        slot = Slot(content)
+        async with self.ahold(chat, slot) as entry:
+            if slot.done:
+                return slot.result()
+            if not (slots := self.locks.take(entry)):
+                # never run a turn without a message, the slot was taken by an earlier turn
+                return slot.result()
+            try:
+                response = await turn(self.merge(slots))
+            except BaseException as e:
+                self.fail(slots, e)
+                raise
+            self.answer(slots, response)
+            return response
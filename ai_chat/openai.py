@@ -1,13 +1,56 @@
 import logging as log
 import os
-from litellm import completion
+from litellm import completion, acompletion
 
 from ai_chat.chat import Chat
+from ai_chat.limits import response_headers
+from ai_chat.prompt import summary_prompt
 from ai_chat.types import AIFunctions
 from ai_chat import Function
 
+class StreamAccumulator:
+    """Collects streamed deltas, including function_call name/argument fragments."""
+
+    def __init__(self):
+        self.content = []
+        self.name = ""
+        self.arguments = []
+        # index -> [id, name, arguments]
+        self.tool_calls: dict[int, list] = {}
+        # only sent by some providers, on the last chunk
+        self.usage = None
+
+    def add(self, chunk) -> str | None:
+        """Add a chunk, returns its content delta if any"""
+        if usage := getattr(chunk, "usage", None):
+            self.usage = usage
+        delta = chunk["choices"][0]["delta"]
+        if call := getattr(delta, "function_call", None):
+            self.name += getattr(call, "name", None) or ""
+            self.arguments.append(getattr(call, "arguments", None) or "")
+        for call in getattr(delta, "tool_calls", None) or []:
+            ent = self.tool_calls.setdefault(call.index, ["", "", ""])
+            ent[0] += call.id or ""
+            ent[1] += call.function.name or ""
+            ent[2] += call.function.arguments or ""
+        if text := getattr(delta, "content", None):
+            self.content.append(text)
+        return text
+
+    def result(self) -> tuple[str, str, Function | list[Function] | None]:
+        content = "".join(self.content) or None
+        if self.tool_calls:
+            return "function_call", content, [Function(name=name, arguments=arguments, id=id)
+                                              for id, name, arguments in self.tool_calls.values()]
+        if self.name:
+            return "function_call", content, Function(name=self.name, arguments="".join(self.arguments))
+        return "assistant", content, None
+
+
 class OpenaiChat(Chat):
-    def chat_complete(self, prompt, functions: AIFunctions) -> tuple[str, str, Function | None]:
+    supports_tool_choice = True
+
+    def completion_args(self, prompt, functions: AIFunctions, tool_choice: str | None = None) -> dict:
         # openai.api_key = os.getenv("OPENAI_API_KEY") # litellm also checks for OPENAI_API_KEY in the os environment variables. 
 
         args = dict(
@@ -16,24 +59,157 @@ class OpenaiChat(Chat):
             n=1,
         )
 
-        if functions:
-            args['functions'] = functions.openai_dict()
+        schema = self.function_schema(functions)
+        if functions and self.ai.parallel_tools:
+            args['tools'] = schema.tools if schema else [{"type": "function", "function": f} for f in functions]
+        elif functions:
+            args['functions'] = schema.functions if schema else functions
+        if functions and tool_choice:
+            args['tool_choice' if 'tools' in args else 'function_call'] = tool_choice
 
-        log.debug(args)
+        if self.ai.admission:
+            # retries inside litellm would go around the admission queue, failures surface instead
+            args.setdefault("max_retries", 0)
 
-        result = completion(**args)
+        log.debug(args)
+        return args
 
+    def parse_completion(self, result) -> tuple[str, str, Function | list[Function] | None]:
         # log.debug("prompt: %s", prompt)
         log.debug("chat complete: %s", result)
+        self.add_usage(getattr(result, "usage", None))
 
         role = "assistant"
         message = result["choices"][0]["message"]
         content = message["content"]
 
         func = None
-        if getattr(message, "function_call", None):
+        if tool_calls := getattr(message, "tool_calls", None):
+            role = "function_call"
+            func = [Function(name=call.function.name, arguments=call.function.arguments, id=call.id)
+                    for call in tool_calls]
+        elif getattr(message, "function_call", None):
             function = message.function_call
             role = "function_call"
             func = Function(name=function.pop('name'), arguments=function.pop('arguments'), **function)
 
         return role, content, func
+
+    def create(self, args: dict):
+        """The completion call itself, litellm's."""
+        return completion(**args)
+
+    async def acreate(self, args: dict):
+        return await acompletion(**args)
+
+    def send(self, args: dict):
+        """One completion request, a stream is returned once its first chunk arrived."""
+        if not args.get("stream"):
+            return self.create(args)
+        chunks = iter(self.create(args))
+        first = next(chunks)
+
+        def resume():
+            yield first
+            yield from chunks
+
+        return resume()
+
+    async def asend(self, args: dict):
+        if not args.get("stream"):
+            return await self.acreate(args)
+        chunks = aiter(await self.acreate(args))
+        first = await anext(chunks)
+
+        async def resume():
+            yield first
+            async for chunk in chunks:
+                yield chunk
+
+        return resume()
+
+    def update_limits(self, args: dict, source):
+        """Pass the provider's rate limit headers, of a response or an error, on to ai.admission."""
+        if self.ai.admission:
+            self.ai.admission.update(args.get("model"), response_headers(source))
+
+    def admit_hedge(self, args: dict):
+        """A hedge counts against ai.admission too, it's only sent if there's capacity right away."""
+        if self.ai.admission:
+            self.ai.admission.acquire(args.get("model"), self.request_tokens(args["messages"]), self.ai.priority,
+                                      max_wait=0)
+
+    async def aadmit_hedge(self, args: dict):
+        if self.ai.admission:
+            await self.ai.admission.aacquire(args.get("model"), self.request_tokens(args["messages"]),
+                                             self.ai.priority, max_wait=0)
+
+    def request(self, args: dict):
+        """Send a completion request, hedged if ai.hedger is set."""
+        try:
+            if self.ai.hedger:
+                result = self.ai.hedger.call(self.send, args, self.admit_hedge)
+            else:
+                result = self.create(args)
+        except Exception as e:
+            self.update_limits(args, e)
+            raise
+        self.update_limits(args, result)
+        return result
+
+    async def arequest(self, args: dict):
+        try:
+            if self.ai.hedger:
+                result = await self.ai.hedger.acall(self.asend, args, self.aadmit_hedge)
+            else:
+                result = await self.acreate(args)
+        except Exception as e:
+            self.update_limits(args, e)
+            raise
+        self.update_limits(args, result)
+        return result
+
+    def summary_args(self, summary, messages) -> dict:
+        args = dict(messages=summary_prompt(summary, messages), **{**self.ai.model_params, **self.ai.summary_model_params})
+        if self.ai.admission:
+            args.setdefault("max_retries", 0)
+        return args
+
+    def summarize(self, summary, messages) -> str:
+        """Through admission, the hedger and the summarize stage, like any other completion."""
+        args = self.summary_args(summary, messages)
+        self.admit(args["messages"], args.get("model"))
+        with self.stage("summarize"):
+            result = self.request(args)
+        return result["choices"][0]["message"]["content"]
+
+    async def asummarize(self, summary, messages) -> str:
+        args = self.summary_args(summary, messages)
+        await self.aadmit(args["messages"], args.get("model"))
+        with self.stage("summarize"):
+            result = await self.arequest(args)
+        return result["choices"][0]["message"]["content"]
+
+    def chat_complete(self, prompt, functions: AIFunctions, tool_choice=None) -> tuple[str, str, Function | None]:
+        result = self.request(self.completion_args(prompt, functions, tool_choice))
+        return self.parse_completion(result)
+
+    async def achat_complete(self, prompt, functions: AIFunctions, tool_choice=None) -> tuple[str, str, Function | None]:
+        result = await self.arequest(self.completion_args(prompt, functions, tool_choice))
+        return self.parse_completion(result)
+
+    def chat_complete_stream(self, prompt, functions: AIFunctions, tool_choice=None):
+        acc = StreamAccumulator()
+        for chunk in self.request(dict(self.completion_args(prompt, functions, tool_choice), stream=True)):
+            if text := acc.add(chunk):
+                yield text
+        self.add_usage(acc.usage)
+        yield acc.result()
+
+    async def achat_complete_stream(self, prompt, functions: AIFunctions, tool_choice=None):
+        acc = StreamAccumulator()
+        async for chunk in await self.arequest(dict(self.completion_args(prompt, functions, tool_choice), stream=True)):
+            if text := acc.add(chunk):
+                yield text
+        self.add_usage(acc.usage)
+        yield acc.result()
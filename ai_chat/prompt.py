@@ -0,0 +1,190 @@
+import json
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    from ai_chat.chat import Chat
+    from ai_chat.types import Message
+
+Tokenizer = Callable[[str], int]
+
+# rough per-message overhead for role/separators in chat formats
+MESSAGE_OVERHEAD = 4
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+SUMMARIZE_SYSTEM = ("Summarize the conversation for your own future reference. Keep names, facts, decisions, "
+                    "open questions and user preferences. Fold the new messages into the current summary, if any. "
+                    "Reply with the summary only.")
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate, about 4 chars per token for english text."""
+    if not text:
+        return 0
+    return len(text) // 4 + 1
+
+
+def tiktoken_tokenizer(model: str) -> Tokenizer:
+    """Exact counts for openai models, requires tiktoken."""
+    import tiktoken
+
+    try:
+        enc = tiktoken.encoding_for_model(model)
+    except KeyError:
+        enc = tiktoken.get_encoding("cl100k_base")
+    return lambda text: len(enc.encode(text))
+
+
+class TokenCounter:
+    """Counts prompt tokens, caching stored messages by id."""
+
+    def __init__(self, tokenizer: Tokenizer | None = None, max_cache=10000):
+        self.tokenizer = tokenizer or estimate_tokens
+        self.max_cache = max_cache
+        self.cache: OrderedDict[str, int] = OrderedDict()
+
+    def count(self, text: str | None) -> int:
+        return self.tokenizer(text) if text else 0
+
+    def count_prompt(self, info: dict) -> int:
+        """Count a single prompt entry, as made by Chat.get_prompt."""
+        total = MESSAGE_OVERHEAD + self.count(info.get("content")) + self.count(info.get("name"))
+        if call := info.get("function_call"):
+            total += self.count(call if isinstance(call, str) else json.dumps(call))
+        if calls := info.get("tool_calls"):
+            total += self.count(json.dumps(calls))
+        return total
+
+    def count_message(self, msg: "Message", info: dict) -> int:
+        """Count a stored message, info is its prompt entry."""
+        if (cnt := self.cache.get(msg.id)) is not None:
+            self.cache.move_to_end(msg.id)
+            return cnt
+        cnt = self.count_prompt(info)
+        self.cache[msg.id] = cnt
+        if len(self.cache) > self.max_cache:
+            self.cache.popitem(last=False)
+        return cnt
+
+
+class PromptBuilder:
+    """Packs system, seed chat and the newest history into the token budget.
+
+    One builder lives on each Chat, and keeps the last prompt it assembled. If the head (system prompt, summary
+    or seed chat) is unchanged and the last turn's window is still the start of this turn's, only the new
+    messages are appended, so the prompt keeps a stable prefix for providers that cache them. Once the window
+    slides, the part of the last window that is kept is reused after the head, and the new messages appended.
+    Prompt entries of stored messages are cached by id, so each is made by get_prompt once per session.
+    """
+
+    def __init__(self, counter: TokenCounter | None = None, max_cache=1000):
+        self.counter = counter or TokenCounter()
+        self.max_cache = max_cache
+        self.infos: OrderedDict[str, dict] = OrderedDict()
+        self.head_key = None
+        self.head: list[dict] = []
+        self.ids: list[str] = []
+        # the last prompt, and the head it was built on
+        self.prompt: list[dict] = []
+        self.prompt_head: list[dict] = []
+        self.builds = 0
+        self.rebuilds = 0
+        # entries shared with the previous turn's prompt, and seconds spent assembling this one
+        self.prefix = 0
+        self.assembly_time = 0.0
+
+    def stats(self) -> dict:
+        return dict(builds=self.builds, rebuilds=self.rebuilds, prefix=self.prefix, assembly_time=self.assembly_time)
+
+    def info(self, chat: "Chat", msg: "Message") -> dict:
+        if (info := self.infos.get(msg.id)) is not None:
+            self.infos.move_to_end(msg.id)
+            return info
+        info = chat.get_prompt(msg.role, msg.content)
+        self.infos[msg.id] = info
+        if len(self.infos) > self.max_cache:
+            self.infos.popitem(last=False)
+        return info
+
+    def build_head(self, chat: "Chat", history: list["Message"], summary: str | None) -> list[dict]:
+        system = chat.get_system()
+        seeded = bool(not summary and not history and chat.ai.seed_chat)
+        key = (system, summary, seeded)
+        if key == self.head_key:
+            return self.head
+
+        head = [
+            {
+                "role": "system",
+                "content": system
+            }
+        ]
+
+        if summary:
+            head.append({"role": "system", "content": SUMMARY_PREFIX + summary})
+        elif seeded:
+            for user, assistant in chat.ai.seed_chat:
+                head.append({"role": "user", "content": user})
+                head.append({"role": "assistant", "content": assistant})
+
+        self.head_key, self.head = key, head
+        return head
+
+    def window(self, chat: "Chat", content: str, head: list[dict], history: list["Message"]) -> list["Message"]:
+        budget = chat.ai.max_prompt
+        if not budget:
+            return history
+
+        # the new content is always sent, so reserve room for it
+        used = sum(self.counter.count_prompt(info) for info in head)
+        used += self.counter.count_prompt({"content": content})
+
+        start = len(history)
+        for msg in reversed(history):
+            used += self.counter.count_message(msg, self.info(chat, msg))
+            if used > budget:
+                break
+            start -= 1
+        return history[start:]
+
+    def retained(self, ids: list[str]) -> int | None:
+        """How many of the last window's messages slid out, if the rest start this window, else None."""
+        if not self.ids:
+            return 0
+        if not ids or ids[0] not in self.ids:
+            return None
+        start = self.ids.index(ids[0])
+        kept = len(self.ids) - start
+        return start if ids[:kept] == self.ids[start:] else None
+
+    def build(self, chat: "Chat", content: str, history: list["Message"], summary: str | None = None) -> list[dict]:
+        started = time.perf_counter()
+        head = self.build_head(chat, history, summary)
+        kept = self.window(chat, content, head, history)
+        ids = [msg.id for msg in kept]
+
+        self.builds += 1
+        if (start := self.retained(ids)) is not None and self.prompt and self.prompt_head == head:
+            # the prompt after the head is the retained suffix of the last window, then the new messages
+            self.prefix = len(self.prompt) if start == 0 else len(head)
+            self.prompt[len(head):len(head) + start] = []
+            self.prompt.extend(self.info(chat, msg) for msg in kept[len(self.ids) - start:])
+        else:
+            self.rebuilds += 1
+            self.prefix = 0
+            self.prompt = head + [self.info(chat, msg) for msg in kept]
+        self.ids, self.prompt_head = ids, head
+        self.assembly_time = time.perf_counter() - started
+        # the caller appends the turn's messages to its copy
+        return list(self.prompt)
+
+
+def summary_prompt(summary: str | None, messages: list["Message"]) -> list[dict]:
+    transcript = "\n".join(f"{m.role}: {m.content}" for m in messages)
+    current = f"Current summary:\n{summary}\n\n" if summary else ""
+    return [
+        {"role": "system", "content": SUMMARIZE_SYSTEM},
+        {"role": "user", "content": f"{current}New messages:\n{transcript}"},
+    ]
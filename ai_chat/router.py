@@ -0,0 +1,210 @@
+import asyncio
+import itertools
+import logging as log
+import random
+import time
+from typing import Awaitable, Callable
+
+import litellm
+from litellm import completion, acompletion
+
+from ai_chat.limits import Overloaded
+from ai_chat.openai import OpenaiChat, StreamAccumulator
+from ai_chat.stats import LatencyWindow
+from ai_chat.types import AIFunctions, Function
+
+# timeouts, rate limits and overload, worth trying on another model
+RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+def retryable(e: Exception) -> bool:
+    if isinstance(e, (TimeoutError, ConnectionError, litellm.Timeout, litellm.APIConnectionError)):
+        return True
+    return getattr(e, "status_code", None) in RETRY_STATUS
+
+
+class ModelRouter:
+    """Routes completions over several models, shared by every RouterChat using it.
+
+    `models` are model_params overrides (at least a "model"), optionally with a "name" and a "weight".
+    With strategy="order" the first healthy model in the list is used, with "latency" the one with the lowest
+    p95 latency over weight, penalized by its error rate (untried models go first, to get samples).
+    A model that fails with a timeout, rate limit or overload is skipped for `cooldown` seconds, and the call
+    moves on to the next candidate after a jittered exponential backoff, up to `retries` times.
+
+    `completion` and `acompletion` default to litellm's, pass your own to test or to use another client.
+    A model shed by admission (limits.Overloaded) is passed over for the call, without counting as a failure.
+    """
+
+    def __init__(self, models: list[dict], *, strategy="order", retries=2, backoff=0.25, max_backoff=4.0,
+                 cooldown=30.0, max_error_rate=0.5, window=200, completion: Callable | None = None,
+                 acompletion: Callable | None = None):
+        assert strategy in ("order", "latency"), "strategy must be order or latency"
+        self.models: list[dict] = []
+        self.names: list[str] = []
+        self.weights: list[float] = []
+        for model in models:
+            model = dict(model)
+            self.weights.append(model.pop("weight", 1.0))
+            self.names.append(model.pop("name", None) or model["model"])
+            self.models.append(model)
+        self.strategy = strategy
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.cooldown = cooldown
+        self.max_error_rate = max_error_rate
+        self.completion = completion
+        self.acompletion = acompletion
+        self.stats = {name: LatencyWindow(window) for name in self.names}
+        self.down_until = dict.fromkeys(self.names, 0.0)
+
+    def snapshot(self) -> dict:
+        return {name: {**self.stats[name].snapshot(), "down": self.down_until[name] > time.monotonic()}
+                for name in self.names}
+
+    def healthy(self, i: int) -> bool:
+        name = self.names[i]
+        return self.down_until[name] <= time.monotonic() and self.stats[name].error_rate <= self.max_error_rate
+
+    def score(self, i: int) -> float:
+        window = self.stats[self.names[i]]
+        return (window.p95 or 0.0) * (1 + 4 * window.error_rate) / self.weights[i]
+
+    def candidates(self) -> list[int]:
+        """Model indexes in the order they should be tried, unhealthy ones last."""
+        order = list(range(len(self.models)))
+        if self.strategy == "latency":
+            order.sort(key=lambda i: (self.score(i), i))
+        return [i for i in order if self.healthy(i)] + [i for i in order if not self.healthy(i)]
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+    def attempts(self):
+        """(attempt, model index) pairs to try, cycling through the candidates."""
+        order = self.candidates()
+        for attempt in range(self.retries + 1):
+            yield attempt, order[attempt % len(order)]
+
+    def succeeded(self, i: int, started: float):
+        self.stats[self.names[i]].add(time.monotonic() - started)
+
+    def failed(self, i: int, started: float, e: Exception) -> bool:
+        """Record a failure, returns True if the call should move on to another model."""
+        name = self.names[i]
+        if isinstance(e, Overloaded):
+            log.warning("model %s has no capacity, trying the next: %s", name, e)
+            return True
+        if not retryable(e):
+            return False
+        log.warning("model %s failed, trying the next: %r", name, e)
+        self.stats[name].add(time.monotonic() - started, ok=False)
+        self.down_until[name] = time.monotonic() + self.cooldown
+        return True
+
+    def attempt_args(self, args: dict, i: int, stream: bool) -> dict:
+        return {**args, **self.models[i], **(dict(stream=True) if stream else {})}
+
+    def complete(self, args: dict, stream=False, send: Callable[[dict], object] | None = None):
+        """Run a completion, for a stream this returns once the first chunk arrived.
+
+        `send` makes each attempt's request, given its args, by default `completion(**args)`.
+        """
+        func = self.completion or completion
+        send = send or (lambda args: func(**args))
+        for attempt, i in self.attempts():
+            if attempt:
+                time.sleep(self.delay(attempt))
+            started = time.monotonic()
+            try:
+                result = send(self.attempt_args(args, i, stream))
+                if stream:
+                    result = iter(result)
+                    result = itertools.chain([next(result)], result)
+            except Exception as e:
+                if not self.failed(i, started, e) or attempt == self.retries:
+                    raise
+                continue
+            self.succeeded(i, started)
+            return result
+
+    async def acomplete(self, args: dict, stream=False, send: Callable[[dict], Awaitable] | None = None):
+        func = self.acompletion or acompletion
+        send = send or (lambda args: func(**args))
+        for attempt, i in self.attempts():
+            if attempt:
+                await asyncio.sleep(self.delay(attempt))
+            started = time.monotonic()
+            try:
+                result = await send(self.attempt_args(args, i, stream))
+                if stream:
+                    result = self.prepend(await result.__anext__(), result)
+            except Exception as e:
+                if not self.failed(i, started, e) or attempt == self.retries:
+                    raise
+                continue
+            self.succeeded(i, started)
+            return result
+
+    @staticmethod
+    async def prepend(first, rest):
+        yield first
+        async for chunk in rest:
+            yield chunk
+
+
+class RouterChat(OpenaiChat):
+    """OpenaiChat that sends each completion to the healthiest of several models, see ModelRouter.
+
+    Each attempt is admitted on, and sent through request() to, the model it's routed to, so ai.admission and
+    ai.hedger see the model that is actually called.
+    """
+
+    admits_per_request = True
+
+    def __init__(self, *, router: ModelRouter, **kws):
+        super().__init__(**kws)
+        self.router = router
+
+    def create(self, args: dict):
+        return (self.router.completion or completion)(**args)
+
+    async def acreate(self, args: dict):
+        return await (self.router.acompletion or acompletion)(**args)
+
+    def route(self, args: dict):
+        """One attempt of the router, on one model."""
+        self.admit(args["messages"], args.get("model"))
+        return self.request(args)
+
+    async def aroute(self, args: dict):
+        await self.aadmit(args["messages"], args.get("model"))
+        return await self.arequest(args)
+
+    def chat_complete(self, prompt, functions: AIFunctions, tool_choice=None) -> tuple[str, str, Function | None]:
+        args = self.completion_args(prompt, functions, tool_choice)
+        return self.parse_completion(self.router.complete(args, send=self.route))
+
+    async def achat_complete(self, prompt, functions: AIFunctions,
+                             tool_choice=None) -> tuple[str, str, Function | None]:
+        args = self.completion_args(prompt, functions, tool_choice)
+        return self.parse_completion(await self.router.acomplete(args, send=self.aroute))
+
+    def chat_complete_stream(self, prompt, functions: AIFunctions, tool_choice=None):
+        acc = StreamAccumulator()
+        args = self.completion_args(prompt, functions, tool_choice)
+        for chunk in self.router.complete(args, stream=True, send=self.route):
+            if text := acc.add(chunk):
+                yield text
+        self.add_usage(acc.usage)
+        yield acc.result()
+
+    async def achat_complete_stream(self, prompt, functions: AIFunctions, tool_choice=None):
+        acc = StreamAccumulator()
+        args = self.completion_args(prompt, functions, tool_choice)
+        async for chunk in await self.router.acomplete(args, stream=True, send=self.aroute):
+            if text := acc.add(chunk):
+                yield text
+        self.add_usage(acc.usage)
+        yield acc.result()
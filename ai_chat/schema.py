@@ -0,0 +1,37 @@
+import hashlib
+import json
+import threading
+import weakref
+
+from ai_chat.types import AIFunctions
+
+_schemas: "weakref.WeakKeyDictionary[AIFunctions, FunctionSchema]" = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def schema_version(functions: AIFunctions) -> tuple:
+    """Changes when a function is added, removed or replaced."""
+    return tuple((name, id(func)) for name, func in functions.map.items())
+
+
+class FunctionSchema:
+    """The openai schema of a function set, made once and serialized once."""
+
+    def __init__(self, functions: AIFunctions, version: tuple | None = None):
+        self.version = version if version is not None else schema_version(functions)
+        self.functions = functions.openai_dict()
+        self.tools = [{"type": "function", "function": f} for f in self.functions]
+        self.data = json.dumps(self.functions, sort_keys=True, separators=(",", ":")).encode()
+        self.digest = hashlib.sha256(self.data).hexdigest()
+
+
+def function_schema(functions: AIFunctions) -> FunctionSchema:
+    """Memoized schema for a function set, shared by every chat using it."""
+    version = schema_version(functions)
+    with _lock:
+        schema = _schemas.get(functions)
+    if schema is None or schema.version != version:
+        schema = FunctionSchema(functions, version)
+        with _lock:
+            _schemas[functions] = schema
+    return schema
@@ -0,0 +1,48 @@
+import threading
+import time
+from collections import deque
+
+
+class LatencyWindow:
+    """Latency and outcome of the last `size` calls, ignoring calls older than `seconds`."""
+
+    def __init__(self, size=200, seconds=300.0):
+        self.samples: deque[tuple[float, float, bool]] = deque(maxlen=size)
+        self.seconds = seconds
+        self.lock = threading.Lock()
+
+    def add(self, latency: float, ok=True):
+        with self.lock:
+            self.samples.append((time.monotonic(), latency, ok))
+
+    def recent(self) -> list[tuple[float, float, bool]]:
+        cutoff = time.monotonic() - self.seconds
+        with self.lock:
+            while self.samples and self.samples[0][0] < cutoff:
+                self.samples.popleft()
+            return list(self.samples)
+
+    def percentile(self, p: float) -> float | None:
+        """Latency percentile of successful calls, nearest rank, None if there are none."""
+        latencies = sorted(latency for _, latency, ok in self.recent() if ok)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))]
+
+    @property
+    def p50(self) -> float | None:
+        return self.percentile(50)
+
+    @property
+    def p95(self) -> float | None:
+        return self.percentile(95)
+
+    @property
+    def error_rate(self) -> float:
+        samples = self.recent()
+        if not samples:
+            return 0.0
+        return sum(1 for _, _, ok in samples if not ok) / len(samples)
+
+    def snapshot(self) -> dict:
+        return dict(count=len(self.recent()), p50=self.p50, p95=self.p95, error_rate=self.error_rate)
@@ -1,4 +1,6 @@
-from .base import Store, State
+from .base import Store, State, WrappedStore
 from .sqlite import SqliteStore, MemoryStore
 from .supabase import SupabaseStore
 from .postgres import PostgresStore
+from .cached import CachedStore, CachedStateStore
+from .vector import VectorRecallStore, HashingEmbedder
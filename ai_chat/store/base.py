@@ -1,4 +1,8 @@
-from typing import TYPE_CHECKING
+import asyncio
+import base64
+import contextlib
+import copy
+from typing import TYPE_CHECKING, AsyncContextManager, ContextManager
 from abc import ABC, abstractmethod
 
 if TYPE_CHECKING:
@@ -10,15 +14,72 @@ from ai_chat.types import Message
 State = str | dict[str, "State"] | int
 
 
+def thread_chat(chat: "Chat", thread_id: str) -> "Chat":
+    """A shallow copy of chat, on another thread of the same ai."""
+    other = copy.copy(chat)
+    other.thread_id = thread_id
+    return other
+
+
 class Store(ABC):
     @abstractmethod
-    def get_messages(self, chat: "Chat", content: str, limit: int = 20) -> list[Message]:
-        ...
+    def get_messages(self, chat: "Chat", content: str, limit: int = 20, before: Message | None = None) -> list[Message]:
+        """Newest `limit` messages, returned oldest to newest.
+
+        Pass the first (oldest) message of a previous page as `before` to page back through older history.
+        """
 
     @abstractmethod
     def add_message(self, message: "Message", chat: "Chat"):
         ...
 
+    def add_messages(self, messages: list["Message"], chat: "Chat"):
+        """Add several messages in one transaction, in order. Override with a bulk insert."""
+        for message in messages:
+            self.add_message(message, chat)
+
+    def get_thread_messages(self, chat: "Chat", thread_ids: list[str], limit: int = 20) -> dict[str, list[Message]]:
+        """Newest `limit` messages of each thread of the chat's ai, by thread_id. Override with a single query."""
+        return {thread_id: self.get_messages(thread_chat(chat, thread_id), "", limit) for thread_id in thread_ids}
+
+    # message embeddings, see VectorRecallStore. SqliteStore, MemoryStore and PostgresStore keep them in their own
+    # table, SupabaseStore and other stores fall back to these defaults: a state key per message, and lookups by
+    # id that page back through the history.
+
+    def get_messages_by_id(self, chat: "Chat", ids: list[str]) -> list[Message]:
+        """The thread's messages with these ids, oldest to newest. Override with a single query."""
+        wanted, found, before = set(ids), [], None
+        while wanted and (page := self.get_messages(chat, "", 100, before)):
+            found = [m for m in page if m.id in wanted] + found
+            wanted -= {m.id for m in page}
+            before = page[0]
+        return found
+
+    @staticmethod
+    def embeddings_prefix(chat: "Chat") -> str:
+        return f"embeddings:{chat.thread_id}:"
+
+    def add_embeddings(self, chat: "Chat", rows: list[tuple[str, bytes]]):
+        """Save (message_id, vector) rows. Override with a table, the default writes a state key per message."""
+        prefix = self.embeddings_prefix(chat)
+        self.set_states(chat, {prefix + id: base64.b64encode(vector).decode() for id, vector in rows})
+
+    def get_embeddings(self, chat: "Chat") -> list[tuple[str, bytes]]:
+        """All (message_id, vector) rows for the chat's thread, in insertion order where the store keeps one."""
+        prefix = self.embeddings_prefix(chat)
+        # enum_state matches with LIKE, where _ in a thread id matches any character
+        return [(key[len(prefix):], base64.b64decode(vector)) for key, vector in self.enum_state(chat, prefix)
+                if key.startswith(prefix)]
+
+    # optional, a lock on the chat's thread shared by every process using the store, see ai_chat.locks.TurnLock
+
+    def lock_thread(self, chat: "Chat", timeout: float | None = None) -> ContextManager:
+        """Hold the thread's lock, raises TimeoutError if it isn't free within `timeout` seconds."""
+        return contextlib.nullcontext()
+
+    def alock_thread(self, chat: "Chat", timeout: float | None = None) -> AsyncContextManager:
+        return contextlib.nullcontext()
+
     @abstractmethod
     def get_state(self, chat: "Chat", key: str) -> State | None:
         ...
@@ -31,6 +92,15 @@ class Store(ABC):
     def enum_state(self, chat: "Chat", prefix: str) -> list[tuple[str, State]]:
         ...
 
+    def get_states(self, chat: "Chat", keys: list[str]) -> dict[str, State]:
+        """Several keys at once, missing keys are left out. Override with a single query."""
+        return {key: state for key in keys if (state := self.get_state(chat, key)) is not None}
+
+    def set_states(self, chat: "Chat", states: dict[str, State]):
+        """Several keys at once. Override with a single write."""
+        for key, state in states.items():
+            self.set_state(chat, key, state)
+
     @abstractmethod
     def set_glob(self, key: str, state: State):
         ...
@@ -42,3 +112,139 @@ class Store(ABC):
     @abstractmethod
     def enum_glob(self, key: str) -> list[tuple[str, State]]:
         ...
+
+    # async versions, override with a native driver, by default the sync call runs in a worker thread
+
+    async def aget_messages(self, chat: "Chat", content: str, limit: int = 20,
+                            before: Message | None = None) -> list[Message]:
+        return await asyncio.to_thread(self.get_messages, chat, content, limit, before)
+
+    async def aget_thread_messages(self, chat: "Chat", thread_ids: list[str],
+                                   limit: int = 20) -> dict[str, list[Message]]:
+        return await asyncio.to_thread(self.get_thread_messages, chat, thread_ids, limit)
+
+    async def aadd_message(self, message: "Message", chat: "Chat"):
+        return await asyncio.to_thread(self.add_message, message, chat)
+
+    async def aadd_messages(self, messages: list["Message"], chat: "Chat"):
+        return await asyncio.to_thread(self.add_messages, messages, chat)
+
+    async def aget_state(self, chat: "Chat", key: str) -> State | None:
+        return await asyncio.to_thread(self.get_state, chat, key)
+
+    async def aset_state(self, chat: "Chat", key: str, state: State):
+        return await asyncio.to_thread(self.set_state, chat, key, state)
+
+    async def aenum_state(self, chat: "Chat", prefix: str) -> list[tuple[str, State]]:
+        return await asyncio.to_thread(self.enum_state, chat, prefix)
+
+    async def aget_states(self, chat: "Chat", keys: list[str]) -> dict[str, State]:
+        return await asyncio.to_thread(self.get_states, chat, keys)
+
+    async def aset_states(self, chat: "Chat", states: dict[str, State]):
+        return await asyncio.to_thread(self.set_states, chat, states)
+
+    async def aset_glob(self, key: str, state: State):
+        return await asyncio.to_thread(self.set_glob, key, state)
+
+    async def aget_glob(self, key: str) -> State:
+        return await asyncio.to_thread(self.get_glob, key)
+
+    async def aenum_glob(self, key: str) -> list[tuple[str, State]]:
+        return await asyncio.to_thread(self.enum_glob, key)
+
+
+class WrappedStore(Store):
+    """Store that delegates everything to another store, subclass to layer behavior on top."""
+
+    def __init__(self, store: Store):
+        self.store = store
+
+    def get_messages(self, chat: "Chat", content: str, limit=20, before: Message | None = None) -> list[Message]:
+        return self.store.get_messages(chat, content, limit, before)
+
+    def add_message(self, message: "Message", chat: "Chat"):
+        self.store.add_message(message, chat)
+
+    def add_messages(self, messages: list["Message"], chat: "Chat"):
+        self.store.add_messages(messages, chat)
+
+    def get_thread_messages(self, chat: "Chat", thread_ids: list[str], limit=20) -> dict[str, list[Message]]:
+        return self.store.get_thread_messages(chat, thread_ids, limit)
+
+    def get_messages_by_id(self, chat: "Chat", ids: list[str]) -> list[Message]:
+        return self.store.get_messages_by_id(chat, ids)
+
+    def add_embeddings(self, chat: "Chat", rows: list[tuple[str, bytes]]):
+        self.store.add_embeddings(chat, rows)
+
+    def get_embeddings(self, chat: "Chat") -> list[tuple[str, bytes]]:
+        return self.store.get_embeddings(chat)
+
+    def lock_thread(self, chat: "Chat", timeout: float | None = None) -> ContextManager:
+        return self.store.lock_thread(chat, timeout)
+
+    def alock_thread(self, chat: "Chat", timeout: float | None = None) -> AsyncContextManager:
+        return self.store.alock_thread(chat, timeout)
+
+    def get_state(self, chat: "Chat", key: str) -> State | None:
+        return self.store.get_state(chat, key)
+
+    def set_state(self, chat: "Chat", key: str, state: State):
+        self.store.set_state(chat, key, state)
+
+    def enum_state(self, chat: "Chat", prefix: str) -> list[tuple[str, State]]:
+        return self.store.enum_state(chat, prefix)
+
+    def get_states(self, chat: "Chat", keys: list[str]) -> dict[str, State]:
+        return self.store.get_states(chat, keys)
+
+    def set_states(self, chat: "Chat", states: dict[str, State]):
+        self.store.set_states(chat, states)
+
+    def set_glob(self, key: str, state: State):
+        self.store.set_glob(key, state)
+
+    def get_glob(self, key: str) -> State | None:
+        return self.store.get_glob(key)
+
+    def enum_glob(self, prefix: str) -> list[tuple[str, State]]:
+        return self.store.enum_glob(prefix)
+
+    async def aget_messages(self, chat: "Chat", content: str, limit=20,
+                            before: Message | None = None) -> list[Message]:
+        return await self.store.aget_messages(chat, content, limit, before)
+
+    async def aget_thread_messages(self, chat: "Chat", thread_ids: list[str],
+                                   limit=20) -> dict[str, list[Message]]:
+        return await self.store.aget_thread_messages(chat, thread_ids, limit)
+
+    async def aadd_message(self, message: "Message", chat: "Chat"):
+        await self.store.aadd_message(message, chat)
+
+    async def aadd_messages(self, messages: list["Message"], chat: "Chat"):
+        await self.store.aadd_messages(messages, chat)
+
+    async def aget_state(self, chat: "Chat", key: str) -> State | None:
+        return await self.store.aget_state(chat, key)
+
+    async def aset_state(self, chat: "Chat", key: str, state: State):
+        await self.store.aset_state(chat, key, state)
+
+    async def aenum_state(self, chat: "Chat", prefix: str) -> list[tuple[str, State]]:
+        return await self.store.aenum_state(chat, prefix)
+
+    async def aget_states(self, chat: "Chat", keys: list[str]) -> dict[str, State]:
+        return await self.store.aget_states(chat, keys)
+
+    async def aset_states(self, chat: "Chat", states: dict[str, State]):
+        await self.store.aset_states(chat, states)
+
+    async def aset_glob(self, key: str, state: State):
+        await self.store.aset_glob(key, state)
+
+    async def aget_glob(self, key: str) -> State | None:
+        return await self.store.aget_glob(key)
+
+    async def aenum_glob(self, prefix: str) -> list[tuple[str, State]]:
+        return await self.store.aenum_glob(prefix)
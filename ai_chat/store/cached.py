@@ -0,0 +1,400 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from ai_chat.chat import Chat
+
+from ai_chat.types import Message
+from ai_chat.store.base import Store, State, WrappedStore
+
+# rough per-message overhead, on top of the content, for the byte bound
+MESSAGE_OVERHEAD = 200
+
+
+def message_size(message: Message) -> int:
+    return MESSAGE_OVERHEAD + len(message.content or "")
+
+
+class Versions:
+    """Write counts of the keys being read, so a read that raced with a write to its key isn't cached.
+
+    Only keys with a read in flight are tracked, call with the owning cache's lock held.
+    """
+
+    def __init__(self):
+        self.reading: dict = {}
+        self.counts: dict = {}
+
+    def start(self, keys) -> dict:
+        """Note reads of `keys` are in flight, returns the version each is read at."""
+        for key in keys:
+            self.reading[key] = self.reading.get(key, 0) + 1
+        return {key: self.counts.get(key, 0) for key in keys}
+
+    def bump(self, key):
+        if key in self.reading:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def current(self, key, version: int) -> bool:
+        return self.counts.get(key, 0) == version
+
+    def finish(self, keys):
+        for key in keys:
+            self.reading[key] -= 1
+            if not self.reading[key]:
+                del self.reading[key]
+                self.counts.pop(key, None)
+
+
+class ThreadHistory:
+    """Newest messages of one thread, complete if it holds the whole thread."""
+
+    def __init__(self, messages: list[Message], complete: bool):
+        self.messages = messages
+        self.complete = complete
+        self.size = sum(message_size(m) for m in messages)
+
+
+class CachedStore(WrappedStore):
+    """Write-through in-process cache of recent thread history, in front of any store.
+
+    Keeps the last `max_messages` per (ai_id, thread_id) in an LRU bounded by `max_threads` and `max_bytes`.
+    Only history is cached, state calls go straight to the wrapped store.
+
+    This process must be the only writer for a cached thread, or reads can be stale.
+    """
+
+    def __init__(self, store: Store, max_messages=50, max_threads=1000, max_bytes=64 * 1024 * 1024):
+        super().__init__(store)
+        self.max_messages = max_messages
+        self.max_threads = max_threads
+        self.max_bytes = max_bytes
+        self.threads: OrderedDict[tuple[str, str], ThreadHistory] = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # appends to threads being read, so a read that raced with one isn't cached
+        self.versions = Versions()
+        self.lock = threading.RLock()
+
+    def stats(self) -> dict:
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, threads=len(self.threads),
+                    bytes=self.bytes)
+
+    def clear(self):
+        with self.lock:
+            self.threads.clear()
+            self.bytes = 0
+
+    def lookup(self, key, limit) -> list[Message] | None:
+        with self.lock:
+            ent = self.threads.get(key)
+            if ent is not None and (ent.complete or len(ent.messages) >= limit):
+                self.threads.move_to_end(key)
+                self.hits += 1
+                return ent.messages[-limit:] if limit else []
+            self.misses += 1
+            return None
+
+    def start(self, keys) -> dict:
+        with self.lock:
+            return self.versions.start(keys)
+
+    def finish(self, keys):
+        with self.lock:
+            self.versions.finish(keys)
+
+    def fill(self, key, messages: list[Message], fetched: int, version: int):
+        with self.lock:
+            if not self.versions.current(key, version):
+                return
+            self.discard(key)
+            ent = ThreadHistory(messages[-self.max_messages:], complete=len(messages) < fetched)
+            self.threads[key] = ent
+            self.bytes += ent.size
+            self.evict()
+
+    def append(self, messages: list[Message]):
+        with self.lock:
+            for message in messages:
+                key = (message.ai_id, message.thread_id)
+                self.versions.bump(key)
+                ent = self.threads.get(key)
+                if ent is None:
+                    # not loaded, the next read fetches it with this message included
+                    continue
+                ent.messages.append(message)
+                ent.size += message_size(message)
+                self.bytes += message_size(message)
+                if len(ent.messages) > self.max_messages:
+                    dropped = ent.messages.pop(0)
+                    ent.size -= message_size(dropped)
+                    self.bytes -= message_size(dropped)
+                    ent.complete = False
+                self.threads.move_to_end(key)
+            self.evict()
+
+    def discard(self, key):
+        if (ent := self.threads.pop(key, None)) is not None:
+            self.bytes -= ent.size
+
+    def evict(self):
+        while self.threads and (len(self.threads) > self.max_threads or self.bytes > self.max_bytes):
+            _, ent = self.threads.popitem(last=False)
+            self.bytes -= ent.size
+            self.evictions += 1
+
+    @staticmethod
+    def key(chat: "Chat"):
+        return chat.ai.id, chat.thread_id
+
+    @staticmethod
+    def stamp(messages: list[Message], chat: "Chat") -> list[Message]:
+        for message in messages:
+            message.ai_id = getattr(message, "ai_id", None) or chat.ai.id
+            message.thread_id = message.thread_id or chat.thread_id
+        return messages
+
+    def get_messages(self, chat: "Chat", content: str, limit=20,
+                     before: Message | None = None) -> list[Message]:
+        if before is not None:
+            return self.store.get_messages(chat, content, limit, before)
+        key = self.key(chat)
+        if (messages := self.lookup(key, limit)) is not None:
+            return messages
+        fetch = max(limit, self.max_messages)
+        versions = self.start([key])
+        try:
+            messages = self.store.get_messages(chat, content, fetch)
+            self.fill(key, messages, fetch, versions[key])
+        finally:
+            self.finish([key])
+        return messages[-limit:] if limit else []
+
+    def cached_threads(self, chat: "Chat", thread_ids: list[str], limit) -> tuple[dict[str, list[Message]], list[str]]:
+        """The threads the cache can answer, and the ones it has to fetch."""
+        out, missed = {}, []
+        for thread_id in thread_ids:
+            if (messages := self.lookup((chat.ai.id, thread_id), limit)) is not None:
+                out[thread_id] = messages
+            else:
+                missed.append(thread_id)
+        return out, missed
+
+    def fill_threads(self, chat: "Chat", fetched: dict[str, list[Message]], fetch: int, versions: dict,
+                     limit) -> dict[str, list[Message]]:
+        for thread_id, messages in fetched.items():
+            if (key := (chat.ai.id, thread_id)) in versions:
+                self.fill(key, messages, fetch, versions[key])
+        return {thread_id: messages[-limit:] if limit else [] for thread_id, messages in fetched.items()}
+
+    def get_thread_messages(self, chat: "Chat", thread_ids: list[str], limit=20) -> dict[str, list[Message]]:
+        out, missed = self.cached_threads(chat, thread_ids, limit)
+        if missed:
+            fetch = max(limit, self.max_messages)
+            keys = [(chat.ai.id, thread_id) for thread_id in missed]
+            versions = self.start(keys)
+            try:
+                fetched = self.store.get_thread_messages(chat, missed, fetch)
+                out.update(self.fill_threads(chat, fetched, fetch, versions, limit))
+            finally:
+                self.finish(keys)
+        return {thread_id: out.get(thread_id, []) for thread_id in thread_ids}
+
+    def add_message(self, message: "Message", chat: "Chat"):
+        self.store.add_message(message, chat)
+        self.append(self.stamp([message], chat))
+
+    def add_messages(self, messages: list["Message"], chat: "Chat"):
+        self.store.add_messages(messages, chat)
+        self.append(self.stamp(messages, chat))
+
+    async def aget_messages(self, chat: "Chat", content: str, limit=20,
+                            before: Message | None = None) -> list[Message]:
+        if before is not None:
+            return await self.store.aget_messages(chat, content, limit, before)
+        key = self.key(chat)
+        if (messages := self.lookup(key, limit)) is not None:
+            return messages
+        fetch = max(limit, self.max_messages)
+        versions = self.start([key])
+        try:
+            messages = await self.store.aget_messages(chat, content, fetch)
+            self.fill(key, messages, fetch, versions[key])
+        finally:
+            self.finish([key])
+        return messages[-limit:] if limit else []
+
+    async def aget_thread_messages(self, chat: "Chat", thread_ids: list[str],
+                                   limit=20) -> dict[str, list[Message]]:
+        out, missed = self.cached_threads(chat, thread_ids, limit)
+        if missed:
+            fetch = max(limit, self.max_messages)
+            keys = [(chat.ai.id, thread_id) for thread_id in missed]
+            versions = self.start(keys)
+            try:
+                fetched = await self.store.aget_thread_messages(chat, missed, fetch)
+                out.update(self.fill_threads(chat, fetched, fetch, versions, limit))
+            finally:
+                self.finish(keys)
+        return {thread_id: out.get(thread_id, []) for thread_id in thread_ids}
+
+    async def aadd_message(self, message: "Message", chat: "Chat"):
+        await self.store.aadd_message(message, chat)
+        self.append(self.stamp([message], chat))
+
+    async def aadd_messages(self, messages: list["Message"], chat: "Chat"):
+        await self.store.aadd_messages(messages, chat)
+        self.append(self.stamp(messages, chat))
+
+
+# cached for keys the store doesn't have
+MISSING = object()
+
+
+def present(key: str, state: State | None) -> dict[str, State]:
+    """A single key read, as get_states would return it."""
+    return {} if state is None else {key: state}
+
+
+class CachedStateStore(WrappedStore):
+    """Read-through, write-through in-process cache of state and glob keys, in front of any store.
+
+    Values are kept decoded, in an LRU of `max_keys`, for `ttl` seconds (None keeps them until evicted), so
+    writes from other processes show up within `ttl`. Keys the store doesn't have are cached as missing too.
+    Cached values are shared between callers, treat them as read-only.
+    """
+
+    def __init__(self, store: Store, max_keys=10000, ttl: float | None = 60.0):
+        super().__init__(store)
+        self.max_keys = max_keys
+        self.ttl = ttl
+        # (ai_id, key) -> (state or MISSING, expires)
+        self.states: OrderedDict[tuple[str, str], tuple[object, float]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # writes to keys being read, so a read that raced with one isn't cached
+        self.versions = Versions()
+        self.lock = threading.Lock()
+
+    def stats(self) -> dict:
+        return dict(hits=self.hits, misses=self.misses, keys=len(self.states))
+
+    def clear(self):
+        with self.lock:
+            self.states.clear()
+
+    def lookup(self, ai_id: str, keys: list[str]) -> tuple[dict[str, State], list[str]]:
+        """Cached states by key, and the keys that have to be read."""
+        found, missing = {}, []
+        now = time.monotonic()
+        with self.lock:
+            for key in keys:
+                ent = self.states.get((ai_id, key))
+                if ent is None or ent[1] < now:
+                    missing.append(key)
+                    continue
+                self.states.move_to_end((ai_id, key))
+                if ent[0] is not MISSING:
+                    found[key] = ent[0]
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+        return found, missing
+
+    def fill(self, ai_id: str, states: dict[str, State], keys: list[str], versions: dict | None = None):
+        """Cache states, read at `versions`, or written if None. Keys not in states are cached as missing.
+
+        A read key written to since it was read is left out.
+        """
+        expires = time.monotonic() + self.ttl if self.ttl is not None else float("inf")
+        with self.lock:
+            for key in keys:
+                if versions is None:
+                    self.versions.bump((ai_id, key))
+                elif not self.versions.current((ai_id, key), versions[(ai_id, key)]):
+                    continue
+                self.states[(ai_id, key)] = (states.get(key, MISSING), expires)
+                self.states.move_to_end((ai_id, key))
+            while len(self.states) > self.max_keys:
+                self.states.popitem(last=False)
+
+    def read(self, ai_id: str, keys: list[str], get) -> dict[str, State]:
+        found, missing = self.lookup(ai_id, keys)
+        if missing:
+            read = [(ai_id, key) for key in missing]
+            with self.lock:
+                versions = self.versions.start(read)
+            try:
+                states = get(missing)
+                self.fill(ai_id, states, missing, versions)
+            finally:
+                with self.lock:
+                    self.versions.finish(read)
+            found.update(states)
+        return found
+
+    async def aread(self, ai_id: str, keys: list[str], aget) -> dict[str, State]:
+        found, missing = self.lookup(ai_id, keys)
+        if missing:
+            read = [(ai_id, key) for key in missing]
+            with self.lock:
+                versions = self.versions.start(read)
+            try:
+                states = await aget(missing)
+                self.fill(ai_id, states, missing, versions)
+            finally:
+                with self.lock:
+                    self.versions.finish(read)
+            found.update(states)
+        return found
+
+    def get_state(self, chat: "Chat", key: str) -> State | None:
+        return self.read(chat.ai.id, [key], lambda keys: present(key, self.store.get_state(chat, key))).get(key)
+
+    def get_states(self, chat: "Chat", keys: list[str]) -> dict[str, State]:
+        return self.read(chat.ai.id, keys, lambda keys: self.store.get_states(chat, keys))
+
+    def get_glob(self, key: str) -> State | None:
+        return self.read("<glob>", [key], lambda keys: present(key, self.store.get_glob(key))).get(key)
+
+    def set_state(self, chat: "Chat", key: str, state: State):
+        self.store.set_state(chat, key, state)
+        self.fill(chat.ai.id, {key: state}, [key])
+
+    def set_states(self, chat: "Chat", states: dict[str, State]):
+        self.store.set_states(chat, states)
+        self.fill(chat.ai.id, states, list(states))
+
+    def set_glob(self, key: str, state: State):
+        self.store.set_glob(key, state)
+        self.fill("<glob>", {key: state}, [key])
+
+    async def aget_state(self, chat: "Chat", key: str) -> State | None:
+        async def aget(keys):
+            return present(key, await self.store.aget_state(chat, key))
+
+        return (await self.aread(chat.ai.id, [key], aget)).get(key)
+
+    async def aget_states(self, chat: "Chat", keys: list[str]) -> dict[str, State]:
+        return await self.aread(chat.ai.id, keys, lambda keys: self.store.aget_states(chat, keys))
+
+    async def aget_glob(self, key: str) -> State | None:
+        async def aget(keys):
+            return present(key, await self.store.aget_glob(key))
+
+        return (await self.aread("<glob>", [key], aget)).get(key)
+
+    async def aset_state(self, chat: "Chat", key: str, state: State):
+        await self.store.aset_state(chat, key, state)
+        self.fill(chat.ai.id, {key: state}, [key])
+
+    async def aset_states(self, chat: "Chat", states: dict[str, State]):
+        await self.store.aset_states(chat, states)
+        self.fill(chat.ai.id, states, list(states))
+
+    async def aset_glob(self, key: str, state: State):
+        await self.store.aset_glob(key, state)
+        self.fill("<glob>", {key: state}, [key])
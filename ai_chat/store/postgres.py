@@ -1,25 +1,270 @@
+import asyncio
+import contextlib
 import json
+import logging as log
 import os
+import re
+import threading
+import time
 from typing import TYPE_CHECKING
 import psycopg2
-from psycopg2.extras import DictCursor
+from psycopg2.extras import DictCursor, execute_values
+from psycopg2.pool import PoolError, ThreadedConnectionPool
 
 if TYPE_CHECKING:
     from ai_chat.chat import Chat
 
 from ai_chat.types import Message
 from ai_chat.store.base import Store, State
+from ai_chat.util import uuid
+
+# newest first in the index, flipped to oldest first for the caller
+GET_MESSAGES = """
+    SELECT * FROM (
+        SELECT * FROM messages
+        WHERE thread_id = %s AND ai_id = %s {where}
+        ORDER BY seq DESC
+        LIMIT %s
+    ) AS page ORDER BY seq
+"""
+
+BEFORE = "AND seq < (SELECT seq FROM messages WHERE id = %s)"
+
+GET_THREAD_MESSAGES = """
+    SELECT id, created_at, ai_id, thread_id, role, content, seq FROM (
+        SELECT *, ROW_NUMBER() OVER (PARTITION BY thread_id ORDER BY seq DESC) AS rn
+        FROM messages
+        WHERE ai_id = %s AND thread_id = ANY(%s)
+    ) AS page
+    WHERE rn <= %s
+    ORDER BY thread_id, seq
+"""
+
+# reserves `count` numbers on the thread's counter, the row lock makes concurrent writers take turns
+NEXT_SEQ = """
+    INSERT INTO message_seqs (thread_id, ai_id, seq) VALUES (%s, %s, %s)
+    ON CONFLICT (thread_id, ai_id) DO UPDATE SET seq = message_seqs.seq + EXCLUDED.seq
+    RETURNING seq
+"""
+
+ADD_MESSAGE = """
+    WITH next AS ({next_seq})
+    INSERT INTO messages (id, created_at, role, content, thread_id, ai_id, seq)
+    SELECT %s, NOW(), %s, %s, %s, %s, seq FROM next
+    ON CONFLICT (id) DO NOTHING
+""".format(next_seq=NEXT_SEQ)
+
+# one multi-row insert, with seqs reserved by NEXT_SEQ
+ADD_MESSAGES = """
+    INSERT INTO messages (id, created_at, role, content, thread_id, ai_id, seq)
+    VALUES %s
+    ON CONFLICT (id) DO NOTHING
+"""
+
+ADD_MESSAGES_TEMPLATE = "(%s, NOW(), %s, %s, %s, %s, %s)"
+
+# for tables made before seq: number the messages without one in created_at order, after any seq the thread
+# already has or has reserved, and start the counters there
+MIGRATE_SEQ = [
+    "ALTER TABLE messages ADD COLUMN IF NOT EXISTS seq bigint",
+    """
+    UPDATE messages SET seq = numbered.seq FROM (
+        SELECT legacy.id, COALESCE(tops.top, 0)
+            + ROW_NUMBER() OVER (PARTITION BY legacy.thread_id, legacy.ai_id ORDER BY legacy.created_at, legacy.id)
+            AS seq
+        FROM messages AS legacy
+        LEFT JOIN (
+            SELECT thread_id, ai_id, MAX(seq) AS top FROM (
+                SELECT thread_id, ai_id, seq FROM messages
+                UNION ALL
+                SELECT thread_id, ai_id, seq FROM message_seqs
+            ) AS seqs
+            GROUP BY thread_id, ai_id
+        ) AS tops ON tops.thread_id = legacy.thread_id AND tops.ai_id = legacy.ai_id
+        WHERE legacy.seq IS NULL
+    ) AS numbered
+    WHERE messages.id = numbered.id
+    """,
+    """
+    INSERT INTO message_seqs (thread_id, ai_id, seq)
+    SELECT thread_id, ai_id, MAX(seq) FROM messages GROUP BY thread_id, ai_id
+    ON CONFLICT (thread_id, ai_id) DO UPDATE SET seq = GREATEST(message_seqs.seq, EXCLUDED.seq)
+    """,
+    "DROP INDEX IF EXISTS ix_messages_thread_ai_created",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ux_messages_thread_ai_seq ON messages(thread_id, ai_id, seq)",
+]
+
+GET_MESSAGES_BY_ID = """
+    SELECT * FROM messages
+    WHERE thread_id = %s AND ai_id = %s AND id = ANY(%s)
+    ORDER BY seq
+"""
+
+ADD_EMBEDDINGS = """
+    INSERT INTO embeddings (message_id, ai_id, thread_id, vector, created_at)
+    VALUES %s
+    ON CONFLICT (message_id) DO UPDATE SET vector = EXCLUDED.vector
+"""
+
+ADD_EMBEDDINGS_TEMPLATE = "(%s, %s, %s, %s, NOW() + %s::int * INTERVAL '1 microsecond')"
+
+GET_EMBEDDINGS = """
+    SELECT message_id, vector FROM embeddings
+    WHERE thread_id = %s AND ai_id = %s
+    ORDER BY created_at
+"""
+
+SET_STATE = """
+    INSERT INTO state (ai_id, key, content, created_at)
+    VALUES (%s, %s, %s, NOW())
+    ON CONFLICT (ai_id, key)
+    DO UPDATE SET content = EXCLUDED.content
+"""
+
+GET_STATE = """
+    SELECT content FROM state
+    WHERE ai_id = %s AND key = %s
+"""
+
+GET_STATES = """
+    SELECT key, content FROM state
+    WHERE ai_id = %s AND key = ANY(%s)
+"""
+
+SET_STATES = """
+    INSERT INTO state (ai_id, key, content, created_at)
+    VALUES %s
+    ON CONFLICT (ai_id, key)
+    DO UPDATE SET content = EXCLUDED.content
+"""
+
+SET_STATES_TEMPLATE = "(%s, %s, %s, NOW())"
+
+ENUM_STATE = """
+    SELECT key, content FROM state
+    WHERE ai_id = %s AND key LIKE %s
+"""
+
+
+# takes a thread's lock if it's free or its lease ran out, returns a row only if it was taken
+TRY_LOCK = """
+    INSERT INTO locks (name, owner, expires_at) VALUES (%s, %s, NOW() + make_interval(secs => %s))
+    ON CONFLICT (name) DO UPDATE SET owner = EXCLUDED.owner, expires_at = EXCLUDED.expires_at
+    WHERE locks.expires_at < NOW()
+    RETURNING owner
+"""
+
+UNLOCK = "DELETE FROM locks WHERE name = %s AND owner = %s"
+
+
+def asyncpg_query(query: str) -> str:
+    """Convert psycopg %s placeholders to asyncpg $n placeholders."""
+    count = 0
+
+    def repl(_):
+        nonlocal count
+        count += 1
+        return f"${count}"
+
+    return re.sub(r"%s", repl, query)
 
 
 class PostgresStore(Store):
-    """PostgreSQL message storage"""
+    """PostgreSQL message storage
+
+    Safe to share across threads: each call checks a connection out of `pool` (a psycopg2 ThreadedConnectionPool
+    by default, or any pool with getconn/putconn such as psycopg_pool) and returns it when done.
+    Passing a single `conn` instead serializes calls on it.
+
+    At most `maxconn` calls hold a connection at once, the rest wait up to `checkout_timeout` seconds for one
+    and then raise PoolError. The default pool closes returned connections beyond `minconn`, so `minconn`
+    defaults to `maxconn`, set it to the concurrency you expect to keep connections warm without holding more.
+
+    Pass an asyncpg pool as `apool` (or install asyncpg) to use native async queries in achat.
+    """
+
+    # seconds a thread lock is held before others may take it, in case its process died holding it
+    lock_lease = 600.0
 
-    def __init__(self, conn=None):
-        if conn is None:
+    def __init__(self, conn=None, apool=None, *, pool=None, minconn: int | None = None, maxconn=10,
+                 checkout_timeout=30.0):
+        if conn is None and pool is None:
             postgres_url = os.environ["POSTGRES_URL"]
-            conn = psycopg2.connect(postgres_url, cursor_factory=DictCursor)
+            minconn = maxconn if minconn is None else minconn
+            pool = ThreadedConnectionPool(minconn, maxconn, postgres_url, cursor_factory=DictCursor)
         self.conn = conn
+        self.pool = pool
+        self.apool = apool
+        self.lock = threading.RLock()
+        # one per connection the pool will hand out, getconn raises instead of waiting when it has none left
+        self.slots = threading.BoundedSemaphore(maxconn)
+        self.checkout_timeout = checkout_timeout
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Check out a connection, commit when the block exits, or roll back if it raises."""
+        if self.pool is None:
+            with self.lock:
+                yield from self.transaction(self.conn)
+            return
+
+        if not self.slots.acquire(timeout=self.checkout_timeout):
+            raise PoolError(f"no postgres connection free after {self.checkout_timeout}s")
+        try:
+            conn = self.pool.getconn()
+            while conn.closed:
+                self.pool.putconn(conn)
+                conn = self.pool.getconn()
+            try:
+                yield from self.transaction(conn)
+            finally:
+                # a closed connection is dropped by the pool and replaced on demand
+                self.pool.putconn(conn)
+        finally:
+            self.slots.release()
+
+    @staticmethod
+    def transaction(conn):
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            # psycopg2 marks a connection closed once it's lost, a timed out or deadlocked query leaves it usable
+            if conn.closed:
+                log.warning("postgres connection lost")
+            else:
+                conn.rollback()
+            raise
+
+    def run(self, func):
+        """Run func(cursor) in a transaction, retrying once on a fresh pool connection if the connection was lost.
+
+        A failed query on a live connection is never retried, nor is anything on a single `conn`.
+        """
+        for attempt in range(2):
+            conn = None
+            try:
+                with self.connection() as conn, conn.cursor() as cur:
+                    return func(cur)
+            except Exception:
+                if conn is None or not conn.closed or attempt or self.pool is None:
+                    raise
 
+    def fetch(self, query, params) -> list:
+        def func(cur):
+            cur.execute(query, params)
+            return cur.fetchall()
+
+        return self.run(func)
+
+    def execute(self, query, params):
+        self.run(lambda cur: cur.execute(query, params))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.closeall()
+        else:
+            self.conn.close()
 
     def create(self):
         queries = [
@@ -30,7 +275,16 @@ class PostgresStore(Store):
                 ai_id text not null,
                 thread_id text not null,
                 role text not null,
-                content text not null
+                content text not null,
+                seq bigint
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS message_seqs (
+                thread_id text not null,
+                ai_id text not null,
+                seq bigint not null,
+                primary key (thread_id, ai_id)
             );
             """,
             """
@@ -43,6 +297,18 @@ class PostgresStore(Store):
             CREATE INDEX IF NOT EXISTS ix_messages_created_at ON messages(created_at);
             """,
             """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                message_id text primary key,
+                ai_id text not null,
+                thread_id text not null,
+                vector bytea not null,
+                created_at timestamp with time zone default now()
+            );
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS ix_embeddings_thread_ai ON embeddings(thread_id, ai_id, created_at);
+            """,
+            """
             CREATE TABLE IF NOT EXISTS state (
                 ai_id text not null,
                 key text,
@@ -50,72 +316,205 @@ class PostgresStore(Store):
                 created_at timestamp with time zone default now(),
                 primary key (ai_id, key)
             );
+            """,
             """
+            CREATE TABLE IF NOT EXISTS locks (
+                name text primary key,
+                owner text not null,
+                expires_at timestamp with time zone not null
+            );
+            """,
+            *MIGRATE_SEQ,
         ]
 
-        with self.conn.cursor() as cur:
+        def func(cur):
             for query in queries:
                 cur.execute(query)
-            self.conn.commit()
-
-    def get_messages(self, chat: "Chat", content: str, limit=20):
-        query = """
-            SELECT * FROM messages
-            WHERE thread_id = %s AND ai_id = %s
-            ORDER BY created_at ASC
-            LIMIT %s
-        """
-        with self.conn.cursor() as cur:
-            cur.execute(query, (chat.thread_id, chat.ai.id, limit))
-            rows = cur.fetchall()
+
+        self.run(func)
+
+    @staticmethod
+    def messages_query(chat: "Chat", limit, before: Message | None) -> tuple[str, tuple]:
+        if before is None:
+            return GET_MESSAGES.format(where=""), (chat.thread_id, chat.ai.id, limit)
+        return GET_MESSAGES.format(where=BEFORE), (chat.thread_id, chat.ai.id, before.id, limit)
+
+    def get_messages(self, chat: "Chat", content: str, limit=20, before: Message | None = None):
+        rows = self.fetch(*self.messages_query(chat, limit, before))
         return [Message(**row) for row in rows]
 
+    def get_thread_messages(self, chat: "Chat", thread_ids: list[str], limit=20) -> dict[str, list[Message]]:
+        out = {thread_id: [] for thread_id in thread_ids}
+        for row in self.fetch(GET_THREAD_MESSAGES, (chat.ai.id, list(thread_ids), limit)):
+            out[row['thread_id']].append(Message(**row))
+        return out
+
     def add_message(self, message: "Message", chat: "Chat"):
-        query = """
-            INSERT INTO messages (id, created_at, role, content, thread_id, ai_id)
-            VALUES (%s, NOW(), %s, %s, %s, %s)
-            ON CONFLICT (id) DO NOTHING
-        """
-        with self.conn.cursor() as cur:
-            cur.execute(query, (message.id, message.role, message.content, chat.thread_id, chat.ai.id))
-            self.conn.commit()
+        self.execute(ADD_MESSAGE, (chat.thread_id, chat.ai.id, 1,
+                                   message.id, message.role, message.content, chat.thread_id, chat.ai.id))
+
+    def add_messages(self, messages: list["Message"], chat: "Chat"):
+        def func(cur):
+            rows = []
+            for (thread_id, ai_id), group in self.thread_groups(messages, chat).items():
+                cur.execute(NEXT_SEQ, (thread_id, ai_id, len(group)))
+                rows += self.message_rows(group, thread_id, ai_id, cur.fetchone()[0])
+            execute_values(cur, ADD_MESSAGES, rows, template=ADD_MESSAGES_TEMPLATE)
+
+        self.run(func)
+
+    @staticmethod
+    def thread_groups(messages: list["Message"], chat: "Chat") -> dict[tuple[str, str], list["Message"]]:
+        groups = {}
+        for message in messages:
+            key = (message.thread_id or chat.thread_id, getattr(message, "ai_id", None) or chat.ai.id)
+            groups.setdefault(key, []).append(message)
+        return groups
+
+    @staticmethod
+    def message_rows(messages: list["Message"], thread_id: str, ai_id: str, last: int) -> list[tuple]:
+        """Rows for ADD_MESSAGES, numbered up to `last`, the end of the seqs reserved for them."""
+        first = last - len(messages) + 1
+        return [(message.id, message.role, message.content, thread_id, ai_id, first + i)
+                for i, message in enumerate(messages)]
+
+    def get_messages_by_id(self, chat: "Chat", ids: list[str]) -> list[Message]:
+        rows = self.fetch(GET_MESSAGES_BY_ID, (chat.thread_id, chat.ai.id, list(ids)))
+        return [Message(**row) for row in rows]
+
+    def add_embeddings(self, chat: "Chat", rows: list[tuple[str, bytes]]):
+        rows = [(id, chat.ai.id, chat.thread_id, psycopg2.Binary(vector), i) for i, (id, vector) in enumerate(rows)]
+        self.run(lambda cur: execute_values(cur, ADD_EMBEDDINGS, rows, template=ADD_EMBEDDINGS_TEMPLATE))
+
+    def get_embeddings(self, chat: "Chat") -> list[tuple[str, bytes]]:
+        rows = self.fetch(GET_EMBEDDINGS, (chat.thread_id, chat.ai.id))
+        return [(row['message_id'], bytes(row['vector'])) for row in rows]
 
     def set_state(self, chat: "Chat", key: str, state: State):
-        query = """
-            INSERT INTO state (ai_id, key, content, created_at)
-            VALUES (%s, %s, %s, NOW())
-            ON CONFLICT (ai_id, key)
-            DO UPDATE SET content = EXCLUDED.content
-        """
-        with self.conn.cursor() as cur:
-            cur.execute(query, (chat.ai.id, key, json.dumps(state)))
-            self.conn.commit()
+        self.execute(SET_STATE, (chat.ai.id, key, json.dumps(state)))
 
     def get_state(self, chat: "Chat", key: str) -> State | None:
-        query = """
-            SELECT content FROM state
-            WHERE ai_id = %s AND key = %s
-        """
-        with self.conn.cursor() as cur:
-            cur.execute(query, (chat.ai.id, key))
-            row = cur.fetchone()
-        return json.loads(row['content']) if row else None
+        rows = self.fetch(GET_STATE, (chat.ai.id, key))
+        return json.loads(rows[0]['content']) if rows else None
 
     def enum_state(self, chat: "Chat", prefix: str) -> list[tuple[str, State]]:
-        query = """
-            SELECT key, content FROM state
-            WHERE ai_id = %s AND key LIKE %s
-        """
-        with self.conn.cursor() as cur:
-            cur.execute(query, (chat.ai.id, prefix + '%'))
-            rows = cur.fetchall()
+        rows = self.fetch(ENUM_STATE, (chat.ai.id, prefix + '%'))
         return [(row['key'], json.loads(row['content'])) for row in rows]
 
+    def get_states(self, chat: "Chat", keys: list[str]) -> dict[str, State]:
+        rows = self.fetch(GET_STATES, (chat.ai.id, list(keys)))
+        return {row['key']: json.loads(row['content']) for row in rows}
+
+    def set_states(self, chat: "Chat", states: dict[str, State]):
+        rows = [(chat.ai.id, key, json.dumps(state)) for key, state in states.items()]
+        if rows:
+            self.run(lambda cur: execute_values(cur, SET_STATES, rows, template=SET_STATES_TEMPLATE))
+
     def set_glob(self, key: str, state: State):
-        self.set_state("<glob>", key, state)
+        self.execute(SET_STATE, ("<glob>", key, json.dumps(state)))
 
     def get_glob(self, key: str) -> State | None:
-        return self.get_state("<glob>", key)
+        rows = self.fetch(GET_STATE, ("<glob>", key))
+        return json.loads(rows[0]['content']) if rows else None
 
     def enum_glob(self, prefix: str) -> list[tuple[str, State]]:
-        return self.enum_state("<glob>", prefix)
+        rows = self.fetch(ENUM_STATE, ("<glob>", prefix + '%'))
+        return [(row['key'], json.loads(row['content'])) for row in rows]
+
+    def try_lock(self, name: str, owner: str) -> bool:
+        return bool(self.fetch(TRY_LOCK, (name, owner, self.lock_lease)))
+
+    def unlock(self, name: str, owner: str):
+        self.execute(UNLOCK, (name, owner))
+
+    @contextlib.contextmanager
+    def lock_thread(self, chat: "Chat", timeout: float | None = None):
+        """A lease row per thread, taken and dropped in short transactions, so no connection is held for the turn."""
+        name, owner = f"{chat.ai.id}:{chat.thread_id}", uuid()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0.005
+        while not self.try_lock(name, owner):
+            if deadline is not None and time.monotonic() + delay > deadline:
+                raise TimeoutError(f"thread {chat.thread_id} is locked")
+            time.sleep(delay)
+            delay = min(delay * 2, 0.2)
+        try:
+            yield
+        finally:
+            self.unlock(name, owner)
+
+    @contextlib.asynccontextmanager
+    async def alock_thread(self, chat: "Chat", timeout: float | None = None):
+        name, owner = f"{chat.ai.id}:{chat.thread_id}", uuid()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0.005
+        while not await self.afetch(TRY_LOCK, (name, owner, self.lock_lease)):
+            if deadline is not None and time.monotonic() + delay > deadline:
+                raise TimeoutError(f"thread {chat.thread_id} is locked")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.2)
+        try:
+            yield
+        finally:
+            await self.aexecute(UNLOCK, (name, owner))
+
+    async def get_apool(self):
+        if self.apool is None:
+            import asyncpg
+            self.apool = await asyncpg.create_pool(os.environ["POSTGRES_URL"])
+        return self.apool
+
+    async def afetch(self, query, params) -> list:
+        pool = await self.get_apool()
+        return await pool.fetch(asyncpg_query(query), *params)
+
+    async def aexecute(self, query, params):
+        pool = await self.get_apool()
+        await pool.execute(asyncpg_query(query), *params)
+
+    async def aget_messages(self, chat: "Chat", content: str, limit=20, before: Message | None = None):
+        rows = await self.afetch(*self.messages_query(chat, limit, before))
+        return [Message(**dict(row)) for row in rows]
+
+    async def aget_thread_messages(self, chat: "Chat", thread_ids: list[str],
+                                   limit=20) -> dict[str, list[Message]]:
+        out = {thread_id: [] for thread_id in thread_ids}
+        for row in await self.afetch(GET_THREAD_MESSAGES, (chat.ai.id, list(thread_ids), limit)):
+            out[row['thread_id']].append(Message(**dict(row)))
+        return out
+
+    async def aadd_message(self, message: "Message", chat: "Chat"):
+        await self.aexecute(ADD_MESSAGE, (chat.thread_id, chat.ai.id, 1,
+                                          message.id, message.role, message.content, chat.thread_id, chat.ai.id))
+
+    async def aadd_messages(self, messages: list["Message"], chat: "Chat"):
+        pool = await self.get_apool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                rows = []
+                for (thread_id, ai_id), group in self.thread_groups(messages, chat).items():
+                    last = await conn.fetchval(asyncpg_query(NEXT_SEQ), thread_id, ai_id, len(group))
+                    rows += self.message_rows(group, thread_id, ai_id, last)
+                await conn.executemany(asyncpg_query(ADD_MESSAGES % ADD_MESSAGES_TEMPLATE), rows)
+
+    async def aset_state(self, chat: "Chat", key: str, state: State):
+        await self.aexecute(SET_STATE, (chat.ai.id, key, json.dumps(state)))
+
+    async def aget_state(self, chat: "Chat", key: str) -> State | None:
+        rows = await self.afetch(GET_STATE, (chat.ai.id, key))
+        return json.loads(rows[0]['content']) if rows else None
+
+    async def aenum_state(self, chat: "Chat", prefix: str) -> list[tuple[str, State]]:
+        rows = await self.afetch(ENUM_STATE, (chat.ai.id, prefix + '%'))
+        return [(row['key'], json.loads(row['content'])) for row in rows]
+
+    async def aget_states(self, chat: "Chat", keys: list[str]) -> dict[str, State]:
+        rows = await self.afetch(GET_STATES, (chat.ai.id, list(keys)))
+        return {row['key']: json.loads(row['content']) for row in rows}
+
+    async def aset_states(self, chat: "Chat", states: dict[str, State]):
+        pool = await self.get_apool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.executemany(asyncpg_query(SET_STATE),
+                                       [(chat.ai.id, key, json.dumps(state)) for key, state in states.items()])
@@ -1,6 +1,11 @@
+import asyncio
+import contextlib
 import json
+import queue
 import sqlite3
+import threading
 import time
+from concurrent.futures import Future
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
@@ -8,16 +13,154 @@ if TYPE_CHECKING:
 
 from ai_chat.types import Message
 from ai_chat.store.base import Store, State
+from ai_chat.util import uuid
+
+# seq is the thread's next number, writes are serialized so nobody else can take it meanwhile
+ADD_MESSAGE = """
+    INSERT INTO messages (id, role, content, thread_id, ai_id, created_at, seq)
+    SELECT ?1, ?2, ?3, ?4, ?5, ?6, COALESCE(MAX(seq), 0) + 1 FROM messages WHERE thread_id = ?4 AND ai_id = ?5;
+"""
+
+MIGRATE_SEQ = """
+    UPDATE messages SET seq = (
+        SELECT rn FROM (
+            SELECT id, ROW_NUMBER() OVER (PARTITION BY thread_id, ai_id ORDER BY created_at, id) AS rn FROM messages
+        ) AS numbered WHERE numbered.id = messages.id
+    );
+"""
+
+# takes a thread's lock if it's free or its lease ran out
+TRY_LOCK = """
+    INSERT INTO locks (name, owner, expires_at) VALUES (?, ?, ?)
+    ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+    WHERE locks.expires_at < ?;
+"""
 
 
 class SqliteStore(Store):
-    """Sqlite message storage"""
+    """Sqlite message storage
+
+    By default one connection is shared across threads behind a lock, so the async methods can run in worker threads.
+
+    With wal=True (file databases only) the store is set up for multi-threaded services: WAL journaling, so readers
+    don't block the writer, each thread reads on its own connection, and all writes are queued to a single writer
+    thread that commits everything queued at that moment in one transaction.
+    """
+
+    # seconds a thread lock is held before others may take it, in case its process died holding it
+    lock_lease = 600.0
+
+    def __init__(self, db_path, *, wal=False, synchronous="NORMAL", busy_timeout=5000, max_batch=256):
+        self.db_path = db_path
+        self.wal = wal
+        self.synchronous = synchronous
+        self.busy_timeout = busy_timeout
+        self.max_batch = max_batch
+        self.lock = threading.RLock()
 
-    def __init__(self, db_path):
-        self.conn = sqlite3.connect(db_path)
-        self.conn.row_factory = sqlite3.Row
+        if wal and str(db_path) == ":memory:":
+            raise ValueError("wal mode needs a database file")
+
+        self.conn = self.connect(isolation_level=None if wal else "")
         self.create_tables()
 
+        if wal:
+            self.local = threading.local()
+            self.readers: list[sqlite3.Connection] = []
+            self.queue: queue.Queue = queue.Queue()
+            self.writer = threading.Thread(target=self.write_loop, name="sqlite-writer", daemon=True)
+            self.writer.start()
+
+    def connect(self, isolation_level="") -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=isolation_level)
+        conn.row_factory = sqlite3.Row
+        if self.wal:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={self.synchronous}")
+            conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout)}")
+        return conn
+
+    def reader(self) -> sqlite3.Connection:
+        """This thread's read connection."""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = self.connect()
+            conn.execute("PRAGMA query_only=1")
+            with self.lock:
+                self.readers.append(conn)
+        return conn
+
+    def fetch(self, query, params) -> list[sqlite3.Row]:
+        if self.wal:
+            return self.reader().execute(query, params).fetchall()
+        with self.lock:
+            return self.conn.execute(query, params).fetchall()
+
+    def execute(self, query, params):
+        self.execute_many(query, [params])
+
+    def execute_many(self, query, params_list):
+        """Run a statement for each set of params, in one transaction."""
+        if self.wal:
+            future = Future()
+            self.queue.put((query, params_list, future))
+            return future.result()
+        with self.lock:
+            try:
+                self.conn.executemany(query, params_list)
+            except Exception:
+                self.conn.rollback()
+                raise
+            self.conn.commit()
+
+    def write_loop(self):
+        while True:
+            jobs = [self.queue.get()]
+            while len(jobs) < self.max_batch:
+                try:
+                    jobs.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in jobs
+            self.commit_jobs([job for job in jobs if job is not None])
+            if stop:
+                return
+
+    def commit_jobs(self, jobs):
+        """Group commit: each job gets a savepoint, so one failing job doesn't undo the others."""
+        if not jobs:
+            return
+        errors = []
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+            for query, params_list, _ in jobs:
+                self.conn.execute("SAVEPOINT job")
+                try:
+                    self.conn.executemany(query, params_list)
+                    errors.append(None)
+                except Exception as e:
+                    self.conn.execute("ROLLBACK TO job")
+                    errors.append(e)
+                self.conn.execute("RELEASE job")
+            self.conn.execute("COMMIT")
+        except Exception as e:
+            if self.conn.in_transaction:
+                self.conn.execute("ROLLBACK")
+            errors = [e] * len(jobs)
+        for (_, _, future), error in zip(jobs, errors):
+            if error:
+                future.set_exception(error)
+            else:
+                future.set_result(None)
+
+    def close(self):
+        if self.wal:
+            self.queue.put(None)
+            self.writer.join()
+            for conn in self.readers:
+                conn.close()
+        self.conn.close()
+
     def create_tables(self):
         # Create the 'messages' table if it doesn't exist
         create_table_query = """
@@ -27,13 +170,24 @@ class SqliteStore(Store):
                 content TEXT,
                 thread_id TEXT,
                 ai_id TEXT,
-                created_at REAL
+                created_at REAL,
+                seq INTEGER
             );
             
             create index if not exists ix_messages_ai_id on messages(ai_id);
             create index if not exists ix_messages_thread_id on messages(thread_id);
             create index if not exists ix_messages_created_at on messages(created_at);
 
+            CREATE TABLE IF NOT EXISTS embeddings (
+                message_id TEXT PRIMARY KEY,
+                ai_id TEXT,
+                thread_id TEXT,
+                vector BLOB,
+                created_at REAL
+            );
+
+            create index if not exists ix_embeddings_thread_ai on embeddings(thread_id, ai_id, created_at);
+
             CREATE TABLE IF NOT EXISTS state (
                 ai_id TEXT,
                 key TEXT,
@@ -41,32 +195,141 @@ class SqliteStore(Store):
                 created_at REAL,
                 primary key (ai_id, key)
             );
- 
+
+            CREATE TABLE IF NOT EXISTS locks (
+                name TEXT PRIMARY KEY,
+                owner TEXT,
+                expires_at REAL
+            );
         """
-        self.conn.executescript(create_table_query)
-        self.conn.commit()
+        with self.lock:
+            self.conn.executescript(create_table_query)
+            self.migrate()
+            self.conn.commit()
+
+    def migrate(self):
+        """Number the messages of tables made before seq, in their created_at order."""
+        columns = [row["name"] for row in self.conn.execute("PRAGMA table_info(messages)")]
+        if "seq" not in columns:
+            self.conn.execute("ALTER TABLE messages ADD COLUMN seq INTEGER")
+            self.conn.execute(MIGRATE_SEQ)
+        self.conn.executescript("""
+            drop index if exists ix_messages_thread_ai_created;
+            create unique index if not exists ux_messages_thread_ai_seq on messages(thread_id, ai_id, seq);
+        """)
 
-    def get_messages(self, chat: "Chat", content: str, limit=20) -> list[Message]:
+    def get_messages(self, chat: "Chat", content: str, limit=20, before: Message | None = None) -> list[Message]:
         """Must return oldest to newest."""
+        where, params = "", [chat.thread_id, chat.ai.id]
+        if before is not None:
+            where = "AND seq < (SELECT seq FROM messages WHERE id = ?)"
+            params += [before.id]
         query = f"""
-            SELECT * FROM messages
-            WHERE thread_id = ? AND ai_id = ?
-            ORDER BY created_at DESC
-            LIMIT {limit};
+            SELECT * FROM (
+                SELECT * FROM messages
+                WHERE thread_id = ? AND ai_id = ? {where}
+                ORDER BY seq DESC
+                LIMIT ?
+            ) ORDER BY seq;
         """
-        params = (chat.thread_id, chat.ai.id)
-        rows = self.conn.execute(query, params).fetchall()
-        return [Message(**dict(row)) for row in sorted(rows, key=lambda row: row['created_at'])]
+        rows = self.fetch(query, params + [limit])
+        return [Message(**dict(row)) for row in rows]
+
+    def get_thread_messages(self, chat: "Chat", thread_ids: list[str], limit=20) -> dict[str, list[Message]]:
+        out = {thread_id: [] for thread_id in thread_ids}
+        for i in range(0, len(thread_ids), 500):
+            ids = thread_ids[i:i + 500]
+            query = f"""
+                SELECT id, role, content, thread_id, ai_id, created_at, seq FROM (
+                    SELECT *, ROW_NUMBER() OVER (PARTITION BY thread_id ORDER BY seq DESC) AS rn FROM messages
+                    WHERE ai_id = ? AND thread_id IN ({", ".join("?" * len(ids))})
+                ) WHERE rn <= ? ORDER BY thread_id, seq;
+            """
+            for row in self.fetch(query, [chat.ai.id, *ids, limit]):
+                out[row["thread_id"]].append(Message(**dict(row)))
+        return out
 
     def add_message(self, message: "Message", chat: "Chat"):
         """Add chat to db, must guarantee sort order somehow."""
+        params = (message.id, message.role, message.content, chat.thread_id, chat.ai.id, time.time())
+        self.execute(ADD_MESSAGE, params)
+
+    def add_messages(self, messages: list["Message"], chat: "Chat"):
+        """Add a chain of messages in one transaction, ordered as given."""
+        # each insert sees the ones before it in the transaction, so seq counts up through the chain
+        now = time.time()
+        params_list = [
+            (message.id, message.role, message.content, message.thread_id or chat.thread_id,
+             getattr(message, "ai_id", None) or chat.ai.id, now)
+            for message in messages
+        ]
+        self.execute_many(ADD_MESSAGE, params_list)
+
+    def try_lock(self, name: str, owner: str) -> bool:
+        now = time.time()
+        self.execute(TRY_LOCK, (name, owner, now + self.lock_lease, now))
+        rows = self.fetch("SELECT owner FROM locks WHERE name = ?", (name,))
+        return bool(rows) and rows[0]["owner"] == owner
+
+    def unlock(self, name: str, owner: str):
+        self.execute("DELETE FROM locks WHERE name = ? AND owner = ?", (name, owner))
+
+    @contextlib.contextmanager
+    def lock_thread(self, chat: "Chat", timeout: float | None = None):
+        """A lease row per thread, polled for with backoff, so processes sharing the file take turns."""
+        name, owner = f"{chat.ai.id}:{chat.thread_id}", uuid()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0.005
+        while not self.try_lock(name, owner):
+            if deadline is not None and time.monotonic() + delay > deadline:
+                raise TimeoutError(f"thread {chat.thread_id} is locked")
+            time.sleep(delay)
+            delay = min(delay * 2, 0.2)
+        try:
+            yield
+        finally:
+            self.unlock(name, owner)
+
+    @contextlib.asynccontextmanager
+    async def alock_thread(self, chat: "Chat", timeout: float | None = None):
+        name, owner = f"{chat.ai.id}:{chat.thread_id}", uuid()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0.005
+        while not await asyncio.to_thread(self.try_lock, name, owner):
+            if deadline is not None and time.monotonic() + delay > deadline:
+                raise TimeoutError(f"thread {chat.thread_id} is locked")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.2)
+        try:
+            yield
+        finally:
+            await asyncio.to_thread(self.unlock, name, owner)
+
+    def get_messages_by_id(self, chat: "Chat", ids: list[str]) -> list[Message]:
+        query = f"""
+            SELECT * FROM messages
+            WHERE thread_id = ? AND ai_id = ? AND id IN ({", ".join("?" * len(ids))})
+            ORDER BY seq;
+        """
+        rows = self.fetch(query, [chat.thread_id, chat.ai.id, *ids])
+        return [Message(**dict(row)) for row in rows]
+
+    def add_embeddings(self, chat: "Chat", rows: list[tuple[str, bytes]]):
         query = """
-            INSERT INTO messages (id, role, content, thread_id, ai_id, created_at)
-            VALUES (?, ?, ?, ?, ?, ?);
+            INSERT OR REPLACE INTO embeddings (message_id, ai_id, thread_id, vector, created_at)
+            VALUES (?, ?, ?, ?, ?);
         """
-        params = (message.id, message.role, message.content, chat.thread_id, chat.ai.id, time.time())
-        self.conn.execute(query, params)
-        self.conn.commit()
+        now = time.time()
+        self.execute_many(query, [(id, chat.ai.id, chat.thread_id, vector, now + i * 1e-6)
+                                  for i, (id, vector) in enumerate(rows)])
+
+    def get_embeddings(self, chat: "Chat") -> list[tuple[str, bytes]]:
+        query = """
+            SELECT message_id, vector FROM embeddings
+             WHERE thread_id = ? and ai_id = ?
+             ORDER BY created_at
+        """
+        return [(row['message_id'], row['vector']) for row in self.fetch(query, (chat.thread_id, chat.ai.id))]
 
     def set_state(self, chat: "Chat", key: str, state: "State"):
         """Add state to db, this is generally 'across chats'."""
@@ -75,8 +338,7 @@ class SqliteStore(Store):
             VALUES (?, ?, ?, ?);
         """
         params = (key, json.dumps(state), chat.ai.id, time.time())
-        self.conn.execute(query, params)
-        self.conn.commit()
+        self.execute(query, params)
 
     def get_state(self, chat: "Chat", key: str) -> State | None:
         """Add state to db, this is generally 'across chats'."""
@@ -85,21 +347,39 @@ class SqliteStore(Store):
              WHERE key = ? and ai_id = ?
         """
         params = (key, chat.ai.id)
-        if rows := self.conn.execute(query, params).fetchall():
+        if rows := self.fetch(query, params):
             return json.loads(rows[0]['content'])
         return None
 
     def enum_state(self, chat: "Chat", prefix: str) -> list[tuple[str, State]]:
         """Add state to db, this is generally 'across chats'."""
         query = """
-            SELECT content from  state
+            SELECT key, content from  state
              WHERE key like ? and ai_id = ?
         """
         params = (prefix + "%", chat.ai.id)
-        if rows := self.conn.execute(query, params).fetchall():
+        if rows := self.fetch(query, params):
             return [(row['key'], json.loads(row['content'])) for row in rows]
         return []
 
+    def get_states(self, chat: "Chat", keys: list[str]) -> dict[str, State]:
+        if not keys:
+            return {}
+        query = f"""
+            SELECT key, content from state
+             WHERE ai_id = ? and key IN ({", ".join("?" * len(keys))})
+        """
+        return {row['key']: json.loads(row['content']) for row in self.fetch(query, [chat.ai.id, *keys])}
+
+    def set_states(self, chat: "Chat", states: dict[str, State]):
+        """All keys in one transaction."""
+        query = """
+            INSERT OR REPLACE INTO state (key, content, ai_id, created_at)
+            VALUES (?, ?, ?, ?);
+        """
+        now = time.time()
+        self.execute_many(query, [(key, json.dumps(state), chat.ai.id, now) for key, state in states.items()])
+
     def set_glob(self, key: str, state: "State"):
         """Add state to db, this is generally 'across chats'."""
         query = """
@@ -107,8 +387,7 @@ class SqliteStore(Store):
             VALUES (?, ?, ?, ?);
         """
         params = (key, json.dumps(state), "<glob>", time.time())
-        self.conn.execute(query, params)
-        self.conn.commit()
+        self.execute(query, params)
 
     def get_glob(self, key: str) -> State | None:
         """Add state to db, this is generally 'across chats'."""
@@ -117,18 +396,18 @@ class SqliteStore(Store):
              WHERE key = ? and ai_id = ?
         """
         params = (key, "<glob>")
-        if rows := self.conn.execute(query, params).fetchall():
+        if rows := self.fetch(query, params):
             return json.loads(rows[0]['content'])
         return None
 
     def enum_glob(self, prefix: str) -> list[tuple[str, State]]:
         """Add state to db, this is generally 'across chats'."""
         query = """
-            SELECT content from  state
+            SELECT key, content from  state
              WHERE key like ? and ai_id = ?
         """
         params = (prefix + "%", "<glob>")
-        if rows := self.conn.execute(query, params).fetchall():
+        if rows := self.fetch(query, params):
             return [(row['key'], json.loads(row['content'])) for row in rows]
         return []
 
@@ -21,12 +21,41 @@ class SupabaseStore(Store):
         thread_id text not null,
         role text not null,
         content text not null,
+        seq bigint
         );
 
     create index ix_messages_ai_id on messages(ai_id);
     create index ix_messages_thread_id on messages(thread_id);
     create index ix_messages_created_at on messages(created_at);
 
+    -- seq numbers each thread's messages in insert order, rows of one insert are numbered in the order sent
+    CREATE TABLE message_seqs (
+        thread_id text not null,
+        ai_id text not null,
+        seq bigint not null,
+        primary key (thread_id, ai_id)
+        );
+
+    create function next_message_seq() returns trigger as $$
+    begin
+        insert into message_seqs (thread_id, ai_id, seq) values (new.thread_id, new.ai_id, 1)
+        on conflict (thread_id, ai_id) do update set seq = message_seqs.seq + 1
+        returning seq into new.seq;
+        return new;
+    end $$ language plpgsql;
+
+    create trigger messages_seq before insert on messages for each row execute function next_message_seq();
+
+    -- for a messages table made before seq, run this before creating the trigger and index
+    alter table messages add column seq bigint;
+    update messages set seq = numbered.rn from (
+        select id, row_number() over (partition by thread_id, ai_id order by created_at, id) as rn from messages
+        ) as numbered where messages.id = numbered.id;
+    insert into message_seqs select thread_id, ai_id, max(seq) from messages group by thread_id, ai_id;
+    drop index if exists ix_messages_thread_ai_created;
+
+    create unique index ux_messages_thread_ai_seq on messages(thread_id, ai_id, seq);
+
     CREATE TABLE state (
         ai_id text not null,
         key text,
@@ -36,22 +65,48 @@ class SupabaseStore(Store):
         );
     """
 
-    def __init__(self, conn: Client | None = None):
+    def __init__(self, conn: Client | None = None, aconn=None):
         if conn is None:
             url: str = os.environ["SUPABASE_URL"]
             key: str = os.environ["SUPABASE_KEY"]
             conn = Client(url, key)
         self.conn = conn
-
-    def get_messages(self, chat: "Chat", content: str, limit=20):
+        # supabase AsyncClient, made on first use by the async methods
+        self.aconn = aconn
+
+    @staticmethod
+    def messages_query(conn, chat: "Chat", limit, before_seq: int | None):
+        """Newest first, so the limit keeps the latest rows."""
+        query = conn.table('messages').select('*').eq('thread_id', chat.thread_id).eq('ai_id', chat.ai.id)
+        if before_seq is not None:
+            query = query.lt('seq', before_seq)
+        return query.order('seq', desc=True).limit(limit)
+
+    @staticmethod
+    def seq_query(conn, before: Message):
+        """The stored seq of `before`, messages built in memory don't carry one."""
+        return conn.table('messages').select('seq').eq('id', before.id).limit(1)
+
+    def get_messages(self, chat: "Chat", content: str, limit=20, before: Message | None = None):
         """Must return oldest to newest."""
-
-        return [Message(**ent) for ent in sorted(self.conn.table('messages').select(
-            '*').eq('thread_id', chat.thread_id).eq('ai_id', chat.ai.id).order(
-            'created_at.desc').limit(limit).execute().data, key=lambda row: row['created_at'])]
+        before_seq = None
+        if before is not None:
+            before_seq = getattr(before, "seq", None)
+            if before_seq is None:
+                rows = self.seq_query(self.conn, before).execute().data
+                if not rows:
+                    return []
+                before_seq = rows[0]['seq']
+        rows = self.messages_query(self.conn, chat, limit, before_seq).execute().data
+        return [Message(**ent) for ent in reversed(rows)]
+
+    def get_messages_by_id(self, chat: "Chat", ids: list[str]) -> list[Message]:
+        rows = self.conn.table('messages').select('*').eq('thread_id', chat.thread_id).eq('ai_id', chat.ai.id) \
+            .in_('id', list(ids)).order('seq').execute().data
+        return [Message(**ent) for ent in rows]
 
     def add_message(self, message: "Message", chat: "Chat"):
-        """Add chat to db, must guarantee sort order somehow."""
+        """Add chat to db, the seq trigger orders it after the thread's other messages."""
 
         assert message.ai_id == chat.ai.id
         assert message.thread_id == chat.thread_id
@@ -66,6 +121,24 @@ class SupabaseStore(Store):
 
         self.conn.table('messages').insert(data).execute()
 
+    def add_messages(self, messages: list["Message"], chat: "Chat"):
+        """Add a chain of messages with one request."""
+        self.conn.table('messages').insert(self.message_rows(messages, chat)).execute()
+
+    @staticmethod
+    def message_rows(messages: list["Message"], chat: "Chat") -> list[dict]:
+        # the seq trigger numbers the rows in the order they're sent
+        return [
+            dict(
+                id=message.id,
+                role=message.role,
+                content=message.content,
+                thread_id=message.thread_id or chat.thread_id,
+                ai_id=getattr(message, "ai_id", None) or chat.ai.id,
+            )
+            for message in messages
+        ]
+
     def set_state(self, chat: "Chat", key: str, state: State):
         data = dict(
             ai_id=chat.ai.id,
@@ -80,9 +153,23 @@ class SupabaseStore(Store):
             return json.loads(res.data[0]['content'])
 
     def enum_state(self, chat: "Chat", prefix: str) -> list[tuple[str, State]]:
-        res = self.conn.table('state').select('content').eq('ai_id', chat.ai.id).like('key', prefix + '%').execute()
+        res = self.conn.table('state').select('key, content').eq('ai_id', chat.ai.id).like('key', prefix + '%').execute()
         if res and res.data:
             return [(row['key'], json.loads(row['content'])) for row in res.data]
+        return []
+
+    def get_states(self, chat: "Chat", keys: list[str]) -> dict[str, State]:
+        res = self.conn.table('state').select('key, content').eq('ai_id', chat.ai.id).in_('key', list(keys)).execute()
+        return {row['key']: json.loads(row['content']) for row in res.data} if res and res.data else {}
+
+    def set_states(self, chat: "Chat", states: dict[str, State]):
+        """All keys with one request."""
+        if states:
+            self.conn.table('state').upsert(self.state_rows(chat.ai.id, states)).execute()
+
+    @staticmethod
+    def state_rows(ai_id: str, states: dict[str, State]) -> list[dict]:
+        return [dict(ai_id=ai_id, key=key, content=json.dumps(state)) for key, state in states.items()]
 
     def set_glob(self, key: str, state: State):
         data = dict(
@@ -100,4 +187,68 @@ class SupabaseStore(Store):
     def enum_glob(self, prefix: str) -> list[tuple[str, State]]:
         res = self.conn.table('state').select('key, content').eq('ai_id', "<glob>").like('key', prefix + '%').execute()
         if res and res.data:
-            return [(row['key'], json.loads(row['content'])) for row in res.data]
\ No newline at end of file
+            return [(row['key'], json.loads(row['content'])) for row in res.data]
+        return []
+
+    async def get_aconn(self):
+        if self.aconn is None:
+            from supabase import acreate_client
+            self.aconn = await acreate_client(os.environ["SUPABASE_URL"], os.environ["SUPABASE_KEY"])
+        return self.aconn
+
+    async def aget_messages(self, chat: "Chat", content: str, limit=20, before: Message | None = None):
+        conn = await self.get_aconn()
+        before_seq = None
+        if before is not None:
+            before_seq = getattr(before, "seq", None)
+            if before_seq is None:
+                res = await self.seq_query(conn, before).execute()
+                if not res.data:
+                    return []
+                before_seq = res.data[0]['seq']
+        res = await self.messages_query(conn, chat, limit, before_seq).execute()
+        return [Message(**ent) for ent in reversed(res.data)]
+
+    async def aadd_message(self, message: "Message", chat: "Chat"):
+        assert message.ai_id == chat.ai.id
+        assert message.thread_id == chat.thread_id
+
+        data = dict(
+            id=message.id,
+            role=message.role,
+            content=message.content,
+            thread_id=message.thread_id,
+            ai_id=chat.ai.id
+        )
+
+        conn = await self.get_aconn()
+        await conn.table('messages').insert(data).execute()
+
+    async def aadd_messages(self, messages: list["Message"], chat: "Chat"):
+        conn = await self.get_aconn()
+        await conn.table('messages').insert(self.message_rows(messages, chat)).execute()
+
+    async def aset_state(self, chat: "Chat", key: str, state: State):
+        data = dict(
+            ai_id=chat.ai.id,
+            key=key,
+            content=json.dumps(state),
+        )
+        conn = await self.get_aconn()
+        await conn.table('state').upsert(data).execute()
+
+    async def aget_state(self, chat: "Chat", key: str) -> State | None:
+        conn = await self.get_aconn()
+        res = await conn.table('state').select('content').eq('ai_id', chat.ai.id).eq('key', key).execute()
+        if res and res.data:
+            return json.loads(res.data[0]['content'])
+
+    async def aget_states(self, chat: "Chat", keys: list[str]) -> dict[str, State]:
+        conn = await self.get_aconn()
+        res = await conn.table('state').select('key, content').eq('ai_id', chat.ai.id).in_('key', list(keys)).execute()
+        return {row['key']: json.loads(row['content']) for row in res.data} if res and res.data else {}
+
+    async def aset_states(self, chat: "Chat", states: dict[str, State]):
+        if states:
+            conn = await self.get_aconn()
+            await conn.table('state').upsert(self.state_rows(chat.ai.id, states)).execute()
@@ -0,0 +1,171 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    import numpy as np
+
+    from ai_chat.chat import Chat
+
+from ai_chat.types import Message
+from ai_chat.store.base import Store, WrappedStore, thread_chat
+
+# list of texts -> (len(texts), dim) float array
+Embedder = Callable[[list[str]], "np.ndarray"]
+
+
+class HashingEmbedder:
+    """Deterministic bag-of-words embedder, no model needed. Good for tests and keyword-ish recall."""
+
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    def __call__(self, texts: list[str]) -> "np.ndarray":
+        import numpy as np
+
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in re.findall(r"\w+", text.lower()):
+                digest = hashlib.blake2b(word.encode(), digest_size=8).digest()
+                bucket = int.from_bytes(digest[:4], "little") % self.dim
+                out[row, bucket] += 1.0 if digest[4] & 1 else -1.0
+        return out
+
+
+class ThreadIndex:
+    """Unit vectors of one thread's messages, grown in place as messages are added."""
+
+    def __init__(self, dim: int):
+        import numpy as np
+
+        self.ids: list[str] = []
+        self.rows: dict[str, int] = {}
+        self.matrix = np.zeros((16, dim), dtype=np.float32)
+
+    def add(self, ids: list[str], vectors: "np.ndarray"):
+        import numpy as np
+
+        need = len(self.ids) + len(ids)
+        if need > len(self.matrix):
+            grown = np.zeros((max(need, 2 * len(self.matrix)), self.matrix.shape[1]), dtype=np.float32)
+            grown[:len(self.ids)] = self.matrix[:len(self.ids)]
+            self.matrix = grown
+        self.matrix[len(self.ids):need] = vectors
+        self.rows.update((id, len(self.ids) + i) for i, id in enumerate(ids))
+        self.ids.extend(ids)
+
+    def search(self, query: "np.ndarray", k: int, exclude: set[str], min_score: float) -> list[str]:
+        """Ids of the top k rows by cosine similarity, best first."""
+        import numpy as np
+
+        scores = self.matrix[:len(self.ids)] @ query
+        skip = [self.rows[id] for id in exclude if id in self.rows]
+        scores[skip] = -np.inf
+        k = min(k, len(self.ids) - len(skip))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [self.ids[i] for i in top if scores[i] > min_score]
+
+
+def normalize(vectors: "np.ndarray") -> "np.ndarray":
+    import numpy as np
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+class VectorRecallStore(WrappedStore):
+    """Query-aware history: the last `recent` messages, plus older messages most similar to the new content.
+
+    User and assistant messages are embedded on add, and the vectors are saved with the wrapped store's
+    add_embeddings (a table in SqliteStore and PostgresStore, a state key per message elsewhere). Each thread's
+    vectors are loaded once into a matrix, which then grows as messages are added, and is searched with a single
+    matrix-vector product. Requires numpy, the "vector" extra, imported when first used.
+    """
+
+    ROLES = ("user", "assistant")
+
+    def __init__(self, store: Store, embedder: Embedder | None = None, recent=6, min_score=0.1, max_threads=1000):
+        super().__init__(store)
+        self.embedder = embedder or HashingEmbedder()
+        self.recent = recent
+        self.min_score = min_score
+        self.max_threads = max_threads
+        self.threads: OrderedDict[tuple[str, str], ThreadIndex] = OrderedDict()
+        self.lock = threading.RLock()
+
+    def load(self, chat: "Chat") -> ThreadIndex | None:
+        import numpy as np
+
+        key = (chat.ai.id, chat.thread_id)
+        with self.lock:
+            if (index := self.threads.get(key)) is not None:
+                self.threads.move_to_end(key)
+                return index
+        rows = self.store.get_embeddings(chat)
+        if not rows:
+            return None
+        vectors = np.stack([np.frombuffer(vector, dtype=np.float32) for _, vector in rows])
+        index = ThreadIndex(vectors.shape[1])
+        index.add([id for id, _ in rows], vectors)
+        with self.lock:
+            self.threads[key] = index
+            while len(self.threads) > self.max_threads:
+                self.threads.popitem(last=False)
+        return index
+
+    def get_messages(self, chat: "Chat", content: str, limit=20, before: Message | None = None) -> list[Message]:
+        if before is not None or not content:
+            return self.store.get_messages(chat, content, limit, before)
+
+        recent = self.store.get_messages(chat, content, min(self.recent, limit))
+        index = self.load(chat)
+        if index is None or len(recent) < min(self.recent, limit):
+            return recent
+
+        query = normalize(self.embedder([content]))[0]
+        with self.lock:
+            ids = index.search(query, limit - len(recent), {m.id for m in recent}, self.min_score)
+        if not ids:
+            return recent
+        # recalled messages are all older than the recent window, so they go first
+        return self.store.get_messages_by_id(chat, ids) + recent
+
+    def embed(self, messages: list[Message], chat: "Chat"):
+        messages = [m for m in messages if m.role in self.ROLES and m.content]
+        if not messages:
+            return
+        vectors = normalize(self.embedder([m.content for m in messages]))
+        ids = [m.id for m in messages]
+        self.store.add_embeddings(chat, [(id, vector.tobytes()) for id, vector in zip(ids, vectors)])
+        with self.lock:
+            if (index := self.threads.get((chat.ai.id, chat.thread_id))) is not None:
+                index.add(ids, vectors)
+
+    def add_message(self, message: "Message", chat: "Chat"):
+        self.store.add_message(message, chat)
+        self.embed([message], chat)
+
+    def add_messages(self, messages: list["Message"], chat: "Chat"):
+        self.store.add_messages(messages, chat)
+        # a bulk write can span threads, see Chat.chat_many
+        threads: dict[str, list[Message]] = {}
+        for message in messages:
+            threads.setdefault(message.thread_id or chat.thread_id, []).append(message)
+        for thread_id, group in threads.items():
+            self.embed(group, chat if thread_id == chat.thread_id else thread_chat(chat, thread_id))
+
+    async def aget_messages(self, chat: "Chat", content: str, limit=20,
+                            before: Message | None = None) -> list[Message]:
+        return await Store.aget_messages(self, chat, content, limit, before)
+
+    async def aadd_message(self, message: "Message", chat: "Chat"):
+        await Store.aadd_message(self, message, chat)
+
+    async def aadd_messages(self, messages: list["Message"], chat: "Chat"):
+        await Store.aadd_messages(self, messages, chat)
@@ -0,0 +1,137 @@
+import copy
+import hashlib
+import math
+import re
+import threading
+from collections import Counter, OrderedDict
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    from ai_chat.chat import Chat
+
+from ai_chat.types import AIFunctions
+from ai_chat.schema import function_schema
+
+
+STOPWORDS = set("a an and are as at be by can do for from how i in is it me my of on or please s t that the "
+                "this to was what when where which who why will with you your".split())
+
+
+def words(text: str) -> list[str]:
+    # split snake_case and camelCase names into words too
+    text = re.sub(r"([a-z])([A-Z])", r"\1 \2", text or "")
+    return [w for w in re.findall(r"[a-z0-9]+", text.lower()) if w not in STOPWORDS]
+
+
+def function_text(schema: dict) -> str:
+    params = schema.get("parameters", {}).get("properties", {})
+    parts = [schema["name"], schema.get("description", "")]
+    for name, param in params.items():
+        parts += [name, param.get("description", "")]
+    return " ".join(parts)
+
+
+class KeywordIndex:
+    """tf-idf over each function's name, description and parameter docs."""
+
+    def __init__(self, schemas: list[dict]):
+        self.names = [s["name"] for s in schemas]
+        docs = [Counter(words(function_text(s))) for s in schemas]
+        df = Counter(word for doc in docs for word in doc)
+        self.terms: dict[str, list[tuple[int, float]]] = {}
+        for i, doc in enumerate(docs):
+            for word, tf in doc.items():
+                idf = math.log(1 + len(docs) / df[word])
+                self.terms.setdefault(word, []).append((i, (1 + math.log(tf)) * idf))
+
+    def scores(self, content: str) -> list[float]:
+        scores = [0.0] * len(self.names)
+        for word in set(words(content)):
+            for i, weight in self.terms.get(word, ()):
+                scores[i] += weight
+        return scores
+
+
+class EmbeddingIndex:
+    """Cosine similarity to each function's embedded description, embedded once per function set."""
+
+    def __init__(self, schemas: list[dict], embedder: Callable):
+        from ai_chat.store.vector import normalize
+
+        self.names = [s["name"] for s in schemas]
+        self.embedder = embedder
+        self.normalize = normalize
+        self.matrix = normalize(embedder([function_text(s) for s in schemas]))
+
+    def scores(self, content: str) -> list[float]:
+        query = self.normalize(self.embedder([content]))[0]
+        return (self.matrix @ query).tolist()
+
+
+class ToolSelector:
+    """Sends only the functions relevant to the turn, set as AiConfig(tool_selector=...).
+
+    Functions are scored against the user's message, and the best `top_k` are sent along with the `pinned`
+    ones. Scoring uses a keyword index, or an `embedder` (see ai_chat.store.vector) if given. Selections are
+    deterministic, and cached per function set and message. Calls to functions that weren't sent still run.
+    """
+
+    def __init__(self, top_k=8, pinned: list[str] = (), embedder: Callable | None = None, min_score=0.0,
+                 max_cache=1000):
+        self.top_k = top_k
+        self.pinned = set(pinned)
+        self.embedder = embedder
+        self.min_score = min_score
+        self.max_cache = max_cache
+        self.indexes: OrderedDict[str, KeywordIndex | EmbeddingIndex] = OrderedDict()
+        self.selections: OrderedDict[tuple[str, str], tuple[AIFunctions, int]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+
+    def stats(self) -> dict:
+        return dict(hits=self.hits, misses=self.misses, saved_tokens=self.saved_tokens)
+
+    def index(self, digest: str, schemas: list[dict]):
+        with self.lock:
+            if (index := self.indexes.get(digest)) is not None:
+                return index
+        index = EmbeddingIndex(schemas, self.embedder) if self.embedder else KeywordIndex(schemas)
+        with self.lock:
+            self.indexes[digest] = index
+            while len(self.indexes) > 16:
+                self.indexes.popitem(last=False)
+        return index
+
+    def rank(self, index, content: str) -> list[str]:
+        scores = index.scores(content)
+        order = sorted(range(len(scores)), key=lambda i: (-scores[i], i))
+        return [index.names[i] for i in order[:self.top_k] if scores[i] > self.min_score]
+
+    def select(self, chat: "Chat", functions: AIFunctions, content: str) -> AIFunctions:
+        if len(functions.map) <= self.top_k + len(self.pinned):
+            return functions
+        schema = function_schema(functions)
+        key = (schema.digest, hashlib.sha256(content.encode()).hexdigest())
+        with self.lock:
+            if (ent := self.selections.get(key)) is not None:
+                self.selections.move_to_end(key)
+                self.hits += 1
+                self.saved_tokens += ent[1]
+                return ent[0]
+
+        names = set(self.rank(self.index(schema.digest, schema.functions), content)) | self.pinned
+        selected = copy.copy(functions)
+        # keep registration order, so the schema sent is stable
+        selected.map = {name: func for name, func in functions.map.items() if name in names}
+
+        counter = chat.ai.token_counter
+        saved = counter.count(schema.data.decode()) - counter.count(function_schema(selected).data.decode())
+        with self.lock:
+            self.misses += 1
+            self.saved_tokens += saved
+            self.selections[key] = (selected, saved)
+            while len(self.selections) > self.max_cache:
+                self.selections.popitem(last=False)
+        return selected
@@ -1,9 +1,20 @@
 import dataclasses
+from typing import TYPE_CHECKING
 
 from ai_chat.defaults import DEFAULT_CHAT_MODEL, DEFAULT_TEMPERATURE, DEFAULT_MAX_TOKENS, DEFAULT_ERROR_PREFIX
+from ai_chat.prompt import TokenCounter, Tokenizer
 
 from ai_functions import AIFunctions
 
+if TYPE_CHECKING:
+    from ai_chat.compact import Compactor
+    from ai_chat.cache import CompletionCache
+    from ai_chat.tools import ToolSelector
+    from ai_chat.hedge import Hedger
+    from ai_chat.instrument import Instrument, TurnStats
+    from ai_chat.limits import AdmissionController
+    from ai_chat.locks import TurnLock
+
 
 class AiConfig:
     """Persona and configuration"""
@@ -12,7 +23,12 @@ class AiConfig:
     error_prefix: str
 
     def __init__(self, *, id, system, error_prefix=DEFAULT_ERROR_PREFIX, functions: AIFunctions = None,
-                 model_params=None, seed_chat=None, max_prompt=10000, **data):
+                 model_params=None, seed_chat=None, max_prompt=10000, tokenizer: Tokenizer = None, parallel_tools=False, tool_workers=4,
+                 compactor: "Compactor" = None, summary_model_params=None,
+                 completion_cache: "CompletionCache" = None, tool_selector: "ToolSelector" = None,
+                 hedger: "Hedger" = None, instruments: list["Instrument"] = None, max_hops=16,
+                 turn_deadline: float = None, turn_token_budget: int = None,
+                 admission: "AdmissionController" = None, priority=0, turn_lock: "TurnLock" = None, **data):
         self.__dict__ = data
         self.id = id
         self.system = system
@@ -20,6 +36,31 @@ class AiConfig:
         self.functions = functions
         self.seed_chat: list[list] = seed_chat
         self.max_prompt = max_prompt
+        # shared by all sessions for this persona, so cached counts survive across turns
+        self.token_counter = TokenCounter(tokenizer)
+        # send functions as openai "tools", so one reply can carry several calls
+        self.parallel_tools = parallel_tools
+        self.tool_workers = tool_workers
+        # folds old history into a stored summary, and the (cheaper) model params used to write it
+        self.compactor = compactor
+        self.summary_model_params = summary_model_params or {}
+        # replays identical deterministic completions, see ai_chat.cache
+        self.completion_cache = completion_cache
+        # sends only the functions relevant to each turn
+        self.tool_selector = tool_selector
+        # duplicates slow completion requests, used by OpenaiChat
+        self.hedger = hedger
+        # stage timing and usage hooks, see ai_chat.instrument
+        self.instruments = instruments or []
+        # bounds on the function call loop of one turn: hops, seconds, and prompt tokens sent
+        self.max_hops = max_hops
+        self.turn_deadline = turn_deadline
+        self.turn_token_budget = turn_token_budget
+        # shared rate limits on completions, and this persona's place in their queue (higher goes first)
+        self.admission = admission
+        self.priority = priority
+        # one turn at a time per thread, optionally merging messages that arrive meanwhile
+        self.turn_lock = turn_lock
         self.model_params = {
             **dict(model=DEFAULT_CHAT_MODEL, temperature=DEFAULT_TEMPERATURE, max_tokens=DEFAULT_MAX_TOKENS),
             **(model_params or {})}
@@ -54,3 +95,4 @@ class ChatResponse:
     request_id: str
     response_id: str
     content: str
+    stats: "TurnStats | None" = None
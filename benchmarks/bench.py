@@ -0,0 +1,170 @@
+"""Chat and store benchmarks, with a stub model so no network is needed.
+
+    python -m benchmarks [--quick] [--stores memory,sqlite,sqlite-wal,postgres] [--out results.json]
+
+PostgresStore is included when POSTGRES_URL points at a server.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Annotated
+
+from ai_chat import AiConfig, Chat, Function
+from ai_chat.instrument import Instrument
+from ai_chat.store import MemoryStore, SqliteStore
+from ai_chat.types import AIFunctions, Message
+from ai_chat.util import uuid
+
+FULL = dict(history=[0, 20, 200], hops=[0, 1, 3], threads=[1, 8], size=[100, 4000], turns=200)
+QUICK = dict(history=[0, 20], hops=[0, 2], threads=[1, 4], size=[100], turns=20)
+
+
+class BenchChat(Chat):
+    """Replies instantly, after `hops` function calls."""
+
+    hops = 0
+    size = 100
+
+    def chat_complete(self, prompt, functions):
+        called = sum(1 for p in prompt[-self.hops:] if p["role"] == "function") if self.hops else 0
+        if called < self.hops:
+            return "function_call", None, Function(name="echo", arguments=json.dumps(dict(text="x" * 20)))
+        return "assistant", "r" * self.size, None
+
+
+def echo(text: Annotated[str, "text to echo"], **kws):
+    """Echo the text"""
+    return text
+
+
+class StageRecorder(Instrument):
+    def __init__(self):
+        self.stages: dict[str, list[float]] = {}
+
+    def on_stage(self, chat, name, seconds):
+        self.stages.setdefault(name, []).append(seconds)
+
+    def on_turn(self, chat, stats):
+        self.stages.setdefault("turn", []).append(stats.seconds)
+
+    def summary(self) -> dict:
+        out = {}
+        for name, samples in sorted(self.stages.items()):
+            samples = sorted(samples)
+            out[name] = dict(
+                count=len(samples),
+                mean_ms=1000 * statistics.fmean(samples),
+                p50_ms=1000 * samples[len(samples) // 2],
+                p95_ms=1000 * samples[min(len(samples) - 1, int(0.95 * len(samples)))],
+            )
+        return out
+
+
+def make_stores(names: list[str], tmp: str) -> dict:
+    stores = {}
+    for name in names:
+        if name == "memory":
+            stores[name] = MemoryStore
+        elif name == "sqlite":
+            stores[name] = lambda: SqliteStore(os.path.join(tmp, uuid() + ".db"))
+        elif name == "sqlite-wal":
+            stores[name] = lambda: SqliteStore(os.path.join(tmp, uuid() + ".db"), wal=True)
+        elif name == "postgres" and os.environ.get("POSTGRES_URL"):
+            from ai_chat.store import PostgresStore
+
+            def postgres():
+                store = PostgresStore(maxconn=16)
+                store.create()
+                return store
+
+            stores[name] = postgres
+    return stores
+
+
+def seed(store, chat: Chat, count: int, size: int):
+    messages = [Message(id=uuid(), role=("user", "assistant")[i % 2], content="s" * size,
+                        thread_id=chat.thread_id, ai_id=chat.ai.id) for i in range(count)]
+    for i in range(0, len(messages), 100):
+        store.add_messages(messages[i:i + 100], chat)
+
+
+def run_case(make_store, *, history: int, hops: int, threads: int, size: int, turns: int) -> dict:
+    store = make_store()
+    recorder = StageRecorder()
+    # a fresh persona per case, so runs against a shared database don't see each other
+    ai = AiConfig(id="bench-" + uuid(), system="You are a benchmark.", functions=AIFunctions([echo]),
+                  max_prompt=None, instruments=[recorder])
+
+    chats = []
+    for t in range(threads):
+        chat = BenchChat(ai=ai, thread_id=f"thread-{t}", store=store)
+        chat.hops, chat.size, chat.history_limit = hops, size, max(history, 1)
+        seed(store, chat, history, size)
+        chats.append(chat)
+
+    def worker(chat: BenchChat):
+        for _ in range(turns // threads):
+            chat.chat("q" * size)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(worker, chats))
+    seconds = time.perf_counter() - started
+
+    if close := getattr(store, "close", None):
+        close()
+    done = turns // threads * threads
+    return dict(turns=done, seconds=seconds, turns_per_sec=done / seconds, stages=recorder.summary())
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(stores: list[str], matrix: dict) -> dict:
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, make_store in make_stores(stores, tmp).items():
+            for history, hops, threads, size in itertools.product(
+                    matrix["history"], matrix["hops"], matrix["threads"], matrix["size"]):
+                params = dict(history=history, hops=hops, threads=threads, size=size)
+                result = run_case(make_store, turns=matrix["turns"], **params)
+                results.append(dict(store=name, **params, **result))
+                print(f"{name:10} {json.dumps(params)} {result['turns_per_sec']:10.1f} turns/s", file=sys.stderr)
+    return dict(
+        meta=dict(time=time.time(), python=platform.python_version(), platform=platform.platform(),
+                  revision=git_revision(), matrix=matrix),
+        results=results,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=__doc__.splitlines()[0])
+    parser.add_argument("--stores", default="memory,sqlite,sqlite-wal,postgres")
+    parser.add_argument("--quick", action="store_true", help="small matrix, for a smoke test")
+    parser.add_argument("--turns", type=int, help="turns per case")
+    parser.add_argument("--out", help="write JSON here instead of stdout")
+    args = parser.parse_args(argv)
+
+    matrix = dict(QUICK if args.quick else FULL)
+    if args.turns:
+        matrix["turns"] = args.turns
+    report = run(args.stores.split(","), matrix)
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+    return report
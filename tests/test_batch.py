@@ -0,0 +1,85 @@
+import asyncio
+import time
+
+from ai_chat import AiConfig
+from ai_chat.limits import RateLimiter, TokenBucket
+from ai_chat.store import MemoryStore, SqliteStore
+from tests.test_chat import MockChat
+
+
+class EchoChat(MockChat):
+    def chat_complete(self, prompt, functions):
+        if prompt[-1]["content"] == "fail":
+            raise ValueError("upstream error")
+        time.sleep(0.05)
+        # the reply shows how much history the model saw
+        return "assistant", f"{prompt[-1]['content']} after {len(prompt) - 2}", None
+
+
+class CountingStore(MemoryStore):
+    def __init__(self):
+        super().__init__()
+        self.reads = 0
+        self.writes = 0
+
+    def get_messages(self, *args, **kws):
+        self.reads += 1
+        return super().get_messages(*args, **kws)
+
+    def add_messages(self, messages, chat):
+        self.writes += 1
+        super().add_messages(messages, chat)
+
+
+def test_chat_many():
+    store = CountingStore()
+    ai = AiConfig(id="ai_1", system="sys")
+    EchoChat(ai=ai, thread_id="t0", store=store).chat("old")
+    store.reads = store.writes = 0
+
+    requests = [(f"t{i % 4}", f"q{i}") for i in range(8)] + [("t9", "fail")]
+    t0 = time.monotonic()
+    results = EchoChat.chat_many(requests, ai=ai, store=store, concurrency=4)
+    assert time.monotonic() - t0 < 0.3
+
+    assert [r.content for r in results] == [c for _, c in requests]
+    assert results[0].response.content == "q0 after 2"
+    # the second turn on a thread sees the first
+    assert results[4].response.content == "q4 after 4"
+    assert results[1].response.content == "q1 after 0"
+    assert isinstance(results[-1].error, ValueError) and results[-1].response is None
+
+    assert store.reads == 0 and store.writes == 1
+    chat = EchoChat(ai=ai, thread_id="t0", store=store)
+    assert [m.content for m in store.get_messages(chat, "")] == ["old", "old after 0", "q0", "q0 after 2",
+                                                                  "q4", "q4 after 4"]
+
+
+def test_achat_many():
+    store = MemoryStore()
+    ai = AiConfig(id="ai_1", system="sys")
+    results = asyncio.run(EchoChat.achat_many([("a", "x"), ("b", "y"), ("a", "z")], ai=ai, store=store))
+    assert [r.response.content for r in results] == ["x after 0", "y after 0", "z after 2"]
+
+
+def test_get_thread_messages(tmp_path):
+    store = SqliteStore(tmp_path / "db.sqlite")
+    ai = AiConfig(id="ai_1", system="sys")
+    for thread in ("a", "b"):
+        chat = MockChat(ai=ai, thread_id=thread, store=store)
+        for i in range(3):
+            chat.chat(f"{thread}{i}")
+    out = store.get_thread_messages(MockChat(ai=ai, store=store), ["a", "b", "c"], 2)
+    assert [m.content for m in out["a"]] == ["a2", "hi, im a reply"]
+    assert out["b"][0].content == "b2"
+    assert out["c"] == []
+
+
+def test_rate_limiter():
+    bucket = TokenBucket(rate=10, capacity=2)
+    assert bucket.take(1) == 0 and bucket.take(1) == 0
+    assert 0.05 < bucket.take(1) <= 0.1
+
+    limiter = RateLimiter(rpm=600, tpm=60)
+    assert limiter.reserve(30) == 0
+    assert limiter.reserve(60) > 20
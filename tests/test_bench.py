@@ -0,0 +1,9 @@
+from benchmarks.bench import run
+
+
+def test_bench_smoke():
+    report = run(["memory", "sqlite"], dict(history=[2], hops=[1], threads=[2], size=[10], turns=4))
+    assert [r["store"] for r in report["results"]] == ["memory", "sqlite"]
+    result = report["results"][0]
+    assert result["turns"] == 4 and result["turns_per_sec"] > 0
+    assert result["stages"]["functions"]["count"] == 4
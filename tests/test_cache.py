@@ -0,0 +1,105 @@
+import time
+
+from ai_chat import AiConfig, Function
+from ai_chat.cache import MemoryCompletionCache, SqliteCompletionCache, completion_key
+from ai_chat.store import MemoryStore
+from tests.test_chat import MockChat
+
+
+class CountingChat(MockChat):
+    calls = 0
+
+    def chat_complete(self, prompt, functions):
+        self.calls += 1
+        return "assistant", f"reply {self.calls}", None
+
+
+def make_chat(cache, temperature=0):
+    ai = AiConfig(id="ai_1", system="sys", model_params=dict(temperature=temperature), completion_cache=cache)
+    return CountingChat(ai=ai, thread_id="t1", store=MemoryStore())
+
+
+def fresh_thread(chat, thread_id):
+    chat.thread_id = thread_id
+    return chat
+
+
+def test_completion_key_is_canonical():
+    prompt = [{"role": "user", "content": "hi"}]
+    assert completion_key(prompt, None, {"a": 1, "b": 2}) == completion_key(prompt, None, {"b": 2, "a": 1})
+    assert completion_key(prompt, None, {"a": 1}) != completion_key(prompt, None, {"a": 2})
+
+
+def test_cache_hit_still_saves():
+    cache = MemoryCompletionCache()
+    chat = make_chat(cache)
+    first = chat.chat("hello")
+    second = fresh_thread(chat, "t2").chat("hello")
+    assert chat.calls == 1
+    assert first.content == second.content == "reply 1"
+    assert cache.stats() == dict(hits=1, misses=1, evictions=0)
+    assert [m.content for m in chat.store.get_messages(chat, "", 10)] == ["hello", "reply 1"]
+
+
+def test_cache_skipped_when_not_deterministic():
+    cache = MemoryCompletionCache()
+    chat = make_chat(cache, temperature=0.7)
+    chat.chat("hello", save=False)
+    chat.chat("hello", save=False)
+    assert chat.calls == 2
+    assert cache.stats()["misses"] == 0
+
+    cache.always = True
+    chat.chat("again", save=False)
+    chat.chat("again", save=False)
+    assert chat.calls == 3
+
+
+def test_cache_stream_replay():
+    chat = make_chat(MemoryCompletionCache())
+    assert list(chat.chat_stream("hello")) == ["reply 1"]
+    assert list(fresh_thread(chat, "t2").chat_stream("hello")) == ["reply 1"]
+    assert chat.calls == 1
+
+
+def test_memory_cache_lru_and_ttl():
+    cache = MemoryCompletionCache(max_size=2, ttl=60)
+    for key in "abc":
+        cache.set(key, ("assistant", key, None))
+    assert cache.get("a") is None
+    assert cache.get("c") == ("assistant", "c", None)
+    assert cache.evictions == 1
+
+    cache.entries["c"] = (time.time() - 120, cache.entries["c"][1])
+    assert cache.get("c") is None
+
+
+def test_sqlite_cache(tmp_path):
+    path = tmp_path / "cache.db"
+    cache = SqliteCompletionCache(path, max_size=2, prune_every=1)
+    calls = [Function(name="f", arguments="{}", id="call_1")]
+    cache.set("a", ("assistant", None, calls))
+    cache.set("b", ("assistant", "b", None))
+
+    role, reply, function = SqliteCompletionCache(path).get("a")
+    assert function[0].name == "f" and function[0].id == "call_1"
+
+    cache.set("c", ("assistant", "c", None))
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+
+
+def test_sqlite_cache_prunes_in_batches(tmp_path):
+    cache = SqliteCompletionCache(tmp_path / "cache.db", max_size=2, prune_every=3, ttl=60)
+    for key in "abcd":
+        cache.set(key, ("assistant", key, None))
+    # pruned at the 3rd save only
+    assert cache.evictions == 1
+    assert cache.conn.execute("SELECT count(*) FROM completions").fetchone()[0] == 3
+
+    cache.conn.execute("UPDATE completions SET created_at = created_at - 120 WHERE key = 'd'")
+    assert cache.get("d") is None
+    cache.set("e", ("assistant", "e", None))
+    cache.set("f", ("assistant", "f", None))
+    assert cache.get("e") and cache.get("f")
+    assert cache.conn.execute("SELECT count(*) FROM completions").fetchone()[0] == 2
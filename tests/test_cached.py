@@ -0,0 +1,196 @@
+from ai_chat.store import CachedStore, CachedStateStore, MemoryStore
+from tests.test_chat import MockChat, chat_instance, memory_store, ai_config  # noqa
+
+
+def test_cached_store_write_through(ai_config):
+    inner = MemoryStore()
+    store = CachedStore(inner, max_messages=10)
+    chat = MockChat(store=store, ai=ai_config, thread_id="t1")
+
+    chat.chat("one")
+    assert store.stats()["misses"] == 1
+
+    reads = []
+    get_messages = inner.get_messages
+    inner.get_messages = lambda *a: reads.append(a) or get_messages(*a)
+
+    chat.chat("two")
+    chat.chat("three")
+    assert not reads
+    assert store.stats()["hits"] == 2
+
+    msgs = store.get_messages(chat, "")
+    assert [m.content for m in msgs] == [m.content for m in get_messages(chat, "")]
+    assert [m.content for m in msgs][-2:] == ["three", "hi, im a reply"]
+
+
+def test_cached_store_window(ai_config):
+    store = CachedStore(MemoryStore(), max_messages=4)
+    chat = MockChat(store=store, ai=ai_config, thread_id="t1")
+    for i in range(5):
+        chat.chat(str(i))
+    store.get_messages(chat, "", 4)
+    hits = store.hits
+    # the cache only holds 4, a bigger read has to go to the store
+    assert len(store.get_messages(chat, "", 8)) == 8
+    assert store.hits == hits
+
+
+def test_cached_store_eviction(ai_config):
+    store = CachedStore(MemoryStore(), max_threads=2)
+    for thread_id in ("a", "b", "c"):
+        chat = MockChat(store=store, ai=ai_config, thread_id=thread_id)
+        chat.chat("hi")
+        store.get_messages(chat, "")
+    stats = store.stats()
+    assert stats["threads"] == 2
+    assert stats["evictions"] == 1
+
+    store = CachedStore(MemoryStore(), max_bytes=500)
+    for thread_id in ("a", "b"):
+        chat = MockChat(store=store, ai=ai_config, thread_id=thread_id)
+        chat.chat("hi")
+        store.get_messages(chat, "")
+    assert store.bytes <= 500
+    assert store.evictions == 1
+
+
+def test_cached_store_thread_messages(ai_config):
+    inner = MemoryStore()
+    store = CachedStore(inner, max_messages=10)
+    for thread_id in ("a", "b"):
+        MockChat(store=inner, ai=ai_config, thread_id=thread_id).chat(thread_id)
+    chat = MockChat(store=store, ai=ai_config, thread_id="a")
+    store.get_messages(chat, "")
+    assert store.misses == 1
+
+    fetched = []
+    get_thread_messages = inner.get_thread_messages
+    inner.get_thread_messages = lambda chat, ids, limit: fetched.append(ids) or get_thread_messages(chat, ids, limit)
+    out = store.get_thread_messages(chat, ["a", "b", "c"], 2)
+    assert [m.content for m in out["b"]] == ["b", "hi, im a reply"]
+    assert out["c"] == []
+    # "a" came from the cache, and the rest are cached now
+    assert fetched == [["b", "c"]]
+    store.get_thread_messages(chat, ["a", "b", "c"], 2)
+    assert fetched == [["b", "c"]]
+
+
+def test_cached_store_fill_races(ai_config):
+    inner = MemoryStore()
+    store = CachedStore(inner)
+    chat = MockChat(store=store, ai=ai_config, thread_id="t1")
+    other = MockChat(store=store, ai=ai_config, thread_id="t2")
+    during = []
+    get_messages = inner.get_messages
+
+    def racing(*args):
+        messages = get_messages(*args)
+        writes, during[:] = list(during), []
+        for write in writes:
+            write()
+        return messages
+
+    inner.get_messages = racing
+    # a write to another thread while t1 is read doesn't keep t1 out of the cache
+    during.append(lambda: other.add_message("user", "elsewhere"))
+    store.get_messages(chat, "")
+    assert store.stats()["threads"] == 1
+
+    # a read that raced with a write to t1 doesn't replace what's cached with its older fetch
+    store.clear()
+    during.extend([lambda: store.get_messages(chat, ""), lambda: chat.add_message("user", "late")])
+    assert store.get_messages(chat, "") == []
+    assert [m.content for m in store.get_messages(chat, "")] == ["late"]
+
+
+class CountingStore(MemoryStore):
+    def __init__(self):
+        super().__init__()
+        self.reads = []
+
+    def get_state(self, chat, key):
+        self.reads.append(key)
+        return super().get_state(chat, key)
+
+    def get_states(self, chat, keys):
+        self.reads.append(tuple(keys))
+        return super().get_states(chat, keys)
+
+    def get_glob(self, key):
+        self.reads.append(key)
+        return super().get_glob(key)
+
+
+def test_cached_state_store(chat_instance):
+    inner = CountingStore()
+    store = CachedStateStore(inner)
+    store.set_states(chat_instance, {"a": 1, "b": {"x": "y"}})
+    assert store.get_state(chat_instance, "a") == 1
+    assert not inner.reads
+
+    assert store.get_states(chat_instance, ["a", "b", "c", "d"]) == {"a": 1, "b": {"x": "y"}}
+    assert inner.reads == [("c", "d")]
+    # missing keys are cached as such
+    assert store.get_state(chat_instance, "c") is None
+    assert inner.reads == [("c", "d")]
+
+    inner.set_glob("config", {"model": "m"})
+    assert store.get_glob("config") == {"model": "m"}
+    assert store.get_glob("config") == {"model": "m"}
+    assert inner.reads == [("c", "d"), "config"]
+    assert store.stats() == dict(hits=5, misses=3, keys=5)
+
+
+def test_cached_state_store_fill_races(chat_instance):
+    inner = CountingStore()
+    store = CachedStateStore(inner)
+    get_state = inner.get_state
+
+    def racing(chat, key):
+        state = get_state(chat, key)
+        if key == "a":
+            store.set_state(chat, "b", 2)
+        return state
+
+    inner.get_state = racing
+    assert store.get_state(chat_instance, "a") is None
+    # the write was to another key, the read is still cached
+    assert store.get_state(chat_instance, "a") is None
+    assert store.get_state(chat_instance, "b") == 2
+    assert inner.reads == ["a"]
+    assert not store.versions.reading
+
+
+def test_cached_state_store_ttl(chat_instance):
+    inner = CountingStore()
+    store = CachedStateStore(inner, ttl=0.0)
+    store.set_state(chat_instance, "a", 1)
+    # another process wrote it
+    inner.set_state(chat_instance, "a", 2)
+    assert store.get_state(chat_instance, "a") == 2
+    assert inner.reads == ["a"]
+
+
+def test_cached_state_store_async(chat_instance):
+    import asyncio
+
+    inner = CountingStore()
+    store = CachedStateStore(inner)
+
+    async def main():
+        await store.aset_states(chat_instance, {"a": 1})
+        await store.aset_glob("g", "v")
+        return (await store.aget_state(chat_instance, "a"), await store.aget_glob("g"),
+                await store.aget_states(chat_instance, ["a", "b"]))
+
+    assert asyncio.run(main()) == (1, "v", {"a": 1})
+    assert inner.reads == [("b",)]
+
+
+def test_store_states(chat_instance, memory_store):
+    memory_store.set_states(chat_instance, {"k1": 1, "k2": [2], "other": "x"})
+    assert memory_store.get_states(chat_instance, ["k1", "k2", "k3"]) == {"k1": 1, "k2": [2]}
+    assert sorted(memory_store.enum_state(chat_instance, "k")) == [("k1", 1), ("k2", [2])]
+    memory_store.set_glob("g1", "v")
+    assert memory_store.enum_glob("g") == [("g1", "v")]
@@ -1,3 +1,4 @@
+import asyncio
 import json
 from typing import Annotated
 import os 
@@ -211,3 +212,298 @@ def test_chat_complete(chat_instance):
 
     assert msgs[0].role == "user"
     assert msgs[1].role == "assistant"
+
+
+def test_achat(chat_instance):
+    chat_response = asyncio.run(chat_instance.achat("Hello, AI!"))
+    assert chat_response.content == "hi, im a reply"
+    assert chat_response.request_id is not None
+
+    msgs = asyncio.run(chat_instance.store.aget_messages(chat_instance, ""))
+    assert [m.role for m in msgs] == ["user", "assistant"]
+
+
+def test_achat_async_function(chat_instance):
+    funcs = AIFunctions()
+
+    async def my_func(arg: Annotated[str, "arg 1"], chat, **kws):
+        """Some async func"""
+        await asyncio.sleep(0)
+        return "ok:" + arg
+
+    funcs.add(my_func)
+    chat_instance.functions = funcs
+
+    replies = [("function_call", None, Function(name="my_func", arguments=json.dumps(dict(arg="yo")))),
+               ("assistant", "done", None)]
+    seen = []
+
+    async def achat_complete(prompt, functions):
+        seen.append(prompt[-1])
+        return replies.pop(0)
+
+    chat_instance.achat_complete = achat_complete
+    res = asyncio.run(chat_instance.achat("Hello, AI!"))
+    assert res.content == "done"
+    assert seen[-1] == {"role": "function", "name": "my_func", "content": "ok:yo"}
+
+
+def test_chat_stream_default(chat_instance):
+    stream = chat_instance.chat_stream("Hello, AI!")
+    deltas = []
+    try:
+        while True:
+            deltas.append(next(stream))
+    except StopIteration as stop:
+        res = stop.value
+    assert deltas == ["hi, im a reply"]
+    assert res.response_id
+    assert len(chat_instance.store.get_messages(chat_instance, "")) == 2
+
+
+def _stream_chunks(*deltas):
+    from litellm.types.utils import ModelResponseStream, StreamingChoices, Delta
+    return [ModelResponseStream(choices=[StreamingChoices(delta=Delta(**d))]) for d in deltas]
+
+
+def test_openai_chat_stream_function(memory_store, ai_config, monkeypatch):
+    funcs = AIFunctions()
+
+    def lookup(arg: Annotated[str, "arg 1"], **kws):
+        """Look something up"""
+        return "found " + arg
+
+    funcs.add(lookup)
+
+    responses = [
+        _stream_chunks(dict(function_call=dict(name="look", arguments="")),
+                       dict(function_call=dict(name="up", arguments='{"arg": ')),
+                       dict(function_call=dict(arguments='"x"}'))),
+        _stream_chunks(dict(content="it is "), dict(content="found x")),
+    ]
+    prompts = []
+
+    def completion(messages, stream, **kws):
+        assert stream
+        prompts.append(list(messages))
+        return iter(responses.pop(0))
+
+    monkeypatch.setattr("ai_chat.openai.completion", completion)
+    chat = OpenaiChat(store=memory_store, ai=ai_config, thread_id="t1")
+    chat.functions = funcs
+
+    assert list(chat.chat_stream("what is x?")) == ["it is ", "found x"]
+    assert prompts[1][-1] == {"role": "function", "name": "lookup", "content": "found x"}
+    msgs = memory_store.get_messages(chat, "")
+    assert msgs[-1].content == "it is found x"
+    assert len(msgs) == 4
+
+
+def test_achat_stream(chat_instance):
+    async def run():
+        return [delta async for delta in chat_instance.achat_stream("Hello, AI!")]
+
+    assert asyncio.run(run()) == ["hi, im a reply"]
+    assert len(chat_instance.store.get_messages(chat_instance, "")) == 2
+
+
+def test_parallel_tool_calls(chat_instance):
+    import time
+    funcs = AIFunctions()
+
+    def slow(arg: Annotated[str, "arg 1"], **kws):
+        """Slow lookup"""
+        time.sleep(0.2)
+        return "got " + arg
+
+    funcs.add(slow)
+    chat_instance.functions = funcs
+
+    calls = [Function(name="slow", arguments=json.dumps(dict(arg=str(i))), id=f"call_{i}") for i in range(3)]
+    replies = [("function_call", None, calls), ("assistant", "all done", None)]
+    prompts = []
+
+    def chat_complete(prompt, functions):
+        prompts.append(list(prompt))
+        return replies.pop(0)
+
+    chat_instance.chat_complete = chat_complete
+    t0 = time.monotonic()
+    res = chat_instance.chat("look up 3 things")
+    assert time.monotonic() - t0 < 0.5
+    assert res.content == "all done"
+
+    # one follow-up request carrying all results
+    assert len(prompts) == 2
+    assert prompts[1][-4]["tool_calls"][2]["id"] == "call_2"
+    assert [p["content"] for p in prompts[1][-3:]] == ["got 0", "got 1", "got 2"]
+    assert all(p["role"] == "tool" for p in prompts[1][-3:])
+
+    msgs = chat_instance.store.get_messages(chat_instance, "")
+    assert [m.role for m in msgs].count("function:slow") == 6
+    assert msgs[-1].content == "all done"
+
+
+def test_openai_parse_tool_calls(chat_instance, ai_config):
+    from litellm import ModelResponse
+    result = ModelResponse(choices=[dict(message=dict(role="assistant", content=None, tool_calls=[
+        dict(id="a", type="function", function=dict(name="f", arguments="{}")),
+        dict(id="b", type="function", function=dict(name="g", arguments='{"x": 1}')),
+    ]))])
+    role, content, funcs = OpenaiChat(ai=ai_config).parse_completion(result)
+    assert role == "function_call"
+    assert [(f.id, f.name, f.arguments) for f in funcs] == [("a", "f", "{}"), ("b", "g", '{"x": 1}')]
+
+
+def test_chat_saves_chain_in_one_batch(chat_instance):
+    funcs = AIFunctions()
+
+    def my_func(arg: Annotated[str, "arg 1"], **kws):
+        """Some func"""
+        return "ok"
+
+    funcs.add(my_func)
+    chat_instance.functions = funcs
+
+    call = Function(name="my_func", arguments=json.dumps(dict(arg="yo")))
+    replies = [("function_call", None, call), ("function_call", None, call), ("assistant", "done", None)]
+    chat_instance.chat_complete = lambda prompt, functions: replies.pop(0)
+
+    batches = []
+    add_messages = chat_instance.store.add_messages
+    chat_instance.store.add_message = lambda *a: pytest.fail("should be batched")
+    chat_instance.store.add_messages = lambda msgs, chat: batches.append(msgs) or add_messages(msgs, chat)
+
+    chat_instance.chat("Hello, AI!")
+    assert len(batches) == 1
+    assert len(batches[0]) == 6
+    msgs = chat_instance.store.get_messages(chat_instance, "")
+    assert [m.id for m in msgs] == [m.id for m in batches[0]]
+
+
+def test_failed_chain_is_not_saved(chat_instance):
+    call = Function(name="missing", arguments="{}")
+    replies = [("function_call", None, call)]
+
+    def chat_complete(prompt, functions):
+        if not replies:
+            raise RuntimeError("provider down")
+        return replies.pop(0)
+
+    chat_instance.chat_complete = chat_complete
+    with pytest.raises(RuntimeError):
+        chat_instance.chat("Hello, AI!")
+    assert chat_instance.store.get_messages(chat_instance, "") == []
+    assert chat_instance.pending is None
+
+
+def test_concurrent_turns_batch_separately(chat_instance):
+    async def chat_complete(prompt, functions):
+        if prompt[-1]["content"] == "fail":
+            await asyncio.sleep(0.1)
+            raise RuntimeError("provider down")
+        await asyncio.sleep(0.02)
+        return "assistant", "done", None
+
+    async def main():
+        return await asyncio.gather(chat_instance.achat("fail"), chat_instance.achat("answer"),
+                                    return_exceptions=True)
+
+    chat_instance.achat_complete = chat_complete
+    failed, answered = asyncio.run(main())
+    assert isinstance(failed, RuntimeError) and answered.content == "done"
+    # the answered turn was saved in its own batch, not lost with the failed one
+    stored = chat_instance.store.get_messages(chat_instance, "")
+    assert [m.content for m in stored] == ["answer", "done"]
+    assert chat_instance.pending is None
+
+
+def _looping_chat(chat_instance, fail=False):
+    funcs = AIFunctions()
+
+    def again(arg: Annotated[str, "arg 1"], **kws):
+        """Keeps the model calling"""
+        if fail:
+            raise ValueError("broken")
+        return "more"
+
+    funcs.add(again)
+    chat_instance.functions = funcs
+    calls = []
+
+    def chat_complete(prompt, functions):
+        calls.append(functions)
+        if functions:
+            return "function_call", None, Function(name="again", arguments=json.dumps(dict(arg="x")))
+        return "assistant", "final answer", None
+
+    chat_instance.chat_complete = chat_complete
+    return calls
+
+
+def test_tool_loop_max_hops(chat_instance):
+    calls = _looping_chat(chat_instance)
+    chat_instance.ai.max_hops = 3
+    res = chat_instance.chat("loop")
+    assert res.content == "final answer"
+    assert len(calls) == 4 and calls[-1] is None
+    assert res.stats.hops == 3 and res.stats.limit == "max_hops"
+
+
+def test_tool_loop_token_budget(chat_instance):
+    calls = _looping_chat(chat_instance)
+    chat_instance.ai.turn_token_budget = 1
+    res = asyncio.run(chat_instance.achat("loop"))
+    assert res.content == "final answer"
+    assert calls == [None]
+    assert res.stats.limit == "token_budget"
+
+
+def test_failed_function_reply_not_saved(chat_instance):
+    _looping_chat(chat_instance, fail=True)
+    chat_instance.ai.max_hops = 1
+    res = chat_instance.chat("loop")
+    assert res.content == "final answer"
+    assert res.response_id is None
+    assert [m.role for m in chat_instance.store.get_messages(chat_instance, "")] == ["user"]
+
+
+def test_failed_parallel_hop_not_saved(chat_instance):
+    _looping_chat(chat_instance, fail=True)
+    calls = [Function(name="again", arguments=json.dumps(dict(arg=str(i))), id=f"call_{i}") for i in range(2)]
+    replies = [("function_call", None, calls), ("assistant", "sorry", None)]
+    chat_instance.chat_complete = lambda prompt, functions: replies.pop(0)
+    res = chat_instance.chat("loop")
+    assert res.content == "sorry"
+    # every call and result of the failed hop is dropped, not just the last call
+    assert [m.role for m in chat_instance.store.get_messages(chat_instance, "")] == ["user"]
+
+
+def test_tool_loop_limit_forbids_calls(memory_store, ai_config, monkeypatch):
+    from litellm import ModelResponse
+    sent = []
+
+    def completion(**kws):
+        sent.append(kws)
+        message = dict(role="assistant", content="done")
+        if "tool_choice" not in kws:
+            message = dict(role="assistant", content=None, tool_calls=[
+                dict(id="a", type="function", function=dict(name="again", arguments='{"arg": "x"}'))])
+        return ModelResponse(choices=[dict(message=message)])
+
+    monkeypatch.setattr("ai_chat.openai.completion", completion)
+    ai_config.parallel_tools = True
+    ai_config.max_hops = 1
+    chat = OpenaiChat(store=memory_store, ai=ai_config, thread_id="t1")
+    _looping_chat(chat)
+    del chat.chat_complete
+    assert chat.chat("loop").content == "done"
+    # the last request still describes the tools its history calls, but can't call them
+    assert len(sent) == 2
+    assert sent[1]["tools"] and sent[1]["tool_choice"] == "none"
+
+
+def test_prompt_tokens_count_tool_calls(chat_instance):
+    calls = [Function(name="lookup", arguments=json.dumps(dict(arg="x" * 100)), id="call_0")]
+    bare = chat_instance.prompt_tokens([chat_instance.tool_calls_prompt([])])
+    assert chat_instance.prompt_tokens([chat_instance.tool_calls_prompt(calls)]) > bare + 20
@@ -0,0 +1,109 @@
+import asyncio
+import time
+
+import pytest
+
+from ai_chat.compact import Compactor
+from ai_chat.prompt import SUMMARY_PREFIX
+from ai_chat.util import assert_wait_for
+from tests.test_chat import MockChat, chat_instance, memory_store, ai_config  # noqa
+
+
+class SummaryChat(MockChat):
+    folded = []
+
+    def summarize(self, summary, messages):
+        self.folded.append([m.content for m in messages])
+        return (summary or "") + "|" + ",".join(m.content for m in messages if m.role == "user")
+
+    def chat_complete(self, prompt, functions):
+        self.prompts.append(prompt)
+        return super().chat_complete(prompt, functions)
+
+
+def test_compaction_is_incremental(memory_store, ai_config):
+    ai_config.compactor = Compactor(threshold=40, keep_recent=2, background=False)
+    chat = SummaryChat(store=memory_store, ai=ai_config, thread_id="t1")
+    chat.folded, chat.prompts = [], []
+
+    for i in range(6):
+        chat.chat(f"message {i} " + "x" * 40)
+
+    assert len(chat.folded) > 1
+    # no message is ever summarized twice
+    seen = [c for batch in chat.folded for c in batch if c.startswith("message")]
+    assert len(seen) == len(set(seen))
+
+    state = memory_store.get_state(chat, Compactor.state_key(chat))
+    assert state["summary"].startswith("|message 0")
+    assert state["count"] == sum(len(batch) for batch in chat.folded)
+
+    last = chat.prompts[-1]
+    assert last[1]["role"] == "system"
+    assert last[1]["content"].startswith(SUMMARY_PREFIX)
+    # summarized messages are not repeated in the prompt
+    assert not any(p["content"] in seen for p in last[2:])
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_compaction_catches_up_past_the_window(memory_store, ai_config, use_async):
+    # by the time the window is full, the summary's last message has already left it
+    ai_config.compactor = Compactor(threshold=100000, keep_recent=7, background=False)
+    chat = SummaryChat(store=memory_store, ai=ai_config, thread_id="t1")
+    chat.folded, chat.prompts = [], []
+
+    async def main():
+        for i in range(30):
+            await chat.achat(f"u{i}")
+
+    if use_async:
+        asyncio.run(main())
+    else:
+        for i in range(30):
+            chat.chat(f"u{i}")
+
+    assert len(chat.folded) > 1
+    folded = [c for batch in chat.folded for c in batch]
+    stored = [m.content for m in memory_store.get_messages(chat, "", 100)]
+    state = memory_store.get_state(chat, Compactor.state_key(chat))
+    # everything up to the summary's last message was folded in once, in order, with no gaps
+    assert folded == stored[:len(folded)]
+    assert state["count"] == len(folded)
+
+
+def test_compaction_async(memory_store, ai_config):
+    ai_config.compactor = Compactor(threshold=40, keep_recent=2, background=False)
+    chat = SummaryChat(store=memory_store, ai=ai_config, thread_id="t1")
+    chat.folded, chat.prompts = [], []
+
+    async def main():
+        for i in range(4):
+            await chat.achat(f"message {i} " + "x" * 40)
+
+    asyncio.run(main())
+    assert chat.folded
+    state = memory_store.get_state(chat, Compactor.state_key(chat))
+    assert state["summary"].startswith("|message 0")
+    assert chat.prompts[-1][1]["content"].startswith(SUMMARY_PREFIX)
+
+
+def test_compaction_in_background(memory_store, ai_config):
+    ai_config.compactor = Compactor(threshold=10, keep_recent=1)
+    chat = SummaryChat(store=memory_store, ai=ai_config, thread_id="t1")
+    chat.folded, chat.prompts = [], []
+
+    chat.chat("first " + "x" * 40)
+    chat.chat("second " + "x" * 40)
+    assert_wait_for(lambda: memory_store.get_state(chat, Compactor.state_key(chat)))
+    time.sleep(0.01)
+    assert chat.folded
+
+
+def test_compaction_below_threshold(memory_store, ai_config):
+    ai_config.compactor = Compactor(threshold=10000, background=False)
+    chat = SummaryChat(store=memory_store, ai=ai_config, thread_id="t1")
+    chat.folded, chat.prompts = [], []
+    for i in range(3):
+        chat.chat("hi")
+    assert not chat.folded
+    assert memory_store.get_state(chat, Compactor.state_key(chat)) is None
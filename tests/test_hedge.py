@@ -0,0 +1,166 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from litellm import ModelResponse
+
+from ai_chat.hedge import Hedger
+from ai_chat.limits import AdmissionController
+from ai_chat.openai import OpenaiChat
+from tests.test_chat import _stream_chunks, memory_store, ai_config  # noqa
+
+
+def reply(content):
+    return ModelResponse(choices=[dict(message=dict(role="assistant", content=content))])
+
+
+def test_hedge_backup_wins(memory_store, ai_config, monkeypatch):
+    calls = []
+
+    def completion(model, **kws):
+        calls.append(model)
+        time.sleep(1.0 if model == ai_config.model_params["model"] else 0.0)
+        return reply("from " + model)
+
+    monkeypatch.setattr("ai_chat.openai.completion", completion)
+    ai_config.hedger = Hedger(max_delay=0.05, max_rate=1.0, backup=dict(model="backup"))
+    chat = OpenaiChat(store=memory_store, ai=ai_config, thread_id="t1")
+
+    t0 = time.monotonic()
+    assert chat.chat("hi").content == "from backup"
+    assert time.monotonic() - t0 < 0.5
+    assert ai_config.hedger.snapshot()["hedge_wins"] == 1
+    assert ai_config.hedger.wasted == 1
+
+
+def test_hedge_admitted(memory_store, ai_config, monkeypatch):
+    calls = []
+
+    def completion(model, **kws):
+        calls.append(model)
+        time.sleep(0.3 if model == ai_config.model_params["model"] else 0.0)
+        return reply("from " + model)
+
+    monkeypatch.setattr("ai_chat.openai.completion", completion)
+    ai_config.hedger = Hedger(max_delay=0.05, max_rate=1.0, backup=dict(model="backup"))
+    ai_config.admission = AdmissionController(rpm=60, models={"backup": dict(rpm=1)})
+    chat = OpenaiChat(store=memory_store, ai=ai_config, thread_id="t1")
+
+    assert chat.chat("hi").content == "from backup"
+    assert ai_config.admission.stats()["admitted"] == 2
+    # no capacity left for the backup, the hedge is dropped rather than queued
+    assert chat.chat("again").content == "from " + ai_config.model_params["model"]
+    assert calls.count("backup") == 1
+    assert ai_config.admission.stats() == dict(admitted=3, shed=1, queued={})
+
+
+def test_hedge_rate_cap():
+    hedger = Hedger(max_delay=0.01, max_rate=0.5)
+    calls = []
+
+    def slow(args):
+        calls.append(args)
+        time.sleep(0.03)
+        return "done"
+
+    for _ in range(4):
+        assert hedger.call(slow, {}) == "done"
+    assert hedger.requests == 4
+    assert hedger.hedged == 2
+    assert len(calls) == 6
+
+
+def test_hedge_delay_from_send():
+    pool = ThreadPoolExecutor(max_workers=1)
+    hedger = Hedger(max_delay=0.05, max_rate=1.0, executor=pool)
+    pool.submit(time.sleep, 0.2)
+    # queued behind the sleep for longer than the delay, but quick once sent
+    assert hedger.call(lambda args: time.sleep(0.01) or "quick", {}) == "quick"
+    assert hedger.hedged == 0
+    assert hedger.stats.p50 < 0.1
+
+
+def test_hedge_not_needed():
+    hedger = Hedger(max_delay=1.0, max_rate=1.0)
+    assert hedger.call(lambda args: "quick", {}) == "quick"
+    assert hedger.hedged == 0
+    assert hedger.stats.p50 is not None
+
+
+def test_hedge_async_stream(memory_store, ai_config, monkeypatch):
+    cancelled = []
+
+    async def acompletion(model, stream, **kws):
+        try:
+            await asyncio.sleep(1.0 if model == ai_config.model_params["model"] else 0.0)
+        except asyncio.CancelledError:
+            cancelled.append(model)
+            raise
+
+        async def chunks():
+            for chunk in _stream_chunks(dict(content="from "), dict(content=model)):
+                yield chunk
+        return chunks()
+
+    monkeypatch.setattr("ai_chat.openai.acompletion", acompletion)
+    ai_config.hedger = Hedger(max_delay=0.05, max_rate=1.0, backup=dict(model="backup"))
+    chat = OpenaiChat(store=memory_store, ai=ai_config, thread_id="t1")
+
+    async def run():
+        return [delta async for delta in chat.achat_stream("hi")]
+
+    assert asyncio.run(run()) == ["from ", "backup"]
+    assert cancelled == [ai_config.model_params["model"]]
+
+
+def test_hedge_async_caller_cancelled():
+    cancelled = []
+
+    async def slow(args):
+        try:
+            await asyncio.sleep(1.0)
+        except asyncio.CancelledError:
+            cancelled.append(args.get("model", "primary"))
+            raise
+
+    async def main(hedger):
+        call = asyncio.create_task(hedger.acall(slow, {}))
+        await asyncio.sleep(0.1)
+        call.cancel()
+        await asyncio.gather(call, return_exceptions=True)
+        await asyncio.sleep(0.01)
+        # before asyncio.run cancels whatever is left
+        return sorted(cancelled)
+
+    # cancelled while waiting out the delay, and while the primary and the hedge race
+    assert asyncio.run(main(Hedger(max_delay=1.0, max_rate=1.0))) == ["primary"]
+    cancelled.clear()
+    assert asyncio.run(main(Hedger(max_delay=0.02, max_rate=1.0, backup=dict(model="backup")))) == ["backup", "primary"]
+
+
+def test_hedge_async_finished_loser_closed():
+    closed = []
+
+    class Stream:
+        def __init__(self, name):
+            self.name = name
+
+        async def aclose(self):
+            closed.append(self.name)
+
+    async def main():
+        answered = asyncio.Event()
+
+        async def send(args):
+            if args.get("model") == "backup":
+                answered.set()
+                return Stream("backup")
+            # both are done by the time the winner is picked
+            await answered.wait()
+            return Stream("primary")
+
+        hedger = Hedger(max_delay=0.01, max_rate=1.0, backup=dict(model="backup"))
+        return await hedger.acall(send, {})
+
+    assert asyncio.run(main()).name == "primary"
+    assert closed == ["backup"]
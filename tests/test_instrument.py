@@ -0,0 +1,92 @@
+import asyncio
+import json
+from typing import Annotated
+
+from litellm import ModelResponse
+
+from ai_chat import Function
+from ai_chat.instrument import Instrument, PrometheusExporter
+from ai_chat.openai import OpenaiChat
+from ai_chat.types import AIFunctions
+from tests.test_chat import chat_instance, memory_store, ai_config  # noqa
+
+
+def test_turn_stats(chat_instance):
+    funcs = AIFunctions()
+
+    def lookup(arg: Annotated[str, "arg 1"], **kws):
+        """Look something up"""
+        return "found"
+
+    funcs.add(lookup)
+    chat_instance.functions = funcs
+    replies = [("function_call", None, Function(name="lookup", arguments=json.dumps(dict(arg="x")))),
+               ("assistant", "done", None)]
+    chat_instance.chat_complete = lambda prompt, functions: replies.pop(0)
+
+    stats = chat_instance.chat("look it up").stats
+    assert stats.hops == 1
+    assert set(stats.stages) == {"history", "prompt", "complete", "functions", "save"}
+    assert stats.seconds >= sum(stats.stages.values())
+    assert chat_instance.last_turn is stats and chat_instance.turn is None
+
+
+def test_concurrent_turn_stats(chat_instance):
+    funcs = AIFunctions()
+
+    def lookup(arg: Annotated[str, "arg 1"], **kws):
+        """Look something up"""
+        return "found"
+
+    funcs.add(lookup)
+    chat_instance.functions = funcs
+
+    async def chat_complete(prompt, functions):
+        await asyncio.sleep(0.05)
+        if prompt[-1]["content"] == "look it up":
+            return "function_call", None, Function(name="lookup", arguments=json.dumps(dict(arg="x")))
+        return "assistant", "done", None
+
+    async def main():
+        # both turns are in flight at once on the same chat
+        return await asyncio.gather(chat_instance.achat("look it up"), chat_instance.achat("just answer"))
+
+    chat_instance.achat_complete = chat_complete
+    looked, answered = asyncio.run(main())
+    assert looked.stats.hops == 1 and answered.stats.hops == 0
+    assert looked.stats is not answered.stats
+    assert chat_instance.turn is None
+
+
+def test_instrument_hooks(chat_instance):
+    events = []
+
+    class Recorder(Instrument):
+        def on_stage(self, chat, name, seconds):
+            events.append(name)
+
+        def on_turn(self, chat, stats):
+            events.append("turn")
+
+    chat_instance.ai.instruments = [Recorder()]
+    asyncio.run(chat_instance.achat("hi"))
+    assert events == ["history", "prompt", "complete", "save", "turn"]
+
+
+def test_usage_and_prometheus(memory_store, ai_config, monkeypatch):
+    def completion(**kws):
+        return ModelResponse(choices=[dict(message=dict(role="assistant", content="hi"))],
+                             usage=dict(prompt_tokens=12, completion_tokens=3, total_tokens=15))
+
+    monkeypatch.setattr("ai_chat.openai.completion", completion)
+    exporter = PrometheusExporter()
+    ai_config.instruments = [exporter]
+    chat = OpenaiChat(store=memory_store, ai=ai_config, thread_id="t1")
+    stats = chat.chat("hello").stats
+    assert (stats.prompt_tokens, stats.completion_tokens) == (12, 3)
+
+    text = exporter.render()
+    assert 'ai_chat_turns_total{ai_id="ai_1"} 1' in text
+    assert 'ai_chat_tokens_total{ai_id="ai_1",kind="prompt"} 12' in text
+    assert 'ai_chat_stage_seconds_count{ai_id="ai_1",stage="complete"} 1' in text
+    assert 'ai_chat_stage_seconds_bucket{ai_id="ai_1",stage="turn",le="+Inf"} 1' in text
@@ -0,0 +1,129 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from litellm import ModelResponse
+
+from ai_chat.limits import AdmissionController, Overloaded
+from ai_chat.openai import OpenaiChat
+from tests.test_chat import MockChat, memory_store, ai_config  # noqa
+
+
+def test_admission_priority():
+    admission = AdmissionController(tpm=600)
+    admission.acquire("m", 600)
+    order = []
+
+    def call(name, priority):
+        admission.acquire("m", 5, priority)
+        order.append(name)
+
+    low = threading.Thread(target=call, args=("low", 0))
+    low.start()
+    time.sleep(0.05)
+    high = threading.Thread(target=call, args=("high", 1))
+    high.start()
+    low.join()
+    high.join()
+    assert order == ["high", "low"]
+    assert admission.stats() == dict(admitted=3, shed=0, queued={})
+
+
+def test_admission_sheds():
+    admission = AdmissionController(rpm=60, models={"slow": dict(rpm=1)}, max_wait=0.1)
+    admission.acquire("slow")
+    t0 = time.monotonic()
+    with pytest.raises(Overloaded, match="slow"):
+        admission.acquire("slow")
+    assert time.monotonic() - t0 < 0.05
+    # other models have their own buckets
+    admission.acquire("fast")
+    assert admission.stats()["shed"] == 1
+
+
+def test_admission_interrupted(monkeypatch):
+    class Interrupted(threading.Event):
+        def wait(self, timeout=None):
+            raise KeyboardInterrupt
+
+    admission = AdmissionController(rpm=1, max_wait=120)
+    admission.acquire("m")
+    monkeypatch.setattr("ai_chat.limits.threading.Event", Interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        admission.acquire("m")
+    assert admission.stats()["queued"] == {}
+
+
+def test_admission_headers():
+    admission = AdmissionController()
+    assert admission.limiter("m").wait() == 0
+    admission.update("m", {"x-ratelimit-limit-requests": "120", "x-ratelimit-remaining-requests": "0"})
+    assert 0.4 < admission.limiter("m").wait() <= 0.5
+    admission.update("m", {"retry-after": "3"})
+    assert admission.limiter("m").wait() > 2.5
+
+
+def test_admission_async():
+    admission = AdmissionController(tpm=600, max_wait=5)
+    order = []
+
+    async def call(name, priority, tokens=5):
+        await admission.aacquire("m", tokens, priority)
+        order.append(name)
+
+    async def main():
+        await call("first", 0, 600)
+        waiting = asyncio.create_task(call("cancelled", 5))
+        tasks = [asyncio.create_task(call("low", 0)), asyncio.create_task(call("high", 1))]
+        await asyncio.sleep(0.05)
+        waiting.cancel()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+    assert order == ["first", "high", "low"]
+    assert admission.stats()["queued"] == {}
+
+
+def test_chat_admission(memory_store, ai_config):
+    ai_config.admission = AdmissionController(rpm=1, max_wait=0.05)
+    chat = MockChat(store=memory_store, ai=ai_config, thread_id="t1")
+    chat.chat("hi")
+    with pytest.raises(Overloaded):
+        chat.chat("again")
+
+
+def test_openai_rate_headers(memory_store, ai_config, monkeypatch):
+    def completion(**kws):
+        assert kws["max_retries"] == 0
+        response = ModelResponse(choices=[dict(message=dict(role="assistant", content="hi"))])
+        response._hidden_params["additional_headers"] = {"llm_provider-x-ratelimit-limit-tokens": "6000",
+                                                         "llm_provider-x-ratelimit-remaining-tokens": "10"}
+        return response
+
+    monkeypatch.setattr("ai_chat.openai.completion", completion)
+    ai_config.admission = AdmissionController()
+    chat = OpenaiChat(store=memory_store, ai=ai_config, thread_id="t1")
+    chat.chat("hi")
+    bucket = ai_config.admission.limiter(ai_config.model_params["model"]).tokens
+    assert bucket.capacity == 6000 and bucket.tokens <= 10
+
+
+def test_openai_summarize_admission(memory_store, ai_config, monkeypatch):
+    models = []
+
+    def completion(**kws):
+        models.append(kws["model"])
+        return ModelResponse(choices=[dict(message=dict(role="assistant", content="summary"))])
+
+    monkeypatch.setattr("ai_chat.openai.completion", completion)
+    ai_config.summary_model_params = {"model": "cheap"}
+    ai_config.admission = AdmissionController(rpm=1, max_wait=0.05)
+    chat = OpenaiChat(store=memory_store, ai=ai_config, thread_id="t1")
+    messages = [chat.structure_reply("hi", "user")]
+    assert chat.summarize(None, messages) == "summary"
+    assert models == ["cheap"]
+    # queued on the summary model's own limits
+    assert ai_config.admission.stats()["admitted"] == 1
+    with pytest.raises(Overloaded):
+        chat.summarize("summary", messages)
@@ -0,0 +1,150 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from ai_chat.locks import TurnLock
+from ai_chat.store import SqliteStore
+from tests.test_chat import MockChat, memory_store, ai_config  # noqa
+
+
+class SlowChat(MockChat):
+    def __init__(self, **kws):
+        super().__init__(**kws)
+        self.prompts = []
+
+    def chat_complete(self, prompt, functions):
+        self.prompts.append(prompt)
+        time.sleep(0.1)
+        return "assistant", f"reply to {prompt[-1]['content']!r} after {len(prompt) - 2}", None
+
+
+def run_together(*funcs):
+    threads = [threading.Thread(target=func) for func in funcs]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.02)
+    for thread in threads:
+        thread.join()
+
+
+def test_turn_lock(memory_store, ai_config):
+    ai_config.turn_lock = TurnLock()
+    chat = SlowChat(store=memory_store, ai=ai_config, thread_id="t1")
+    run_together(lambda: chat.chat("a"), lambda: chat.chat("b"))
+    # the second turn saw the first one's messages
+    assert [len(prompt) for prompt in chat.prompts] == [2, 4]
+    contents = [m.content for m in memory_store.get_messages(chat, "")]
+    assert contents == ["a", "reply to 'a' after 0", "b", "reply to 'b' after 2"]
+    assert ai_config.turn_lock.stats() == dict(threads=0, coalesced=0)
+
+
+def test_turn_lock_coalesce(memory_store, ai_config):
+    ai_config.turn_lock = TurnLock(coalesce=True)
+    chat = SlowChat(store=memory_store, ai=ai_config, thread_id="t1")
+    replies = {}
+
+    def send(content):
+        replies[content] = chat.chat(content).content
+
+    run_together(lambda: send("a"), lambda: send("b"), lambda: send("c"))
+    assert len(chat.prompts) == 2
+    assert replies["b"] == replies["c"] == "reply to 'b\\n\\nc' after 2"
+    assert [m.content for m in memory_store.get_messages(chat, "")][2] == "b\n\nc"
+    assert ai_config.turn_lock.coalesced == 1
+
+
+def test_turn_lock_async(memory_store, ai_config):
+    ai_config.turn_lock = TurnLock(coalesce=True)
+    chat = SlowChat(store=memory_store, ai=ai_config, thread_id="t1")
+    other = SlowChat(store=memory_store, ai=ai_config, thread_id="t2")
+
+    async def main():
+        first = asyncio.create_task(chat.achat("a"))
+        while not chat.prompts:
+            await asyncio.sleep(0.005)
+        return await asyncio.gather(first, chat.achat("b"), chat.achat("c"), other.achat("d"))
+
+    t0 = time.monotonic()
+    replies = [r.content for r in asyncio.run(main())]
+    assert replies[1] == replies[2] == "reply to 'b\\n\\nc' after 2"
+    assert replies[3] == "reply to 'd' after 0"
+    # other threads don't wait
+    assert time.monotonic() - t0 < 0.35
+
+
+def test_turn_lock_coalesced_turn_cancelled(memory_store, ai_config):
+    ai_config.turn_lock = TurnLock(coalesce=True)
+    chat = SlowChat(store=memory_store, ai=ai_config, thread_id="t1")
+
+    async def main():
+        first = asyncio.create_task(chat.achat("a"))
+        while not chat.prompts:
+            await asyncio.sleep(0.005)
+        merged, waiting = asyncio.create_task(chat.achat("b")), asyncio.create_task(chat.achat("c"))
+        await first
+        await asyncio.sleep(0.03)
+        merged.cancel()
+        return await asyncio.gather(merged, waiting, return_exceptions=True)
+
+    cancelled, error = asyncio.run(main())
+    assert isinstance(cancelled, asyncio.CancelledError)
+    # c was taken into b's turn, it gets an error rather than a turn of its own on an empty message
+    assert isinstance(error, RuntimeError) and "interrupted" in str(error)
+    assert [prompt[-1]["content"] for prompt in chat.prompts] == ["a", "b\n\nc"]
+    assert ai_config.turn_lock.stats()["threads"] == 0
+
+
+def test_turn_lock_async_waiters(memory_store, ai_config):
+    # waiters don't hold executor threads, so the holder's completion still gets one
+    ai_config.turn_lock = TurnLock(timeout=5)
+    chat = SlowChat(store=memory_store, ai=ai_config, thread_id="t1")
+
+    async def main():
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(2))
+        return await asyncio.gather(*(chat.achat(str(i)) for i in range(12)))
+
+    assert len(asyncio.run(main())) == 12
+    # each turn saw the one before it, up to the history limit
+    assert [len(prompt) for prompt in chat.prompts] == [min(n, 22) for n in range(2, 26, 2)]
+    assert ai_config.turn_lock.stats()["threads"] == 0
+
+
+def test_turn_lock_timeout(memory_store, ai_config):
+    ai_config.turn_lock = TurnLock(timeout=0.05)
+    chat = SlowChat(store=memory_store, ai=ai_config, thread_id="t1")
+    errors = []
+
+    def send(content):
+        try:
+            chat.chat(content)
+        except TimeoutError as e:
+            errors.append(e)
+
+    run_together(lambda: send("a"), lambda: send("b"))
+    assert len(errors) == 1
+    # the lock was handed back, not leaked to the waiter that gave up
+    chat.chat("c")
+    assert ai_config.turn_lock.stats()["threads"] == 0
+
+
+def test_sqlite_lock_thread(tmp_path, ai_config):
+    one, two = SqliteStore(tmp_path / "db.sqlite"), SqliteStore(tmp_path / "db.sqlite")
+    chat = MockChat(store=one, ai=ai_config, thread_id="t1")
+    with one.lock_thread(chat):
+        with pytest.raises(TimeoutError):
+            with two.lock_thread(chat, timeout=0.05):
+                pass
+        # other threads are free
+        with two.lock_thread(MockChat(store=two, ai=ai_config, thread_id="t2"), timeout=0.05):
+            pass
+    with two.lock_thread(chat, timeout=0.05):
+        pass
+
+    # a lease left by a dead process runs out
+    one.lock_lease = 0.0
+    with one.lock_thread(chat):
+        with two.lock_thread(chat, timeout=0.5):
+            pass
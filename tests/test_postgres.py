@@ -1,8 +1,13 @@
+import sqlite3
+
+import psycopg2
 import pytest
+from psycopg2.pool import PoolError
 from dotenv import load_dotenv
 
 from ai_chat import Message
 from ai_chat.store import PostgresStore
+from ai_chat.store.postgres import MIGRATE_SEQ
 from ai_chat.util import uuid
 from tests.test_chat import chat_instance, memory_store, ai_config  # noqa
 
@@ -14,9 +19,8 @@ def postgres():
     store = PostgresStore()
     store.create()
     yield store, test_id
-    with store.conn.cursor() as cur:
-        cur.execute("DELETE FROM messages WHERE ai_id = %s", (test_id,))
-    store.conn.commit()
+    store.execute("DELETE FROM messages WHERE ai_id = %s", (test_id,))
+    store.close()
 
 
 def test_postgres_store(chat_instance, postgres):
@@ -44,3 +48,130 @@ def test_postgres_store(chat_instance, postgres):
     store.set_state(chat_instance, "name", "val")
 
     assert store.get_state(chat_instance, "name") == "val"
+
+
+class FakeConn:
+    def __init__(self, fail=False, cancel=False):
+        self.closed = 0
+        self.fail = fail
+        self.cancel = cancel
+        self.commits = 0
+        self.executed = 0
+
+    def cursor(self):
+        conn = self
+
+        class Cursor:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                pass
+
+            def execute(self, query, params):
+                conn.executed += 1
+                if conn.fail:
+                    # as psycopg2 does when the connection is lost
+                    conn.closed = 2
+                    raise psycopg2.OperationalError("server closed the connection")
+                if conn.cancel:
+                    raise psycopg2.extensions.QueryCanceledError("canceling statement due to statement timeout")
+
+            def fetchall(self):
+                return [{"content": '"val"'}]
+
+        return Cursor()
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+class FakePool:
+    def __init__(self, conns):
+        self.conns = conns
+        self.out = []
+
+    def getconn(self):
+        conn = self.conns.pop(0)
+        self.out.append(conn)
+        return conn
+
+    def putconn(self, conn):
+        self.out.remove(conn)
+        if not conn.closed:
+            self.conns.append(conn)
+
+
+def test_postgres_pool_replaces_broken_connection(chat_instance):
+    broken, good = FakeConn(fail=True), FakeConn()
+    pool = FakePool([broken, good])
+    store = PostgresStore(pool=pool)
+
+    assert store.get_state(chat_instance, "name") == "val"
+    assert broken.closed
+    assert pool.conns == [good]
+    assert not pool.out
+
+
+def test_postgres_query_timeout_keeps_connection(chat_instance):
+    timed_out = FakeConn(cancel=True)
+    pool = FakePool([timed_out])
+    store = PostgresStore(pool=pool)
+    with pytest.raises(psycopg2.extensions.QueryCanceledError):
+        store.get_state(chat_instance, "name")
+    # not retried, and the connection went back to the pool
+    assert timed_out.executed == 1 and not timed_out.closed
+    assert pool.conns == [timed_out]
+
+    # a single connection is never closed or retried on
+    conn = FakeConn(cancel=True)
+    store = PostgresStore(conn)
+    with pytest.raises(psycopg2.extensions.QueryCanceledError):
+        store.get_state(chat_instance, "name")
+    conn.cancel = False
+    assert store.get_state(chat_instance, "name") == "val"
+    assert conn.executed == 2 and not conn.closed
+
+
+def test_postgres_pool_waits_for_a_connection(chat_instance):
+    pool = FakePool([FakeConn()])
+    store = PostgresStore(pool=pool, maxconn=1, checkout_timeout=0.05)
+    with store.connection():
+        # the pool has nothing left, the checkout waits for a slot and gives up
+        with pytest.raises(PoolError):
+            store.get_state(chat_instance, "name")
+    assert store.get_state(chat_instance, "name") == "val"
+    assert not pool.out
+
+
+def test_postgres_message_rows(chat_instance):
+    chat_instance.thread_id = "t1"
+    msgs = [chat_instance.structure_reply(str(i), "user") for i in range(3)]
+    msgs[1].thread_id = "t2"
+    groups = PostgresStore.thread_groups(msgs, chat_instance)
+    assert [[m.content for m in group] for group in groups.values()] == [["0", "2"], ["1"]]
+    rows = PostgresStore.message_rows(groups[("t1", chat_instance.ai.id)], "t1", chat_instance.ai.id, 7)
+    assert [(row[2], row[-1]) for row in rows] == [("0", 6), ("2", 7)]
+
+
+def test_postgres_migrate_partly_numbered_thread():
+    # the numbering is plain SQL, sqlite runs it too
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE messages (id text, created_at text, ai_id text, thread_id text, seq bigint)")
+    conn.execute("CREATE TABLE message_seqs (thread_id text, ai_id text, seq bigint)")
+    conn.executemany("INSERT INTO messages VALUES (?, ?, 'a', ?, ?)", [
+        ("old1", "2023-01-01", "t1", None), ("old2", "2023-01-02", "t1", None),
+        ("new1", "2023-01-03", "t1", 1), ("new2", "2023-01-04", "t1", 2),
+        ("other", "2023-01-01", "t2", None),
+    ])
+    # a seq reserved but never written
+    conn.execute("INSERT INTO message_seqs VALUES ('t1', 'a', 3)")
+    conn.execute(MIGRATE_SEQ[1])
+    seqs = dict(conn.execute("SELECT id, seq FROM messages"))
+    assert seqs == {"old1": 4, "old2": 5, "new1": 1, "new2": 2, "other": 1}
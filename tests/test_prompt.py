@@ -0,0 +1,89 @@
+from ai_chat import Message
+from ai_chat.prompt import TokenCounter, estimate_tokens, PromptBuilder
+from tests.test_chat import chat_instance, memory_store, ai_config  # noqa
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("abcd" * 10) == 11
+
+
+def test_token_counter_caches_by_id():
+    calls = []
+
+    def tokenizer(text):
+        calls.append(text)
+        return len(text)
+
+    counter = TokenCounter(tokenizer)
+    msg = Message(id="m1", role="user", content="hello")
+    info = {"role": "user", "content": "hello"}
+    assert counter.count_message(msg, info) == counter.count_message(msg, info)
+    assert calls == ["hello"]
+
+
+def test_prompt_budget_keeps_newest(chat_instance):
+    chat_instance.ai.max_prompt = 60
+    history = [Message(id=str(i), role="user", content="x" * 40 + str(i)) for i in range(10)]
+    prompt = chat_instance.build_prompt("hi", history)
+    assert prompt[0]["role"] == "system"
+    assert 1 < len(prompt) < 11
+    assert prompt[-1]["content"] == history[-1].content
+    counter = chat_instance.ai.token_counter
+    assert sum(counter.count_prompt(p) for p in prompt) + counter.count_prompt({"content": "hi"}) <= 60
+
+
+def test_prompt_no_budget(chat_instance):
+    chat_instance.ai.max_prompt = None
+    history = [Message(id=str(i), role="user", content="x" * 400) for i in range(10)]
+    assert len(PromptBuilder().build(chat_instance, "hi", history)) == 11
+
+
+def test_prompt_seed_chat(chat_instance):
+    chat_instance.ai.seed_chat = [["hi", "hello"]]
+    prompt = chat_instance.build_prompt("yo", [])
+    assert [p["role"] for p in prompt] == ["system", "user", "assistant"]
+
+
+def test_prompt_incremental(chat_instance):
+    chat_instance.ai.max_prompt = None
+    calls = []
+    get_prompt = chat_instance.get_prompt
+    chat_instance.get_prompt = lambda role, content: calls.append(content) or get_prompt(role, content)
+    history = [Message(id=str(i), role="user", content=f"m{i}") for i in range(4)]
+
+    builder = chat_instance.prompt_builder
+    first = chat_instance.build_prompt("a", history[:2])
+    first.append({"role": "user", "content": "a"})
+    second = chat_instance.build_prompt("b", history)
+    assert [p["content"] for p in second] == ["My AI System", "m0", "m1", "m2", "m3"]
+    assert calls == ["m0", "m1", "m2", "m3"]
+    assert builder.stats()["rebuilds"] == 1 and builder.prefix == 3
+
+    # the window slid, the kept messages are reused after the head
+    history.append(Message(id="4", role="user", content="m4"))
+    third = chat_instance.build_prompt("c", history[2:])
+    assert [p["content"] for p in third] == ["My AI System", "m2", "m3", "m4"]
+    assert builder.rebuilds == 1 and builder.prefix == 1
+    assert calls == ["m0", "m1", "m2", "m3", "m4"]
+
+    # not a continuation of the last window
+    assert [p["content"] for p in chat_instance.build_prompt("d", history[1:3])] == ["My AI System", "m1", "m2"]
+    assert builder.rebuilds == 2 and builder.prefix == 0
+
+    chat_instance.ai.system = "changed"
+    assert chat_instance.build_prompt("e", history[1:3])[0]["content"] == "changed"
+    assert builder.rebuilds == 3
+
+
+def test_prompt_head_shrinks(chat_instance):
+    chat_instance.ai.max_prompt = None
+    chat_instance.ai.seed_chat = [["example q", "example a"]]
+    history = [Message(id=str(i), role="user", content=f"m{i}") for i in range(3)]
+    assert len(chat_instance.build_prompt("first", [])) == 3
+    # the seed chat is dropped once there's history, not kept as if it were
+    assert [p["content"] for p in chat_instance.build_prompt("second", history[:1])] == ["My AI System", "m0"]
+
+    summarized = chat_instance.build_prompt("third", history[1:], summary="s")
+    assert len(summarized) == 4 and summarized[1]["content"].endswith("s")
+    assert [p["content"] for p in chat_instance.build_prompt("fourth", history[1:])] == ["My AI System", "m1", "m2"]
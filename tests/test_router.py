@@ -0,0 +1,149 @@
+import asyncio
+import time
+
+import litellm
+import pytest
+from litellm import ModelResponse
+
+from ai_chat.hedge import Hedger
+from ai_chat.limits import AdmissionController
+from ai_chat.router import ModelRouter, RouterChat
+from ai_chat.stats import LatencyWindow
+from tests.test_chat import _stream_chunks, memory_store, ai_config  # noqa
+
+
+def reply(content):
+    return ModelResponse(choices=[dict(message=dict(role="assistant", content=content))])
+
+
+def rate_limited(model):
+    return litellm.RateLimitError("slow down", llm_provider="openai", model=model)
+
+
+def test_latency_window():
+    window = LatencyWindow()
+    for latency in range(1, 101):
+        window.add(latency / 100)
+    window.add(5.0, ok=False)
+    assert window.p50 == 0.51
+    assert window.p95 == 0.96
+    assert window.error_rate == pytest.approx(1 / 101)
+
+
+def test_router_fails_over(memory_store, ai_config):
+    calls = []
+
+    def completion(model, **kws):
+        calls.append(model)
+        if model == "primary":
+            raise rate_limited(model)
+        return reply(f"from {model}")
+
+    router = ModelRouter([dict(model="primary"), dict(model="backup")], backoff=0, completion=completion)
+    chat = RouterChat(router=router, store=memory_store, ai=ai_config, thread_id="t1")
+    assert chat.chat("hi").content == "from backup"
+    assert calls == ["primary", "backup"]
+
+    # primary is cooling down, so it isn't tried again
+    assert chat.chat("again").content == "from backup"
+    assert calls[2:] == ["backup"]
+    assert router.snapshot()["primary"]["down"]
+    assert router.snapshot()["backup"]["count"] == 2
+
+
+def test_router_bounded_retries():
+    calls = []
+
+    def completion(model, **kws):
+        calls.append(model)
+        raise litellm.Timeout("timed out", model=model, llm_provider="openai")
+
+    router = ModelRouter([dict(model="a"), dict(model="b")], retries=2, backoff=0, completion=completion)
+    with pytest.raises(litellm.Timeout):
+        router.complete(dict(messages=[]))
+    assert calls == ["a", "b", "a"]
+
+
+def test_router_does_not_retry_bad_requests():
+    calls = []
+
+    def completion(model, **kws):
+        calls.append(model)
+        raise ValueError("bad prompt")
+
+    router = ModelRouter([dict(model="a"), dict(model="b")], backoff=0, completion=completion)
+    with pytest.raises(ValueError):
+        router.complete(dict(messages=[]))
+    assert calls == ["a"]
+
+
+def test_router_prefers_fast_model():
+    router = ModelRouter([dict(model="slow"), dict(model="fast", weight=2)], strategy="latency")
+    for _ in range(10):
+        router.stats["slow"].add(2.0)
+        router.stats["fast"].add(1.0)
+    assert router.candidates() == [1, 0]
+    router.stats["fast"].add(1.0, ok=False)
+    router.down_until["fast"] = float("inf")
+    assert router.candidates() == [0, 1]
+
+
+def test_router_stream_fails_over(memory_store, ai_config):
+    async def acompletion(model, stream, **kws):
+        if model == "primary":
+            raise rate_limited(model)
+
+        async def chunks():
+            for chunk in _stream_chunks(dict(content="hel"), dict(content="lo")):
+                yield chunk
+        return chunks()
+
+    router = ModelRouter([dict(model="primary"), dict(model="backup")], backoff=0, acompletion=acompletion)
+    chat = RouterChat(router=router, store=memory_store, ai=ai_config, thread_id="t1")
+
+    async def run():
+        return [delta async for delta in chat.achat_stream("hi")]
+
+    assert asyncio.run(run()) == ["hel", "lo"]
+    assert memory_store.get_messages(chat, "")[-1].content == "hello"
+
+
+def test_router_requests_hedged_and_limited(memory_store, ai_config):
+    calls = []
+
+    def completion(model, **kws):
+        calls.append(model)
+        time.sleep(0.3 if len(calls) == 1 else 0.0)
+        response = reply(f"from {model} {len(calls)}")
+        response._hidden_params["additional_headers"] = {"x-ratelimit-limit-requests": "120",
+                                                         "x-ratelimit-remaining-requests": "0"}
+        return response
+
+    router = ModelRouter([dict(model="primary")], backoff=0, completion=completion)
+    ai_config.hedger = Hedger(max_delay=0.05, max_rate=1.0)
+    ai_config.admission = AdmissionController()
+    chat = RouterChat(router=router, store=memory_store, ai=ai_config, thread_id="t1")
+    # a routed call goes through request(), so it is hedged, and the headers reach admission
+    assert chat.chat("hi").content == "from primary 2"
+    assert ai_config.hedger.hedge_wins == 1
+    assert ai_config.admission.limiter("primary").wait() > 0
+
+
+def test_router_admits_routed_model(memory_store, ai_config):
+    calls = []
+
+    def completion(model, **kws):
+        calls.append(model)
+        return reply(f"from {model}")
+
+    ai_config.admission = AdmissionController(rpm=60, models={"primary": dict(rpm=1)}, max_wait=0)
+    router = ModelRouter([dict(model="primary"), dict(model="backup")], backoff=0, completion=completion)
+    chat = RouterChat(router=router, store=memory_store, ai=ai_config, thread_id="t1")
+    assert chat.chat("hi").content == "from primary"
+    # primary's own limit is used up, the call moves on instead of waiting or failing
+    assert chat.chat("again").content == "from backup"
+    assert calls == ["primary", "backup"]
+    assert ai_config.admission.stats() == dict(admitted=2, shed=1, queued={})
+    # nothing was counted against the configured model
+    assert ai_config.model_params["model"] not in ai_config.admission.limiters
+    assert not router.snapshot()["primary"]["down"]
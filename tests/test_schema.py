@@ -0,0 +1,42 @@
+from typing import Annotated
+
+from ai_chat.schema import function_schema
+from ai_chat.types import AIFunctions
+from tests.test_chat import chat_instance, memory_store, ai_config  # noqa
+
+
+def first(arg: Annotated[str, "arg 1"], **kws):
+    """First function"""
+
+
+def second(arg: Annotated[str, "arg 1"], **kws):
+    """Second function"""
+
+
+def test_schema_memoized(chat_instance, monkeypatch):
+    funcs = AIFunctions([first])
+    calls = []
+    openai_dict = funcs.openai_dict
+    monkeypatch.setattr(funcs, "openai_dict", lambda: calls.append(1) or openai_dict())
+
+    chat_instance.functions = funcs
+    schema = chat_instance.function_schema(chat_instance.get_functions())
+    assert chat_instance.function_schema(funcs) is schema
+    assert function_schema(funcs) is schema
+    assert len(calls) == 1
+    assert [f["name"] for f in schema.functions] == ["first"]
+    assert schema.tools[0]["function"] is schema.functions[0]
+
+    funcs.add(second)
+    changed = chat_instance.function_schema(funcs)
+    assert [f["name"] for f in changed.functions] == ["first", "second"]
+    assert changed.digest != schema.digest
+
+
+def test_schema_reset_on_assign(chat_instance):
+    chat_instance.functions = AIFunctions([first])
+    chat_instance.function_schema(chat_instance.functions)
+    chat_instance.functions = AIFunctions([second])
+    assert chat_instance._schema is None
+    assert chat_instance.function_schema(chat_instance.functions).functions[0]["name"] == "second"
+    assert chat_instance.function_schema(None) is None
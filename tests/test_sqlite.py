@@ -39,4 +39,96 @@ def test_sqlite_store(chat_instance, sqlite):
 
     store.set_state(chat_instance, "name", "val")
 
-    assert store.get_state(chat_instance, "name") == "val"
\ No newline at end of file
+    assert store.get_state(chat_instance, "name") == "val"
+
+def test_sqlite_add_messages(chat_instance, sqlite):
+    store, ai_id = sqlite
+    chat_instance.ai.id = ai_id
+    chat_instance.thread_id = uuid()
+    msgs = [chat_instance.structure_reply(str(i), "user") for i in range(5)]
+    store.add_messages(msgs, chat_instance)
+    assert [m.content for m in store.get_messages(chat_instance, "")] == ["0", "1", "2", "3", "4"]
+
+
+def test_sqlite_get_messages_pages(chat_instance, sqlite):
+    store, ai_id = sqlite
+    chat_instance.ai.id = ai_id
+    chat_instance.thread_id = uuid()
+    store.add_messages([chat_instance.structure_reply(str(i), "user") for i in range(25)], chat_instance)
+
+    page = store.get_messages(chat_instance, "", limit=10)
+    assert [m.content for m in page] == [str(i) for i in range(15, 25)]
+
+    page = store.get_messages(chat_instance, "", limit=10, before=page[0])
+    assert [m.content for m in page] == [str(i) for i in range(5, 15)]
+
+    page = store.get_messages(chat_instance, "", limit=10, before=page[0])
+    assert [m.content for m in page] == [str(i) for i in range(5)]
+
+
+def test_sqlite_wal_threads(chat_instance, tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    store = SqliteStore(tmp_path / "wal.db", wal=True)
+    chat_instance.thread_id = uuid()
+
+    def write(i):
+        store.add_message(chat_instance.structure_reply(str(i), "user"), chat_instance)
+        return len(store.get_messages(chat_instance, "", limit=1000))
+
+    with ThreadPoolExecutor(8) as pool:
+        counts = list(pool.map(write, range(100)))
+
+    # each writer sees at least its own write once add_message returns
+    assert min(counts) >= 1
+    assert len(store.get_messages(chat_instance, "", limit=1000)) == 100
+    assert store.fetch("PRAGMA journal_mode", ())[0][0] == "wal"
+
+    # a failed write doesn't take the rest of its group down with it
+    msg = chat_instance.structure_reply("dup", "user")
+    store.add_message(msg, chat_instance)
+    with pytest.raises(Exception):
+        store.add_message(msg, chat_instance)
+    store.set_state(chat_instance, "name", "val")
+    assert store.get_state(chat_instance, "name") == "val"
+    store.close()
+
+
+def test_sqlite_seq(chat_instance, sqlite, monkeypatch):
+    store, ai_id = sqlite
+    chat_instance.thread_id = uuid()
+    # a stuck clock doesn't matter, seq orders the thread
+    monkeypatch.setattr("ai_chat.store.sqlite.time.time", lambda: 1000.0)
+    store.add_message(chat_instance.structure_reply("b", "user"), chat_instance)
+    store.add_message(chat_instance.structure_reply("a", "assistant"), chat_instance)
+    store.add_messages([chat_instance.structure_reply(c, "user") for c in "zy"], chat_instance)
+    msgs = store.get_messages(chat_instance, "")
+    assert [(m.seq, m.content) for m in msgs] == [(1, "b"), (2, "a"), (3, "z"), (4, "y")]
+    plan = " ".join(row[3] for row in store.fetch(
+        "EXPLAIN QUERY PLAN SELECT * FROM messages WHERE thread_id = ? AND ai_id = ? ORDER BY seq DESC LIMIT 20",
+        (chat_instance.thread_id, chat_instance.ai.id)))
+    assert "ux_messages_thread_ai_seq" in plan and "TEMP B-TREE" not in plan
+
+
+def test_sqlite_migrate_seq(chat_instance, tmp_path):
+    import sqlite3
+
+    conn = sqlite3.connect(tmp_path / "old.db")
+    conn.execute("CREATE TABLE messages (id TEXT PRIMARY KEY, role TEXT, content TEXT, thread_id TEXT, "
+                 "ai_id TEXT, created_at REAL)")
+    conn.executemany("INSERT INTO messages VALUES (?, 'user', ?, ?, ?, ?)", [
+        ("m2", "second", "t1", chat_instance.ai.id, 2.0),
+        ("m1", "first", "t1", chat_instance.ai.id, 1.0),
+        ("m3", "other", "t2", chat_instance.ai.id, 1.5),
+    ])
+    conn.commit()
+    conn.close()
+
+    store = SqliteStore(tmp_path / "old.db")
+    chat_instance.thread_id = "t1"
+    store.add_message(chat_instance.structure_reply("third", "user"), chat_instance)
+    assert [(m.seq, m.content) for m in store.get_messages(chat_instance, "")] == [
+        (1, "first"), (2, "second"), (3, "third")]
+    # opening it again leaves it be
+    SqliteStore(tmp_path / "old.db")
+    assert len(store.get_messages(chat_instance, "")) == 3
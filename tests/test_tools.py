@@ -0,0 +1,69 @@
+from typing import Annotated
+
+from ai_chat import AiConfig, Function
+from ai_chat.store import MemoryStore, HashingEmbedder
+from ai_chat.tools import ToolSelector, words
+from ai_chat.types import AIFunctions
+from tests.test_chat import MockChat
+
+
+def get_weather(city: Annotated[str, "city to check"], **kws):
+    """Current weather forecast for a city"""
+    return "sunny"
+
+
+def send_email(to: Annotated[str, "recipient address"], **kws):
+    """Send an email message"""
+    return "sent"
+
+
+def search_files(query: Annotated[str, "text to find"], **kws):
+    """Search the user's documents"""
+
+
+def get_time(**kws):
+    """Current time"""
+    return "noon"
+
+
+def make_chat(selector):
+    funcs = AIFunctions([get_weather, send_email, search_files, get_time])
+    ai = AiConfig(id="ai_1", system="sys", functions=funcs, tool_selector=selector)
+    return MockChat(ai=ai, thread_id="t1", store=MemoryStore())
+
+
+def test_words():
+    assert words("getWeather send_email to the user's") == ["get", "weather", "send", "email", "user"]
+
+
+def test_selects_relevant_functions():
+    selector = ToolSelector(top_k=1, pinned=["get_time"])
+    chat = make_chat(selector)
+    chat.turn_content = "what's the weather in paris?"
+    selected = chat.get_functions()
+    assert list(selected.map) == ["get_weather", "get_time"]
+    assert selector.saved_tokens > 0
+
+    assert chat.get_functions() is selected
+    assert selector.stats()["hits"] == 1
+
+    # unselected functions still run
+    assert chat.execute_function(Function(name="send_email", arguments='{"to": "x"}')) == "sent"
+
+
+def test_no_match_sends_pinned_only():
+    chat = make_chat(ToolSelector(top_k=2, pinned=["get_time"]))
+    chat.turn_content = "hello there"
+    assert list(chat.get_functions().map) == ["get_time"]
+
+
+def test_small_sets_unchanged():
+    chat = make_chat(ToolSelector(top_k=4))
+    chat.turn_content = "weather"
+    assert chat.get_functions() is chat.functions
+
+
+def test_embedding_selector():
+    chat = make_chat(ToolSelector(top_k=1, embedder=HashingEmbedder()))
+    chat.chat("please send an email to bob")
+    assert list(chat.get_functions().map) == ["send_email"]
@@ -0,0 +1,74 @@
+import subprocess
+import sys
+
+import numpy as np
+
+from ai_chat.store import VectorRecallStore, HashingEmbedder, MemoryStore, SqliteStore, Store
+from tests.test_chat import MockChat, chat_instance, memory_store, ai_config  # noqa
+
+
+def test_hashing_embedder_is_deterministic():
+    emb = HashingEmbedder(dim=64)
+    a, b = emb(["the cat sat", "the cat sat"])
+    assert a.shape == (64,)
+    assert np.array_equal(a, b)
+    assert emb(["x"]).any()
+
+
+def test_vector_recall(tmp_path, ai_config):
+    store = VectorRecallStore(SqliteStore(tmp_path / "db"), recent=2)
+    chat = MockChat(store=store, ai=ai_config, thread_id="t1")
+    chat.add_message("user", "my dog is named rex")
+    for i in range(20):
+        chat.add_message("user", f"filler message number {i}")
+
+    msgs = store.get_messages(chat, "what is my dog named", limit=4)
+    contents = [m.content for m in msgs]
+    assert contents[0] == "my dog is named rex"
+    assert contents[-2:] == ["filler message number 18", "filler message number 19"]
+
+    # the matrix is grown in memory, and persisted for a fresh store
+    chat.add_message("user", "my cat is named tom")
+    chat.add_message("user", "more filler")
+    chat.add_message("user", "even more filler")
+    assert store.get_messages(chat, "cat named", limit=3)[0].content == "my cat is named tom"
+
+    fresh = VectorRecallStore(SqliteStore(tmp_path / "db"), recent=2)
+    assert fresh.get_messages(chat, "cat named", limit=3)[0].content == "my cat is named tom"
+
+
+def test_vector_recall_without_content(ai_config):
+    store = VectorRecallStore(SqliteStore(":memory:"))
+    chat = MockChat(store=store, ai=ai_config, thread_id="t1")
+    chat.chat("hello")
+    assert [m.role for m in store.get_messages(chat, "")] == ["user", "assistant"]
+
+
+class StateOnlyStore(MemoryStore):
+    """A store without its own embeddings table, like SupabaseStore."""
+    get_messages_by_id = Store.get_messages_by_id
+    add_embeddings = Store.add_embeddings
+    get_embeddings = Store.get_embeddings
+
+
+def test_vector_recall_default_hooks(ai_config):
+    inner = StateOnlyStore()
+    store = VectorRecallStore(inner, recent=2)
+    chat = MockChat(store=store, ai=ai_config, thread_id="t1")
+    writes = []
+    set_states = inner.set_states
+    inner.set_states = lambda chat, states: writes.append(len(states)) or set_states(chat, states)
+    chat.add_message("user", "my dog is named rex")
+    for i in range(150):
+        chat.add_message("user", f"filler message number {i}")
+
+    assert len(inner.get_embeddings(chat)) == 151
+    # each add writes its own vector, not the thread's so far
+    assert writes == [1] * 151
+    msgs = VectorRecallStore(inner, recent=2).get_messages(chat, "what is my dog named", limit=4)
+    assert msgs[0].content == "my dog is named rex"
+
+
+def test_import_without_numpy():
+    code = "import sys; sys.modules['numpy'] = None; import ai_chat, ai_chat.store"
+    assert subprocess.run([sys.executable, "-c", code]).returncode == 0